@@ -59,6 +59,7 @@ import xmlrpclib
 import httplib
 import socket
 import sys
+import threading
 
 translation = gettext.translation('xen-xm', fallback=True)
 
@@ -94,6 +95,8 @@ class UDSHTTPConnection(httplib.HTTPConnection):
     def connect(self):
         path = self.host.replace("_", "/")
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(getattr(self, 'timeout', None), (int, long, float)):
+            self.sock.settimeout(self.timeout)
         self.sock.connect(path)
 
 
@@ -101,27 +104,120 @@ class UDSHTTP(httplib.HTTPConnection):
     _connection_class = UDSHTTPConnection
 
 
-class UDSTransport(xmlrpclib.Transport):
-
-    def __init__(self, use_datetime=0):
-        self._use_datetime = use_datetime
+class PooledTransport(xmlrpclib.Transport):
+    """Keep-alive transport: up to max_connections persistent HTTP(S)
+    connections per host are kept between the calls. A connection is used by
+    one call at a time, so a Session using this transport can be shared by
+    several threads. timeout is the socket timeout in seconds (None: the
+    socket default)."""
+
+    def __init__(self, use_datetime=0, timeout=None, max_connections=4,
+                 https=False, context=None):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.https = https
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.context = context
+        self.verbose = 0
         self._extra_headers = []
-        self._connection = (None, None)
+        self._idle = {}
+        self._lock = threading.Lock()
 
     def add_extra_header(self, key, value):
         self._extra_headers += [ (key, value) ]
 
     def make_connection(self, host):
-        # Python 2.4 compatibility
-        if sys.version_info[0] <= 2 and sys.version_info[1] < 7:
-            return UDSHTTP(host)
-        else:
-            return UDSHTTPConnection(host)
-
-    def send_request(self, connection, handler, request_body):
-        connection.putrequest("POST", handler)
-        for key, value in self._extra_headers:
+        """Return a new connection to host"""
+        chost, extra_headers, x509 = self.get_host_info(host)
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if self.https:
+            if self.context is not None:
+                kwargs['context'] = self.context
+            return httplib.HTTPSConnection(chost, **kwargs)
+        return httplib.HTTPConnection(chost, **kwargs)
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.verbose = verbose
+        connection = self._get_connection(host)
+        reused = connection.sock is not None
+        try:
+            try:
+                response = self._send(connection, host, handler, request_body)
+            except socket.timeout:
+                raise
+            except (socket.error, httplib.HTTPException):
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry once on a new one
+                connection.close()
+                connection = self.make_connection(host)
+                response = self._send(connection, host, handler, request_body)
+            if response.status != 200:
+                response.read()
+                raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                              response.reason, response.msg)
+            result = self.parse_response(response)
+        except:
+            connection.close()
+            raise
+        self._put_connection(host, connection)
+        return result
+
+    def close(self):
+        """Close the idle connections"""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _send(self, connection, host, handler, request_body):
+        chost, extra_headers, x509 = self.get_host_info(host)
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        for key, value in (extra_headers or []) + self._extra_headers:
             connection.putheader(key, value)
+        connection.putheader("User-Agent", self.user_agent)
+        connection.putheader("Content-Type", "text/xml")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        connection.send(request_body)
+        return connection.getresponse()
+
+    def _get_connection(self, host):
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(host)
+            if connections:
+                return connections.pop()
+        finally:
+            self._lock.release()
+        return self.make_connection(host)
+
+    def _put_connection(self, host, connection):
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault(host, [])
+            if len(connections) < self.max_connections:
+                connections.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+
+class UDSTransport(PooledTransport):
+
+    def make_connection(self, host):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return UDSHTTPConnection(host, **kwargs)
 
 
 class Session(xmlrpclib.ServerProxy):
@@ -137,19 +233,23 @@ class Session(xmlrpclib.ServerProxy):
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=1, ignore_ssl=False):
+                 allow_none=1, ignore_ssl=False, timeout=None,
+                 max_connections=4):
 
         # Fix for CA-172901 (+ Python 2.4 compatibility)
         # Fix for context=ctx ( < Python 2.7.9 compatibility)
+        ctx = None
         if not (sys.version_info[0] <= 2 and sys.version_info[1] <= 7 and sys.version_info[2] <= 9) \
                 and ignore_ssl:
             import ssl
             ctx = ssl._create_unverified_context()
-            xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
-                                           verbose, allow_none, context=ctx)
-        else:
-            xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
-                                           verbose, allow_none)
+        if transport is None:
+            transport = PooledTransport(timeout=timeout,
+                                        max_connections=max_connections,
+                                        https=uri.startswith('https'),
+                                        context=ctx)
+        xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
+                                       verbose, allow_none)
         self.transport = transport
         self._session = None
         self.last_login_method = None
@@ -208,6 +308,8 @@ class Session(xmlrpclib.ServerProxy):
             self.last_login_method = None
             self.last_login_params = None
             self.API_version = API_VERSION_1_1
+            if isinstance(self.transport, PooledTransport):
+                self.transport.close()
 
     def _get_api_version(self):
         pool = self.xenapi.pool.get_all()[0]
@@ -229,8 +331,8 @@ class Session(xmlrpclib.ServerProxy):
             return xmlrpclib.ServerProxy.__getattr__(self, name)
 
 
-def xapi_local():
-    return Session("http://_var_xapi_xapi/", transport=UDSTransport())
+def xapi_local(timeout=None):
+    return Session("http://_var_xapi_xapi/", transport=UDSTransport(timeout=timeout))
 
 
 def _parse_result(result):
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: benchmark.py
+ Author: longhui
+ Created Time: 2018-09-10 15:02:11
+
+ Benchmarks of the xenserver plugins code paths.
+
+ metadata: time the uuid -> name translation loading of Connect() against a
+           real XenServer, one get_all_records() call per class (MetadataCache)
+           against the former get_all() + get_uuid()/get_name_label()/... per VM path
+     python benchmark.py metadata --host=192.168.1.10 -u root -p password
+
+ carbon:   bytes and CPU time of the carbon plaintext and pickle protocols for the
+           metrics of example.xml, repeated up to --metrics. The receiving side is
+           measured by decoding the output the way carbon does
+     python benchmark.py carbon --metrics=100000 --batch-size=500
+
+ parse:    CPU time of GetRRDUdpates.Parse(), of the latest row selection and of the
+           rendering of the metrics for collectd, PUTVAL (collectd exec) and carbon, with
+           the peak memory of each document. The documents are example.xml and generated
+           ones of --vms x --vm-metrics x --rows (comma separated lists), the results are
+           written as JSON so they can be compared between versions
+     python benchmark.py parse --vms=10,100,1000 --vm-metrics=20 --rows=12 --output=parse.json
+
+ generate: print a generated rrd_updates document
+     python benchmark.py generate --vms=100 --vm-metrics=20 --rows=12 > rrd_updates.xml
+"""
+from optparse import OptionParser
+import os
+import time
+import sys
+import struct
+import resource
+import json
+import traceback
+from cStringIO import StringIO
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import XenAPI
+import graphite_common
+import xenserver_common
+
+
+class CountingSession(XenAPI.Session):
+    ''' XenAPI.Session counting the XML-RPC calls it makes '''
+    def __init__(self, *args, **kwargs):
+        XenAPI.Session.__init__(self, *args, **kwargs)
+        self.calls = 0
+
+    def xenapi_request(self, methodname, params):
+        self.calls += 1
+        return XenAPI.Session.xenapi_request(self, methodname, params)
+
+
+def load_per_object(session):
+    '''
+    The former Connect() path: one call to list the VMs, then one call per VM and field
+    '''
+    uuid_name_map = {}
+    host_ref = session.xenapi.host.get_all()[0]
+    uuid = session.xenapi.host.get_uuid(host_ref)
+    server_name = session.xenapi.host.get_hostname(host_ref)
+    uuid_name_map[uuid] = server_name
+    for vm_ref in session.xenapi.VM.get_all():
+        vm_uuid = session.xenapi.VM.get_uuid(vm_ref)
+        vm_name = session.xenapi.VM.get_name_label(vm_ref)
+        if session.xenapi.VM.get_is_control_domain(vm_ref):
+            uuid_name_map[vm_uuid] = server_name + "_control-domain"
+        else:
+            uuid_name_map[vm_uuid] = vm_name
+    return uuid_name_map
+
+
+def load_bulk(session):
+    uuid_name_map = xenserver_common.MetadataCache('hostname', '_control-domain')
+    uuid_name_map.Load(session)
+    return uuid_name_map
+
+
+def bench_metadata(options):
+    session = CountingSession("http://" + options.host)
+    session.xenapi.login_with_password(options.user, options.passwd)
+    try:
+        for name, load in (("per_object", load_per_object), ("get_all_records", load_bulk)):
+            best = None
+            for i in range(options.repeat):
+                session.calls = 0
+                t1 = time.time()
+                uuid_name_map = load(session)
+                elapsed = time.time() - t1
+                if best is None or elapsed < best:
+                    best = elapsed
+            print "%-16s %8.3fs %6d calls %6d names" % (name, best, session.calls, len(uuid_name_map))
+    finally:
+        session.logout()
+
+
+EXAMPLE_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.xml")
+
+
+def example_metrics(count, path=EXAMPLE_XML):
+    '''
+    Return count (path, value, timestamp) tuples named like xenserverPlugin does,
+    from the newest row of path, repeated with a suffix as needed
+    '''
+    rrdupdates = xenserver_common.GetRRDUdpates()
+    rrdupdates.Parse(open(path))
+    (timestamp, hostData, vmData) = rrdupdates.GetLatestSnapshot()
+    metrics = []
+    for param, value in hostData.iteritems():
+        metrics.append(("Xenserver_host_%s.%s" % (rrdupdates.GetHostUUID(), param), str(value), timestamp))
+    for uuid, values in vmData.iteritems():
+        for param, value in values.iteritems():
+            metrics.append(("Xenserver_vm_%s.%s" % (uuid, param), str(value), timestamp))
+    result = []
+    copy = 0
+    while len(result) < count:
+        for (name, value, timestamp) in metrics[:count - len(result)]:
+            result.append(("%s_%d" % (name, copy), value, timestamp))
+        copy += 1
+    return result
+
+
+def decode_plaintext(message):
+    for line in message.splitlines():
+        (path, value, timestamp) = line.split()
+        (float(timestamp), float(value))
+
+
+def decode_pickle(message):
+    offset = 0
+    while offset < len(message):
+        (length,) = struct.unpack("!L", message[offset:offset + 4])
+        offset += 4
+        for (path, (timestamp, value)) in pickle.loads(message[offset:offset + length]):
+            (float(timestamp), float(value))
+        offset += length
+
+
+def best_time(func, arg, repeat):
+    best = None
+    for i in range(repeat):
+        t1 = time.clock()
+        func(arg)
+        elapsed = time.clock() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_carbon(options):
+    metrics = example_metrics(options.metrics)
+    for (protocol, decode) in (("plaintext", decode_plaintext), ("pickle", decode_pickle)):
+        client = graphite_common.CarbonClient(None, None, protocol=protocol, batch_size=options.batch_size)
+        message = client.encode(metrics)
+        encode_time = best_time(client.encode, metrics, options.repeat)
+        decode_time = best_time(decode, message, options.repeat)
+        print "%-10s %10d bytes %8.3fs encode %8.3fs decode (carbon side)" % (protocol, len(message), encode_time, decode_time)
+
+
+def generate_uuids(vms, host_index=0):
+    '''
+    Return the (host uuid, vm uuids) of a generated document, distinct for each host_index
+    '''
+    host_uuid = "%08d-0000-0000-0000-000000000000" % host_index
+    return (host_uuid, ["%08d-0000-0000-0000-%012d" % (host_index, vm + 1) for vm in range(vms)])
+
+
+def generate_rrd_updates(vms, vm_metrics, rows, host_metrics=40, step=5, end=1524485260, host_index=0):
+    '''
+    Return a rrd_updates document the way xapi writes it: the host columns, then vm_metrics
+    columns for each of the vms VMs, and rows rows newest first. The uuids are the
+    generate_uuids() of host_index
+    '''
+    legend = []
+    (host_uuid, vm_uuids) = generate_uuids(vms, host_index)
+    for i in range(host_metrics):
+        legend.append("AVERAGE:host:%s:cpu%d" % (host_uuid, i))
+    for vm_uuid in vm_uuids:
+        for i in range(vm_metrics):
+            legend.append("AVERAGE:vm:%s:cpu%d" % (vm_uuid, i))
+    columns = len(legend)
+    parts = ["<xport><meta><start>%d</start><step>%d</step><end>%d</end><rows>%d</rows><columns>%d</columns><legend>"
+             % (end - step * (rows - 1), step, end, rows, columns)]
+    for entry in legend:
+        parts.append("<entry>%s</entry>" % entry)
+    parts.append("</legend></meta><data>")
+    for row in range(rows):
+        parts.append("<row><t>%d</t>" % (end - step * row))
+        parts.append("".join(["<v>%.4f</v>" % ((row * columns + col) % 1000 * 1.5) for col in range(columns)]))
+        parts.append("</row>")
+    parts.append("</data></xport>")
+    return "".join(parts)
+
+
+def snapshot_items(rrdupdates, step=5):
+    '''
+    GraphiteData items of the latest row of rrdupdates, named the way xenserverPlugin does
+    '''
+    (timestamp, hostData, vmData) = rrdupdates.GetLatestSnapshot()
+    items = []
+    host = "Xenserver_host_%s" % rrdupdates.GetHostUUID()
+    for param, value in hostData.iteritems():
+        items.append(graphite_common.GraphiteData(host, host, param, step, str(value), timestamp))
+    for uuid, values in vmData.iteritems():
+        vm = "Xenserver_vm_%s" % uuid
+        for param, value in values.iteritems():
+            items.append(graphite_common.GraphiteData(vm, vm, param, step, str(value), timestamp))
+    return items
+
+
+def render_collectd(rrdupdates):
+    '''
+    The (host, plugin, type_instance, values) fields collectd-xenserver sets on each collectd.Values
+    '''
+    (timestamp, hostData, vmData) = rrdupdates.GetLatestSnapshot()
+    result = []
+    vmid = "host:benchmark:%s" % rrdupdates.GetHostUUID()
+    for param, value in hostData.iteritems():
+        result.append((vmid, vmid, param, [str(value)]))
+    for uuid, values in vmData.iteritems():
+        vmid = "vm:benchmark:%s" % uuid
+        for param, value in values.iteritems():
+            result.append((vmid, vmid, param, [str(value)]))
+    return result
+
+
+def render_putval(rrdupdates):
+    data_format = 'PUTVAL "%s/%s/%s" interval=%s N:%s'
+    lines = []
+    for item in snapshot_items(rrdupdates):
+        data_map = item.format_data()
+        lines.append(data_format % (data_map["endpoint"], data_map["metric"], data_map["type"],
+                                    data_map["step"], data_map["value"]))
+    return lines
+
+
+def render_carbon(rrdupdates, protocol):
+    metrics = []
+    for item in snapshot_items(rrdupdates):
+        data_map = item.format_data()
+        metrics.append(("%s.%s" % (data_map["metric"], data_map["type"]), data_map["value"], data_map["timestamp"]))
+    return graphite_common.CarbonClient(None, None, protocol=protocol).encode(metrics)
+
+
+def parsed(document):
+    rrdupdates = xenserver_common.GetRRDUdpates()
+    rrdupdates.Parse(StringIO(document))
+    return rrdupdates
+
+
+def run_forked(func, *args):
+    '''
+    Return func(*args) run in a child process: it starts from the memory the parent
+    process has now, and what it allocates is gone with it
+    '''
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            try:
+                os.close(read_end)
+                data = pickle.dumps(func(*args), 2)
+                while data:
+                    data = data[os.write(write_end, data):]
+                status = 0
+            except Exception:
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    (pid, status) = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("benchmark child process failed")
+    return pickle.loads("".join(chunks))
+
+
+def max_rss(func, arg):
+    func(arg)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_memory(func, arg):
+    '''
+    Peak resident memory in KB of a child process running func(arg), the parent
+    process is left as it was
+    '''
+    return run_forked(max_rss, func, arg)
+
+
+def load_and_parse(load):
+    return parsed(load())
+
+
+def bench_document(name, load, repeat):
+    '''
+    Times and peak memory of the document returned by load(). The peak memory is
+    measured first, in a child forked before this process loads the document
+    '''
+    peak_rss = peak_memory(load_and_parse, load)
+    document = load()
+    rrdupdates = parsed(document)
+    result = {
+        "document": name,
+        "bytes": len(document),
+        "rows": rrdupdates.GetRows(),
+        "columns": rrdupdates.columns,
+        "vms": len(rrdupdates.GetVMList()),
+        "metrics": len(snapshot_items(rrdupdates)),
+        "parse_s": best_time(parsed, document, repeat),
+        "latest_row_s": best_time(lambda r: r.GetLatestSnapshot(), rrdupdates, repeat),
+        "render_collectd_s": best_time(render_collectd, rrdupdates, repeat),
+        "render_putval_s": best_time(render_putval, rrdupdates, repeat),
+        "render_carbon_plaintext_s": best_time(lambda r: render_carbon(r, "plaintext"), rrdupdates, repeat),
+        "render_carbon_pickle_s": best_time(lambda r: render_carbon(r, "pickle"), rrdupdates, repeat),
+        "peak_rss_kb": peak_rss,
+    }
+    return result
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def read_example():
+    f = open(EXAMPLE_XML)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def bench_parse(options):
+    # the documents are only loaded by the child process measuring them: each one is
+    # measured in a process which never held the others
+    documents = [("example.xml", read_example)]
+    for vms in int_list(options.vms):
+        for vm_metrics in int_list(options.vm_metrics):
+            for rows in int_list(options.rows):
+                documents.append(("generated_%dvms_%dmetrics_%drows" % (vms, vm_metrics, rows),
+                                  lambda vms=vms, vm_metrics=vm_metrics, rows=rows: generate_rrd_updates(vms, vm_metrics, rows)))
+    results = {
+        "python": sys.version.split()[0],
+        "time": int(time.time()),
+        "repeat": options.repeat,
+        "documents": [],
+    }
+    for (name, load) in documents:
+        results["documents"].append(run_forked(bench_document, name, load, options.repeat))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, "w")
+        f.write(output + "\n")
+        f.close()
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog metadata|carbon|parse|generate [options]")
+    parser.add_option("--host", dest="host", help="IP for host server")
+    parser.add_option("-u", "--user", dest="user", default="root", help="User name for host server")
+    parser.add_option("-p", "--passwd", dest="passwd", default="", help="Passward for host server")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3, help="Runs of each case, the best one is reported")
+    parser.add_option("--metrics", dest="metrics", type="int", default=100000, help="Metrics sent by the carbon case")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=500, help="Metrics per pickle batch")
+    parser.add_option("--vms", dest="vms", default="10,100,1000", help="VMs of the generated documents, comma separated")
+    parser.add_option("--vm-metrics", dest="vm_metrics", default="20", help="Metrics per VM of the generated documents, comma separated")
+    parser.add_option("--rows", dest="rows", default="12", help="Rows of the generated documents, comma separated")
+    parser.add_option("--output", dest="output", help="JSON file of the parse results, stdout by default")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ("metadata", "carbon", "parse", "generate"):
+        parser.print_help()
+        sys.exit(1)
+
+    if args[0] == "metadata":
+        if not options.host:
+            print "Please input the host to benchmark with --host"
+            sys.exit(1)
+        bench_metadata(options)
+    elif args[0] == "carbon":
+        bench_carbon(options)
+    elif args[0] == "parse":
+        bench_parse(options)
+    elif args[0] == "generate":
+        print generate_rrd_updates(int_list(options.vms)[0], int_list(options.vm_metrics)[0], int_list(options.rows)[0])
@@ -9,5 +9,5 @@ processNums=$(ps aux| grep graphite_plugin.py |grep -v grep|wc -l)
 
 if [[ $processNums -lt 1 ]];then
     echo "`date`: start /root/graphite_plugin.py"
-    nohup python /root/graphite_plugin.py --server=192.168.1.1 --port=2003 --step=10  &
+    nohup python /root/graphite_plugin.py --server=192.168.1.1 --port=2003 --step=10 --state-file=/root/graphite_plugin.state  &
 fi
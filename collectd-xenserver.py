@@ -15,6 +15,7 @@ http://community.citrix.com/display/xs/Using+XenServer+RRDs
 Dependencies:
   - XenAPI python module: http://pypi.python.org/pypi/XenAPI
   - collectd python module: http://pypi.python.org/pypi/collectd
+  - xenserver_common.py of this repository, in the ModulePath
 
 collectd.conf example:
   <Plugin python>
@@ -27,10 +28,36 @@ collectd.conf example:
                     User "root"
                     Password "mysecretpassword"
               </Host>
-              <Host "10.0.0.101">>
+              <Host "https://10.0.0.101">
                     User "root"
                     Password "mysecretpassword"
               </Host>
+              # optional: read the hosts on 8 threads, wait at most 8s for each of them
+              Workers 8
+              Timeout 8
+              # or: the pool master, its members are looked up and read with its session
+              #<Pool "10.0.0.200">
+              #      User "root"
+              #      Password "mysecretpassword"
+              #</Pool>
+              # optional: fetch all the hosts at once from one thread, 200 at a time
+              #AsyncFetch true
+              #MaxConnections 200
+              # optional: dispatch the timings of each read as the xenserver_collector plugin
+              #SelfMetrics true
+              # optional: only parse and dispatch some of the legend entries (cf:vm|host:uuid:param)
+              #Allow "AVERAGE:host:*" "AVERAGE:vm:*:cpu*" "re::(memory|memory_internal_free)$"
+              #Deny "*:vbd_*"
+              # optional: ask xapi for less: these VMs only, one query each, no host metrics, 60s MAX samples
+              #VM "f2a4e7b2-..." "0c6b2a3e-..."
+              #GraphHost false
+              #RRDInterval 60
+              #RRDConsolidation "MAX"
+              # optional: dispatch every row not dispatched yet, 60 at most per host and read
+              #Backfill true
+              #BackfillMaxRows 60
+              # optional: resume the rrd_updates cursors (and names) after a restart
+              #StateFile "/var/lib/collectd/xenserver.state"
         </Module>
   </Plugin>
 
@@ -44,231 +71,448 @@ __status__ = "Development"
 
 import XenAPI
 import collectd
-import urllib
+import urlparse, socket, select, errno
 import os, sys, time, getopt
-from xml.dom import minidom
-from xml.parsers.expat import ExpatError
+import threading, Queue, traceback
+import xenserver_common
+from xenserver_common import MetadataCache, StateFile, MetricFilter, GetRRDUdpates, RRDSelection
 
 
-# Per VM dictionary (used by GetRRDUdpates to look up column numbers by variable names)
-class VMReport(dict):
-    """Used internally by GetRRDUdpates"""
-    def __init__(self, uuid):
-        self.uuid = uuid
+# Thread pool used to read the hosts concurrently
+class WorkerPool:
+    """ Fixed set of daemon threads running the jobs submitted by XenServerCollectd.Read """
+    def __init__(self, workers):
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target=self.__run, name='xenserver-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
 
-# Per Host dictionary (used by GetRRDUdpates to look up column numbers by variable names)
-class HostReport(dict):
-    """Used internally by GetRRDUdpates"""
-    def __init__(self, uuid):
-        self.uuid = uuid
+    def Submit(self, key, func, *args):
+        ''' Queue func(*args), its outcome will be returned by GetResult() under key '''
+        self.tasks.put((key, func, args))
 
-# Fetch and parse data class
-class GetRRDUdpates:
-    """ Object used to get and parse the output the http://host/rrd_udpates?..."""
-    def __init__(self):
-        # rrdParams are what get passed to the CGI executable in the URL
-        self.rrdParams = dict()
-        self.rrdParams['start'] = int(time.time()) - 10
-        self.rrdParams['host'] = 'true'   # include data for host (as well as for VMs)
-        self.rrdParams['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
-        self.rrdParams['interval'] = '10'
-
-    def GetRows(self):
-        return self.rows
-
-    def GetVMList(self):
-        return self.vm_reports.keys()
-
-    def GetVMParamList(self, uuid):
-        report = self.vm_reports[uuid]
-        if not report:
-            return []
-        return report.keys()
-
-    def GetVMData(self, uuid, param, row):
-        report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
-
-    def GetHostUUID(self):
-        report = self.host_report
-        if not report:
-            return None
-        return report.uuid
-
-    def GetHostParamList(self):
-        report = self.host_report
-        if not report:
-            return []
-        return report.keys()
-
-    def GetHostData(self, param, row):
-        report = self.host_report
-        col = report[param]
-        return self.__lookup_data(col, row)
-
-    def GetRowTime(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col+1]
-        return float(node.firstChild.toxml()) # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml()) # node.firstChild should have nodeType TEXT_NODE
-
-    def Refresh(self, session, override_rrdParams = {}, server = 'http://localhost'):
-        rrdParams = dict(self.rrdParams)
-        rrdParams.update(override_rrdParams)
-        rrdParams['host'] = "true"
-        rrdParams['session_id'] = session
-        rrdParamstr = "&".join(["%s=%s"  % (k,rrdParams[k]) for k in rrdParams])
-        url = "%s/rrd_updates?%s" % (server, rrdParamstr)
-
-        #print "Query: %s" % url
-
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-        collectd.info("Featch url: %s" %url)
-        sock = urllib.URLopener().open(url)
-        xmlsource = sock.read()
-        sock.close()
-
-        #myFile = open('debug.xml','w')
-        #myFile.write(xmlsource)
-        #myFile.close()
-
-        xmldoc = minidom.parseString(xmlsource)
-        self.__parse_xmldoc(xmldoc)
-        # Update the time used on the next run
-        self.rrdParams['start'] = self.end_time + 1 # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def LookupMetadataBytag(name):
-            return int (self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-
-        # rows = number of samples per variable
-        # columns = number of variables
-        self.rows = LookupMetadataBytag('rows')
-        self.columns = LookupMetadataBytag('columns')
-
-        # These indicate the period covered by the data
-        self.start_time = LookupMetadataBytag('start')
-        self.step_time  = LookupMetadataBytag('step')
-        self.end_time   = LookupMetadataBytag('end')
-
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
-
-        # vm_reports matches uuid to per VM report
-        self.vm_reports = {}
-
-        # There is just one host_report and its uuid should not change!
-        self.host_report = None
-
-        # Handle each column.  (I.e. each variable)
-        for col in range(self.columns):
-            self.__handle_col(col)
-
-    def __handle_col(self, col):
-        # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
-
-        # vmOrHost will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
-        (cf, vmOrHost, uuid, param) = col_meta_data.split(':')
-
-        if vmOrHost == 'vm':
-            # Create a report for this VM if it doesn't exist
-            if not self.vm_reports.has_key(uuid):
-                self.vm_reports[uuid] = VMReport(uuid)
-
-            # Update the VMReport with the col data and meta data
-            vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
-
-        elif vmOrHost == 'host':
-            # Create a report for the host if it doesn't exist
-            if not self.host_report:
-                self.host_report = HostReport(uuid)
-            elif self.host_report.uuid != uuid:
-                raise Exception, "Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid)
-
-            # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
+    def GetResult(self, timeout):
+        ''' Return the next (key, result, error) tuple, raise Queue.Empty after timeout seconds '''
+        if timeout <= 0:
+            return self.results.get(False)
+        return self.results.get(True, timeout)
+
+    def __run(self):
+        while True:
+            (key, func, args) = self.tasks.get()
+            try:
+                self.results.put((key, func(*args), None))
+            except Exception:
+                self.results.put((key, None, traceback.format_exc()))
+
+# One non blocking GET request of a FetchLoop
+class HttpFetch:
+    """ rrd_updates request to one server, advanced by Step() each time its socket is ready """
+    def __init__(self, key, server, path, sock, reused, timeout):
+        self.key = key
+        self.server = server
+        self.path = path
+        self.sock = sock
+        self.reused = reused # kept alive by a previous request, it may have been closed since
+        self.started = time.time()
+        self.deadline = self.started + timeout # given up past this time.time() value
+        (scheme, netloc, urlpath, query, fragment) = urlparse.urlsplit(server)
+        self.out = 'GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: gzip\r\n\r\n' % (path, netloc)
+        self.inbuf = ''
+        self.received = 0
+        self.status = None
+        self.headers = {}
+        self.body = []
+        self.framing = None # 'length', 'chunked' or 'close'
+        self.left = 0 # bytes of the body, or of the current chunk, still to receive
+        self.afterChunk = False
+        self.keepAlive = False
+        if reused:
+            self.state = 'send'
+        else:
+            self.state = 'connect'
+
+    def GetEvents(self):
+        ''' poll() events this request waits for '''
+        if self.state in ('connect', 'send'):
+            return select.POLLOUT
+        return select.POLLIN
+
+    def GetBody(self):
+        return ''.join(self.body)
+
+    def Step(self):
+        ''' Make progress, return True once the response is complete. Raise socket.error on failure '''
+        if self.state == 'connect':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.state = 'send'
+        if self.state == 'send':
+            sent = self.sock.send(self.out)
+            self.out = self.out[sent:]
+            if not self.out:
+                self.state = 'head'
+            return False
+
+        try:
+            data = self.sock.recv(64 * 1024)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not data:
+            if self.state == 'body' and self.framing == 'close':
+                return True
+            raise socket.error(errno.ECONNRESET, 'connection closed by %s' % self.server)
+        self.received += len(data)
+        self.inbuf += data
+        if self.state == 'head':
+            end = self.inbuf.find('\r\n\r\n')
+            if end < 0:
+                return False
+            self.__ParseHead(self.inbuf[:end])
+            self.inbuf = self.inbuf[end + 4:]
+            self.state = 'body'
+        return self.__ParseBody()
 
+    def __ParseHead(self, head):
+        lines = head.split('\r\n')
+        (version, status) = lines[0].split(' ', 2)[:2]
+        self.status = int(status)
+        for line in lines[1:]:
+            (name, value) = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            self.framing = 'chunked'
+        elif 'content-length' in self.headers:
+            self.framing = 'length'
+            self.left = int(self.headers['content-length'])
         else:
-            raise Exception, "Invalid string in <legend>: %s" % col_meta_data
+            self.framing = 'close'
+        self.keepAlive = (version == 'HTTP/1.1' and self.framing != 'close'
+                          and self.headers.get('connection', '').lower() != 'close')
+
+    def __ParseBody(self):
+        ''' Move the received data to the body, return True once it is complete '''
+        while True:
+            if self.left > 0:
+                data = self.inbuf[:self.left]
+                self.inbuf = self.inbuf[len(data):]
+                self.body.append(data)
+                self.left -= len(data)
+                if self.left > 0:
+                    return False
+            if self.framing == 'length':
+                return True
+            if self.framing == 'close':
+                self.body.append(self.inbuf)
+                self.inbuf = ''
+                return False
+            # chunked: the CRLF closing the previous chunk, then the size line of the next one
+            if self.afterChunk:
+                if len(self.inbuf) < 2:
+                    return False
+                self.inbuf = self.inbuf[2:]
+                self.afterChunk = False
+            end = self.inbuf.find('\r\n')
+            if end < 0:
+                return False
+            size = int(self.inbuf[:end].split(';')[0], 16)
+            if size == 0:
+                # last chunk, wait for the end of the trailer
+                return self.inbuf.find('\r\n\r\n', end) >= 0
+            self.inbuf = self.inbuf[end + 2:]
+            self.left = size
+            self.afterChunk = True
+
+# Fetch the rrd_updates of many hosts at once from one thread
+class FetchLoop:
+    """ poll() loop running many HttpFetch at once, at most maxConnections overall and perServer per server """
+    def __init__(self, maxConnections=64, perServer=1):
+        self.maxConnections = maxConnections
+        self.perServer = perServer
+        self.idle = {} # server -> sockets kept alive by the previous requests
+        self.requests = 0
+        self.connects = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+
+    def Run(self, requests, timeout, callback):
+        '''
+        GET every (key, server, path) of requests. callback(key, status, headers, body, error, elapsed)
+        is called as each one completes; each one still running timeout seconds after it started
+        (once it got a connection slot, again when it is retried) is given up with error 'timeout'
+        '''
+        queue = list(requests)
+        active = {} # fd -> HttpFetch
+        perServer = {}
+        poller = select.poll()
+        while queue or active:
+            # start what the caps allow, the rest waits for a slot
+            waiting = []
+            for (key, server, path) in queue:
+                if len(active) >= self.maxConnections or perServer.get(server, 0) >= self.perServer:
+                    waiting.append((key, server, path))
+                    continue
+                try:
+                    fetch = self.__Start(key, server, path, timeout)
+                except socket.error, e:
+                    callback(key, None, None, None, str(e), 0.0)
+                    continue
+                active[fetch.sock.fileno()] = fetch
+                perServer[server] = perServer.get(server, 0) + 1
+                poller.register(fetch.sock, fetch.GetEvents())
+            queue = waiting
+
+            now = time.time()
+            for fd, fetch in active.items():
+                if fetch.deadline <= now:
+                    poller.unregister(fd)
+                    del active[fd]
+                    perServer[fetch.server] -= 1
+                    fetch.sock.close()
+                    self.timeouts += 1
+                    callback(fetch.key, None, None, None, 'timeout', now - fetch.started)
+            if not active:
+                continue
+            wait = min([fetch.deadline for fetch in active.values()]) - now
+            for (fd, event) in poller.poll(max(0, wait) * 1000):
+                fetch = active[fd]
+                try:
+                    done = fetch.Step()
+                except (socket.error, ValueError), e:
+                    poller.unregister(fd)
+                    del active[fd]
+                    fetch.sock.close()
+                    if fetch.reused and not fetch.received:
+                        # the server closed the idle connection, retry once on a new one
+                        queue.append((fetch.key, fetch.server, fetch.path))
+                        perServer[fetch.server] -= 1
+                        self.__DropIdle(fetch.server)
+                        continue
+                    perServer[fetch.server] -= 1
+                    callback(fetch.key, None, None, None, str(e), time.time() - fetch.started)
+                    continue
+                self.bytes_received += fetch.received
+                fetch.received = 0
+                if not done:
+                    poller.modify(fd, fetch.GetEvents())
+                    continue
+                poller.unregister(fd)
+                del active[fd]
+                perServer[fetch.server] -= 1
+                self.requests += 1
+                if fetch.keepAlive:
+                    self.idle.setdefault(fetch.server, []).append(fetch.sock)
+                else:
+                    fetch.sock.close()
+                callback(fetch.key, fetch.status, fetch.headers, fetch.GetBody(), None, time.time() - fetch.started)
+
+    def GetStats(self):
+        ''' Requests, connections opened, bytes received, connection reuse ratio and timeouts '''
+        reuse = 0.0
+        if self.requests:
+            reuse = max(0.0, 1 - float(self.connects) / self.requests)
+        return {'requests': self.requests, 'connects': self.connects, 'bytes_received': self.bytes_received,
+                'reuse_ratio': reuse, 'timeouts': self.timeouts}
+
+    def __Start(self, key, server, path, timeout):
+        idle = self.idle.get(server)
+        if idle:
+            return HttpFetch(key, server, path, idle.pop(), True, timeout)
+        (scheme, netloc, urlpath, query, fragment) = urlparse.urlsplit(server)
+        if netloc.startswith('_'):
+            # unix socket path with '/' written '_', as XenAPI.xapi_local() names /var/xapi/xapi
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = netloc.replace('_', '/')
+        else:
+            (host, port) = (netloc, 80)
+            if ':' in netloc:
+                (host, port) = netloc.rsplit(':', 1)
+            (family, socktype, proto, canonname, address) = socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        self.connects += 1
+        return HttpFetch(key, server, path, sock, False, timeout)
+
+    def __DropIdle(self, server):
+        ''' The other idle connections to server are likely closed as well '''
+        for sock in self.idle.pop(server, []):
+            sock.close()
 
+# Keep a MetadataCache up to date between two logins
+class MetadataWatcher:
+    """ Background thread applying the XAPI event.from deltas of the VM and host classes to a MetadataCache """
+    def __init__(self, url, user, passwd, cache, timeout=30.0, call_timeout=10.0):
+        self.url = url
+        self.user = user
+        self.passwd = passwd
+        self.cache = cache
+        self.timeout = timeout # seconds a event.from call waits for new events
+        self.callTimeout = call_timeout # seconds an XML-RPC call may take beyond that
+        self.stopped = False
+        self.thread = None
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.__run, name='xenserver-events-%s' % self.url)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def Stop(self):
+        ''' The thread ends once its pending event.from call returns '''
+        self.stopped = True
+
+    def __run(self):
+        # event.from blocks, it gets its own session rather than sharing the one of the reads
+        session = None
+        token = ''
+        failures = 0
+        while not self.stopped:
+            try:
+                if session is None:
+                    # the socket must outlast the event.from wait, a hung xapi still ends the call
+                    session = XenAPI.Session(self.url, timeout=self.timeout + self.callTimeout)
+                    session.xenapi.login_with_password(self.user, self.passwd)
+                    token = '' # the first call returns every object as an 'add' event
+                result = getattr(session.xenapi.event, 'from')(['vm', 'host'], token, float(self.timeout))
+                token = result['token']
+                for event in result['events']:
+                    self.__apply(event)
+                failures = 0
+            except Exception, e:
+                failures += 1
+                collectd.warning('xenserver-collectd: event.from on %s failed: %s' % (self.url, e))
+                session = self.__logout(session)
+                time.sleep(min(60, 2 ** failures))
+        self.__logout(session)
+
+    def __apply(self, event):
+        if event['operation'] == 'del':
+            self.cache.Remove(event['ref'])
+        elif event['class'] == 'vm':
+            self.cache.UpdateVM(event['ref'], event['snapshot'])
+        elif event['class'] == 'host':
+            self.cache.UpdateHost(event['ref'], event['snapshot'])
+
+    def __logout(self, session):
+        if session is not None:
+            try:
+                session.logout()
+            except Exception:
+                pass
+        return None
 
 class XenServerCollectd:
     def __init__(self):
         self.hosts = {}
         self.verbose = False # Set to true to make your logs really fat
         self.graphHost = True
-        self.xApiIterCpt = 0
-        self.xApiDefaultIterCpt = 60 # Reconnect the API every X polls
+        self.sessionMaxAge = 3600 # Login again on a host once its session is older than this, 0 to disable
+        self.watchEvents = False # Follow the VM and host changes with a event.from watcher per host
         self.rrdParams = {}
         self.rrdParams['cf'] = "AVERAGE"
-        self.rrdParams['start'] = int(time.time()) - 10
+        # 'start' is left to the GetRRDUdpates of each host, which moves it after each refresh
         self.rrdParams['interval'] = 5
-        self.uuid_name_map={} # translate uuid to vm name
+        self.uuid_name_map = MetadataCache() # translate uuid to vm name
+        self.workers = 1 # Number of hosts read at the same time
+        self.timeout = 10 # Seconds Read() waits for each host when workers > 1, and the XAPI calls time out after
+        self.pool = None
+        self.asyncFetch = False # Fetch every host from one FetchLoop, parse on the workers
+        self.maxConnections = 64 # rrd_updates fetches running at the same time with asyncFetch
+        self.fetchLoop = None
+        self.poolRefresh = 300 # Seconds between two lookups of the members of each <Pool>
+        self.selfMetrics = False # Dispatch the timings of each read as the xenserver_collector plugin
+        self.allow = [] # Allow and Deny patterns of the legend entries, see MetricFilter
+        self.deny = []
+        self.metricFilter = None
+        self.vmUUIDs = [] # Only fetch these VMs, with one vm_uuid= query each (see RRDSelection)
+        self.vmParallel = 8 # vm_uuid= queries of one host fetched at the same time, by the workers or the FetchLoop
+        self.backfill = False # Dispatch every row fetched, not only the newest one
+        self.backfillMaxRows = 60 # Rows fetched and dispatched at most per host and read with backfill
+        self.stateFile = None # StateFile the cursors (and names) are saved to after each read
+        self.stateNames = True # Save the uuid to name cache in the stateFile too
+        self.stateNamesMaxAge = 3600 # Seconds the saved names spare the enumeration at the first login
+        self.savedState = {} # state loaded from the stateFile at startup
 
     def Connect(self, hostname=''):
         ''' This is called at the startup of Collectd '''
         # Called at startup
         if hostname == '':
+            if self.asyncFetch and self.fetchLoop is None:
+                # the vm_uuid= queries of a host run concurrently, as RRDSelection does on the workers
+                self.fetchLoop = FetchLoop(self.maxConnections, self.vmParallel)
+            if (self.workers > 1 or self.asyncFetch) and self.pool is None:
+                self.pool = WorkerPool(self.workers)
             for hostname in self.hosts.keys():
-                url    = self.hosts[hostname]['url']
-                user   = self.hosts[hostname]['user']
-                passwd = self.hosts[hostname]['passwd']
-                self.hosts[hostname]['rrdupdates'] = GetRRDUdpates()
-                self.hosts[hostname]['session'] = XenAPI.Session(url)
-                self.hosts[hostname]['session'].xenapi.login_with_password(user, passwd)
-                self._LogVerbose('Connecting: %s on %s' % (user, url))
-                # host name, uuid translation
-                host_ref = self.hosts[hostname]['session'].xenapi.host.get_all()[0]
-                uuid = self.hosts[hostname]['session'].xenapi.host.get_uuid(host_ref)
-                server_name = self.hosts[hostname]['session'].xenapi.host.get_name_label(host_ref)
-                self.uuid_name_map[uuid] = server_name
-                # VM name, uuid translation
-                vm_refs_list = self.hosts[hostname]['session'].xenapi.VM.get_all()
-                for vm_ref in vm_refs_list:
-                    vm_uuid = self.hosts[hostname]['session'].xenapi.VM.get_uuid(vm_ref)
-                    vm_name = self.hosts[hostname]['session'].xenapi.VM.get_name_label(vm_ref)
-                    self.uuid_name_map[vm_uuid] = vm_name
+                # with asyncFetch, the first read logs in on the workers
+                if self.fetchLoop is None:
+                    self._LogVerbose('Connecting: %s on %s' % (self.hosts[hostname]['user'], self.hosts[hostname]['url']))
+                    self._Login(hostname)
+                if self.watchEvents:
+                    self.hosts[hostname]['watcher'] = MetadataWatcher(self.hosts[hostname]['url'], self.hosts[hostname]['user'],
+                                                                      self.hosts[hostname]['passwd'], self.uuid_name_map,
+                                                                      call_timeout=self.timeout)
+                    self.hosts[hostname]['watcher'].Start()
         # If hostname is set, then we just need to reconnect a specific host
         else:
-            url    = self.hosts[hostname]['url']
-            user   = self.hosts[hostname]['user']
-            passwd = self.hosts[hostname]['passwd']
-            self.hosts[hostname]['rrdupdates'] = GetRRDUdpates()
-            self.hosts[hostname]['session'] = XenAPI.Session(url)
-            self.hosts[hostname]['session'].xenapi.login_with_password(user, passwd)
-            self._LogVerbose('Reconnecting: %s on %s' % (user, url))
-            # host name, uuid translation
-            host_ref = self.hosts[hostname]['session'].xenapi.host.get_all()[0]
-            uuid = self.hosts[hostname]['session'].xenapi.host.get_uuid(host_ref)
-            server_name = self.hosts[hostname]['session'].xenapi.host.get_name_label(host_ref)
-            self.uuid_name_map[uuid] = server_name
-            # VM name, uuid translation
-            vm_refs_list = self.hosts[hostname]['session'].xenapi.VM.get_all()
-            for vm_ref in vm_refs_list:
-                vm_uuid = self.hosts[hostname]['session'].xenapi.VM.get_uuid(vm_ref)
-                vm_name = self.hosts[hostname]['session'].xenapi.VM.get_name_label(vm_ref)
-                self.uuid_name_map[vm_uuid] = vm_name
+            self._LogVerbose('Reconnecting: %s on %s' % (self.hosts[hostname]['user'], self.hosts[hostname]['url']))
+            self._Logout(hostname)
+            self._Login(hostname)
+
+    def _Login(self, hostname):
+        ''' Open a new session on hostname and load its uuid to name translations '''
+        url    = self.hosts[hostname]['url']
+        user   = self.hosts[hostname]['user']
+        passwd = self.hosts[hostname]['passwd']
+        # keep the rrd_updates cursor of the host across sessions
+        if 'rrdupdates' not in self.hosts[hostname]:
+            self.hosts[hostname]['rrdupdates'] = self._NewRRDUpdates()
+            self._RestoreHost(hostname)
+        self.hosts[hostname]['session'] = None
+        # a hung xapi must not hold a worker past the Timeout of the read
+        session = XenAPI.Session(url, timeout=self.timeout)
+        session.xenapi.login_with_password(user, passwd)
+        self.hosts[hostname]['session'] = session
+        self.hosts[hostname]['session_time'] = time.time()
+        self.hosts[hostname]['session_failed'] = False
+        # host and VM name, uuid translation, unless the names saved in the StateFile are fresh enough
+        restored = self.hosts[hostname].pop('names_restored', 0)
+        if time.time() - restored > self.stateNamesMaxAge:
+            self.uuid_name_map.Load(session)
+            self.hosts[hostname]['names_time'] = time.time()
+        else:
+            self._LogVerbose('Names of %s restored from the state file, not loaded' % hostname)
+            self.hosts[hostname]['names_time'] = restored
+
+    def _Logout(self, hostname):
+        ''' Close the session of hostname, if any. A failure only means it is already gone '''
+        session = self.hosts[hostname].get('session')
+        self.hosts[hostname]['session'] = None
+        if session is None or self.hosts[hostname].get('master', hostname) != hostname:
+            # a pool member only borrows the session of its master
+            return
+        try:
+            session.logout()
+        except Exception, e:
+            self._LogVerbose('Logout of %s failed: %s' % (hostname, e))
+
+    def _SessionStale(self, hostname):
+        ''' True when hostname has no session, when it was refused or is older than sessionMaxAge '''
+        host = self.hosts[hostname]
+        if host.get('session') is None or host.get('session_failed'):
+            return True
+        if self.sessionMaxAge and time.time() - host.get('session_time', 0) > self.sessionMaxAge:
+            self._LogVerbose('Session of %s expired, last successful read %ss ago'
+                             % (hostname, int(time.time() - host.get('last_success', 0))))
+            return True
+        return False
 
     def Config(self, conf):
         ''' Set the config dictionary hosts[hostname] = {'url': ..,'user': .., 'passwd': ..}  from collectd.conf'''
@@ -276,60 +520,462 @@ class XenServerCollectd:
             collectd.error('Module configuration missing')
         #
         for node in conf.children:
+            if node.key == 'Workers':
+                self.workers = int(node.values[0])
+                continue
+            elif node.key == 'Timeout':
+                self.timeout = float(node.values[0])
+                continue
+            elif node.key == 'SessionMaxAge':
+                self.sessionMaxAge = int(node.values[0])
+                continue
+            elif node.key == 'WatchEvents':
+                self.watchEvents = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'AsyncFetch':
+                self.asyncFetch = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'MaxConnections':
+                self.maxConnections = int(node.values[0])
+                continue
+            elif node.key == 'PoolRefresh':
+                self.poolRefresh = int(node.values[0])
+                continue
+            elif node.key == 'SelfMetrics':
+                self.selfMetrics = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'Allow':
+                self.allow.extend([str(value) for value in node.values])
+                continue
+            elif node.key == 'Deny':
+                self.deny.extend([str(value) for value in node.values])
+                continue
+            elif node.key == 'VM':
+                self.vmUUIDs.extend([str(value) for value in node.values])
+                continue
+            elif node.key == 'Backfill':
+                self.backfill = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'BackfillMaxRows':
+                self.backfillMaxRows = int(node.values[0])
+                continue
+            elif node.key == 'StateFile':
+                self.stateFile = StateFile(str(node.values[0]))
+                continue
+            elif node.key == 'StateNames':
+                self.stateNames = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'StateNamesMaxAge':
+                self.stateNamesMaxAge = int(node.values[0])
+                continue
+            elif node.key == 'GraphHost':
+                self.graphHost = self._ConfigBool(node.values[0])
+                continue
+            elif node.key == 'RRDInterval':
+                self.rrdParams['interval'] = int(node.values[0])
+                continue
+            elif node.key == 'RRDConsolidation':
+                if str(node.values[0]).upper() not in ('AVERAGE', 'MIN', 'MAX'):
+                    collectd.error('xenserver-collectd: RRDConsolidation is one of AVERAGE, MIN or MAX, not %s' % node.values[0])
+                    continue
+                self.rrdParams['cf'] = str(node.values[0]).upper()
+                continue
             hostname = ''
             user = ''
             passwd = ''
-            if node.key == 'Host':
+            if node.key == 'Host' or node.key == 'Pool':
                 hostname = node.values[0]
+            url = "http://%s" % hostname
+            if '://' in hostname:
+                # a URL, https://.. for TLS: the host is named after its address
+                url = hostname
+                hostname = urlparse.urlsplit(url)[1]
             for hostchild in node.children:
                 if hostchild.key == "User":
                     user = hostchild.values[0]
                 elif hostchild.key == 'Password':
                     passwd = hostchild.values[0]
-            self.hosts[hostname] = {'url': "http://%s" % hostname,'user': user, 'passwd': passwd}
+            self.hosts[hostname] = {'url': url,'user': user, 'passwd': passwd}
+            if node.key == 'Pool':
+                # pool master: its session is shared with the members, found by _DiscoverMembers()
+                self.hosts[hostname]['master'] = hostname
+                self.hosts[hostname]['lock'] = threading.Lock()
+                self.hosts[hostname]['members'] = []
             self._LogVerbose('Reading new host from config: %s => %s' % (hostname, self.hosts[hostname]))
+        if self.allow or self.deny:
+            # compiled once, the columns left out are never stored nor dispatched
+            self.metricFilter = MetricFilter(self.allow, self.deny)
+            self._LogVerbose('Metric filter: allow %s, deny %s' % (self.allow, self.deny))
+        if not self.graphHost:
+            # xapi leaves the host columns out of the xml
+            self.rrdParams['host'] = 'false'
+        if self.stateFile is not None:
+            # resume where the previous run stopped
+            self.savedState = self.stateFile.Load()
+            if self.stateNames and 'names' in self.savedState:
+                self.uuid_name_map.Restore(self.savedState['names'])
+            self._LogVerbose('State loaded from %s: %s hosts' % (self.stateFile.path, len(self.savedState.get('hosts', {}))))
+
+    def _NewRRDUpdates(self):
+        ''' Return the rrd_updates reader of a new host: every VM, or the VM selection only '''
+        if self.vmUUIDs:
+            return RRDSelection(self.vmUUIDs, self.metricFilter, self.vmParallel)
+        return GetRRDUdpates(self.metricFilter)
+
+    def _RestoreHost(self, hostname):
+        ''' Resume the rrd_updates cursor of hostname from the state loaded at startup '''
+        saved = self.savedState.get('hosts', {}).get(hostname)
+        if not saved:
+            return
+        self.hosts[hostname]['rrdupdates'].SetCursor(saved['cursor'])
+        self.hosts[hostname]['rrdupdates'].SetHighWater(saved.get('high_water', 0))
+        if self.stateNames and 'names' in self.savedState:
+            self.hosts[hostname]['names_restored'] = saved.get('names_time', 0)
+
+    def _SaveState(self):
+        ''' Write the rrd_updates cursor of every host, and the names, to the StateFile '''
+        if self.stateFile is None:
+            return
+
+        def update(state):
+            # keep the hosts of the other collectors sharing the file, and their names
+            hosts = state.get('hosts', {})
+            for hostname, host in self.hosts.items():
+                if 'rrdupdates' not in host:
+                    continue
+                hosts[hostname] = {'cursor': host['rrdupdates'].GetCursor(), 'high_water': host['rrdupdates'].GetHighWater(),
+                                   'names_time': host.get('names_time', 0)}
+            saved = {'hosts': hosts}
+            if self.stateNames:
+                names = MetadataCache()
+                names.Restore(state.get('names', {}))
+                names.Restore(self.uuid_name_map.Dump())
+                saved['names'] = names.Dump()
+            return saved
+        try:
+            self.stateFile.Update(update)
+        except (IOError, OSError), e:
+            collectd.error('xenserver-collectd: saving the state to %s failed: %s' % (self.stateFile.path, e))
 
     def Read(self):
         ''' This is called by Collectd every $Interval seconds '''
+        self._RefreshPools()
+        if self.pool is None:
+            for hostname in self.hosts.keys():
+                # one host failing does not skip the next ones
+                try:
+                    self._Dispatch(hostname, self._ReadHost(hostname))
+                except Exception:
+                    self._ReadFailed(hostname, traceback.format_exc())
+        elif self.fetchLoop is not None:
+            self._ReadAsync()
+        else:
+            # Every host gets its own deadline: one which does not answer in time only
+            # delays its own metrics, they are dispatched by a later Read()
+            pending = {}
+            for hostname in self.hosts.keys():
+                if self.hosts[hostname].get('busy'):
+                    self._LogVerbose('Read(): %s is still running since a previous read' % hostname)
+                    continue
+                self.hosts[hostname]['busy'] = True
+                pending[hostname] = time.time() + self.timeout
+                self.pool.Submit(hostname, self._ReadHost, hostname)
+            self._CollectResults(pending)
+        # the cursors of the hosts read, for a restart to resume from
+        self._SaveState()
+
+    def _ReadAsync(self):
+        '''
+        Fetch the rrd_updates of every host at once from the FetchLoop, the responses
+        are parsed on the workers. Logins, being blocking XAPI calls, run on the workers
+        as well and the host is fetched from the next read on. Each fetch gets Timeout
+        seconds from the time it starts, and each parse Timeout seconds from its fetch
+        '''
+        deadline = time.time() + self.timeout
+        pending = {}
+        requests = []
+        # a host may need several queries (RRDSelection): the fetches are keyed by (hostname, index)
+        # and the host is parsed once all of its responses are in
+        responses = {}
+        errors = {}
+        fetchTime = {}
         for hostname in self.hosts.keys():
-            # If the connection is gone, reconnect
-            if self.hosts[hostname]['session'] is None:
+            if self.hosts[hostname].get('busy'):
+                self._LogVerbose('Read(): %s is still running since a previous read' % hostname)
+                continue
+            self.hosts[hostname]['busy'] = True
+            if urlparse.urlsplit(self.hosts[hostname]['url'])[0] == 'https':
+                # the FetchLoop speaks plain http only: TLS hosts are fetched on the workers
+                pending[hostname] = deadline
+                self.pool.Submit(hostname, self._ReadHost, hostname)
+                continue
+            master = self.hosts[hostname].get('master', hostname)
+            if self._SessionStale(master):
+                pending[hostname] = deadline
+                self.pool.Submit(hostname, self._CheckSession, hostname)
+                continue
+            self.hosts[hostname]['session'] = self.hosts[master]['session']
+            self._LimitBackfill(hostname)
+            paths = self.hosts[hostname]['rrdupdates'].GetQueries(self.hosts[hostname]['session'].handle, self.rrdParams)
+            responses[hostname] = [None] * len(paths)
+            errors[hostname] = []
+            fetchTime[hostname] = 0.0
+            for index, path in enumerate(paths):
+                requests.append(((hostname, index), self.hosts[hostname]['url'], path))
+
+        def fetched(key, status, headers, body, error, elapsed):
+            (hostname, index) = key
+            if status == 401:
+                # xapi does not know the session anymore (SESSION_INVALID), the next read logs in again
+                self.hosts[self.hosts[hostname].get('master', hostname)]['session_failed'] = True
+                error = 'session refused'
+            elif error is None and status != 200:
+                error = 'http error %s' % status
+            if error is None:
+                responses[hostname][index] = (body, headers.get('content-encoding'))
+            else:
+                responses[hostname][index] = IOError(error)
+                errors[hostname].append(error)
+            fetchTime[hostname] = max(fetchTime[hostname], elapsed)
+            if None in responses[hostname]:
+                return
+            # all the responses of hostname are in
+            if len(errors[hostname]) == len(responses[hostname]) or 'session refused' in errors[hostname]:
+                self.hosts[hostname]['busy'] = False
+                if errors[hostname][0] == 'timeout':
+                    collectd.warning('xenserver-collectd: %s did not answer within %ss, its metrics are delayed' % (hostname, self.timeout))
+                else:
+                    collectd.error('xenserver-collectd: Read() of %s failed: %s' % (hostname, errors[hostname][0]))
+                return
+            pending[hostname] = time.time() + self.timeout
+            self.pool.Submit(hostname, self._ParseHost, hostname, responses[hostname], fetchTime[hostname])
+
+        self.fetchLoop.Run(requests, self.timeout, fetched)
+        self._LogVerbose('rrd_updates: %s' % self.fetchLoop.GetStats())
+        self._CollectResults(pending)
+
+    def _CollectResults(self, pending):
+        ''' Dispatch the worker results until every pending host is done or past its deadline '''
+        while True:
+            if pending:
+                wait = max(pending.values()) - time.time()
+            else:
+                wait = 0
+            try:
+                (hostname, snapshot, error) = self.pool.GetResult(wait)
+            except Queue.Empty:
+                break
+            pending.pop(hostname, None)
+            self.hosts[hostname]['busy'] = False
+            if error:
+                self._ReadFailed(hostname, error)
+            elif snapshot is not None:
+                self._Dispatch(hostname, snapshot)
+
+        for hostname in pending.keys():
+            collectd.warning('xenserver-collectd: %s did not answer within %ss, its metrics are delayed' % (hostname, self.timeout))
+
+    def _ReadFailed(self, hostname, error):
+        ''' Log the failed read of hostname, its session (the one of its pool master) is renewed on the next read '''
+        collectd.error('xenserver-collectd: Read() of %s failed: %s' % (hostname, error))
+        self.hosts[self.hosts[hostname].get('master', hostname)]['session_failed'] = True
+
+    def _CheckSession(self, hostname):
+        '''
+        Log in again if the session of hostname is gone, refused or too old. The members
+        of a pool use the session of the pool master, which logs in once for all of them
+        '''
+        master = self.hosts[hostname].get('master')
+        if master is None:
+            if self._SessionStale(hostname):
                 self.Connect(hostname)
+            return
+        self.hosts[master]['lock'].acquire()
+        try:
+            if self._SessionStale(master):
+                self.Connect(master)
+        finally:
+            self.hosts[master]['lock'].release()
+        self.hosts[hostname]['session'] = self.hosts[master]['session']
+
+    def _RefreshPools(self):
+        ''' Look up the members of each pool after each login of its master, and every poolRefresh seconds '''
+        masters = [hostname for hostname in self.hosts.keys() if self.hosts[hostname].get('master') == hostname]
+        for master in masters:
+            host = self.hosts[master]
+            if host.get('session') is None or host.get('session_failed'):
+                continue
+            if host['session'] is host.get('discovered_session') and time.time() - host.get('discovered_time', 0) < self.poolRefresh:
+                continue
+            try:
+                self._DiscoverMembers(master)
+            except Exception, e:
+                collectd.error('xenserver-collectd: pool members lookup on %s failed: %s' % (master, e))
+
+    def _DiscoverMembers(self, master):
+        ''' Add the hosts which joined the pool of master to self.hosts, remove the ones which left it '''
+        session = self.hosts[master]['session']
+        this_host = session.xenapi.session.get_this_host(session.handle)
+        members = []
+        for ref, record in session.xenapi.host.get_all_records().iteritems():
+            address = record['address']
+            if ref == this_host or (address in self.hosts and self.hosts[address].get('master') != master):
+                # the master itself, or a host also configured on its own
+                continue
+            members.append(address)
+            if address not in self.hosts:
+                self._LogVerbose('Pool %s: new member %s' % (master, address))
+                # the members are reached the way the master is, http or https
+                url = "%s://%s" % (urlparse.urlsplit(self.hosts[master]['url'])[0], address)
+                self.hosts[address] = {'url': url, 'master': master, 'session': session,
+                                       'rrdupdates': self._NewRRDUpdates()}
+                self._RestoreHost(address)
+        for address in self.hosts[master]['members']:
+            if address in members:
+                continue
+            if self.hosts[address].get('busy'):
+                # still being read, removed by the next lookup
+                members.append(address)
+                continue
+            self._LogVerbose('Pool %s: %s left the pool' % (master, address))
+            del self.hosts[address]
+        self.hosts[master]['members'] = members
+        self.hosts[master]['discovered_session'] = session
+        self.hosts[master]['discovered_time'] = time.time()
+
+    def _LimitBackfill(self, hostname):
+        ''' With Backfill, do not fetch more rows of hostname than BackfillMaxRows '''
+        if self.backfill:
+            self.hosts[hostname]['rrdupdates'].LimitStart(time.time() - self.backfillMaxRows * int(self.rrdParams['interval']))
 
-            # Dirt fix: Reconnect every x reads to prevent unhandled api session timeout.
-            self.xApiIterCpt += 1
-            if self.xApiIterCpt > self.xApiDefaultIterCpt:
-                self.Shutdown()
-                self.Connect()
-                self.xApiIterCpt = 0
+    def _ReadHost(self, hostname):
+        ''' Fetch and parse the new rrd_updates of hostname, return its latest snapshot '''
+        # If the connection is gone, refused or too old, reconnect this host only
+        t1 = time.time()
+        self._CheckSession(hostname)
+        login_time = time.time() - t1
 
-            self._LogVerbose('Read(): %s' % self.hosts[hostname]['url'] )
-            self._LogVerbose("session and handle: %s, %s" % (self.hosts[hostname]['session'], self.hosts[hostname]['session'].handle))
-            # Fetch the new http://hostname/rrd_update?.. and parse the new data
+        self._LogVerbose('Read(): %s' % self.hosts[hostname]['url'] )
+        self._LogVerbose("session and handle: %s, %s" % (self.hosts[hostname]['session'], self.hosts[hostname]['session'].handle))
+        # Fetch the new http://hostname/rrd_update?.. and parse the new data
+        self._LimitBackfill(hostname)
+        try:
             self.hosts[hostname]['rrdupdates'].Refresh(self.hosts[hostname]['session'].handle, self.rrdParams, self.hosts[hostname]['url'])
+        except IOError, e:
+            # http 401: xapi does not know the session anymore (SESSION_INVALID), login again and retry once
+            if len(e.args) < 2 or e.args[1] != 401:
+                raise
+            master = self.hosts[hostname].get('master', hostname)
+            # another member of the pool may have logged in again meanwhile
+            if self.hosts[master]['session'] is self.hosts[hostname]['session']:
+                self.hosts[master]['session_failed'] = True
+            t1 = time.time()
+            self._CheckSession(hostname)
+            login_time += time.time() - t1
+            self.hosts[hostname]['rrdupdates'].Refresh(self.hosts[hostname]['session'].handle, self.rrdParams, self.hosts[hostname]['url'])
+        self.hosts[hostname]['last_success'] = time.time()
+        self._LogVerbose('rrd_updates of %s: %s' % (hostname, self.hosts[hostname]['rrdupdates'].GetHttpStats()))
+        return self._Snapshot(hostname, login_time)
+
+    def _ParseHost(self, hostname, responses, fetch_time):
+        ''' Parse the rrd_updates responses of hostname fetched by the FetchLoop, return its latest snapshot '''
+        self.hosts[hostname]['rrdupdates'].ParseBodies(responses, fetch_time)
+        self.hosts[hostname]['last_success'] = time.time()
+        return self._Snapshot(hostname, 0.0)
+
+    def _Snapshot(self, hostname, login_time):
+        '''
+        Return the (hostUUID, windows) snapshot parsed for hostname: windows lists the
+        (timestamps, hostData, vmData) to dispatch, [(None, ..)] with the newest row only
+        or the GetRowsSince() windows of the rows not dispatched yet with backfill. The
+        timings of the read so far are kept in self.hosts[hostname]['cycle'] for _Dispatch()
+        '''
+        cycle = dict(self.hosts[hostname]['rrdupdates'].GetRefreshStats())
+        cycle['login_time'] = login_time
+        if self.metricFilter is not None:
+            self._LogVerbose('%s: %s columns kept, %s dropped by the metric filter' % (hostname, cycle['columns'], cycle['dropped']))
+        if self.vmUUIDs:
+            for (uuid, error) in self.hosts[hostname]['rrdupdates'].GetFailed():
+                self._LogVerbose('%s: rrd_updates of VM %s failed, left out: %s' % (hostname, uuid, error))
+        t1 = time.time()
+        if self.backfill:
+            # every row newer than the last one dispatched (the high water mark of each query)
+            windows = self.hosts[hostname]['rrdupdates'].GetNewRows(self.backfillMaxRows)
+        else:
+            # values of the newest row, for the host and every vm
+            (rowTime, hostData, vmData) = self.hosts[hostname]['rrdupdates'].GetLatestSnapshot()
+            windows = [(None, hostData, vmData)]
+        hostUUID = self.hosts[hostname]['rrdupdates'].GetHostUUID()
+        t2 = time.time()
+        # name the objects created since the login, without enumerating all of them again
+        uuids = [hostUUID]
+        for (timestamps, hostData, vmData) in windows:
+            uuids.extend(vmData.keys())
+        self.uuid_name_map.Resolve(self.hosts[hostname]['session'], uuids)
+        cycle['select_time'] = t2 - t1
+        cycle['resolve_time'] = time.time() - t2
+        self.hosts[hostname]['cycle'] = cycle
+        return (hostUUID, windows)
+
+    def _Dispatch(self, hostname, snapshot):
+        ''' Send a snapshot returned by _ReadHost() to Collectd '''
+        (hostUUID, windows) = snapshot
+        t1 = time.time()
+        rows_time = 0.0
+        metrics = 0
+
+        for (timestamps, hostData, vmData) in windows:
+            rows = 1
+            if timestamps is not None:
+                rows = len(timestamps)
 
             # If the option is set, process the host mectrics data
             if self.graphHost:
                 isHost = True
-                uuid = self.hosts[hostname]['rrdupdates'].GetHostUUID()
-                mectricsData = self._GetRows(hostname, uuid, isHost)
-                self._ToCollectd(hostname, uuid, mectricsData, isHost)
+                mectricsData = self._GetRows(hostData, timestamps)
+                self._ToCollectd(hostname, hostUUID, mectricsData, isHost, timestamps)
+                metrics += len(mectricsData) * rows
 
-            # Process all row w've found so far for each vm
-            for uuid in self.hosts[hostname]['rrdupdates'].GetVMList():
+            # Process the rows w've found for each vm
+            for uuid, values in vmData.iteritems():
                 isHost = False
-                mectricsData = self._GetRows(hostname, uuid, isHost)
-                self._ToCollectd(hostname, uuid, mectricsData, isHost)
+                t2 = time.time()
+                mectricsData = self._GetRows(values, timestamps)
+                rows_time += time.time() - t2
+                self._ToCollectd(hostname, uuid, mectricsData, isHost, timestamps)
+                metrics += len(mectricsData) * rows
+
+        if self.selfMetrics:
+            cycle = self.hosts[hostname].get('cycle', {})
+            cycle['rows_time'] = rows_time
+            cycle['dispatch_time'] = time.time() - t1 - rows_time
+            cycle['metrics'] = metrics
+            self._DispatchSelf(hostname, cycle)
+
+    def _DispatchSelf(self, hostname, cycle):
+        ''' Send the timings and sizes of the last read of hostname as the xenserver_collector plugin '''
+        for key, value in cycle.iteritems():
+            cltd = collectd.Values(type = 'gauge')
+            cltd.plugin = 'xenserver_collector'
+            cltd.plugin_instance = hostname
+            cltd.type_instance = key
+            cltd.values = [ value ]
+            cltd.dispatch()
 
     def Shutdown(self):
         ''' Disconnect all the active sessions - This is called by Collectd on SIGTERM '''
         for hostname in self.hosts.keys():
             self._LogVerbose('Disconnecting %s ' % hostname)
-            self.hosts[hostname]['session'].logout()
+            if self.hosts[hostname].get('watcher'):
+                self.hosts[hostname]['watcher'].Stop()
+            self._Logout(hostname)
 
 
-    def _ToCollectd(self, hostname, uuid, metricsData, isHost):
-        ''' This is where the metrics are sent to Collectd '''
+    def _ToCollectd(self, hostname, uuid, metricsData, isHost, timestamps=None):
+        '''
+        This is where the metrics are sent to Collectd: one value per metric, or one per
+        timestamp from the columns of a backfill window
+        '''
         if isHost:
             if uuid in self.uuid_name_map:
                 vmid = 'host:%s:%s' % (hostname,self.uuid_name_map[uuid])
@@ -341,38 +987,41 @@ class XenServerCollectd:
             else:
                 vmid = 'vm:%s:%s' % (hostname, uuid)
 
-        for key, value in metricsData.iteritems():
-            cltd = collectd.Values(type = 'gauge');
-            # naming: host "/" plugin ["-" plugin instance] "/" type ["-" type instance]
-            cltd.host =  vmid #'xenservers' # xenservers/
-            cltd.plugin = vmid # vm-29887edd-6f21-d936-53e5-b4cb2bac3ba0/
-            cltd.type_instance = key # cpu0
-            cltd.values = [ value ]
-            cltd.dispatch()
-            self._LogVerbose('Dispatch() data from %s: %s/%s/%s/%s' % (hostname, cltd.host, cltd.plugin, cltd.type_instance, value))
+        for key, column in metricsData.iteritems():
+            if timestamps is None:
+                rows = [(None, column)]
+            else:
+                rows = zip(timestamps, column)
+            for (timestamp, value) in rows:
+                cltd = collectd.Values(type = 'gauge');
+                # naming: host "/" plugin ["-" plugin instance] "/" type ["-" type instance]
+                cltd.host =  vmid #'xenservers' # xenservers/
+                cltd.plugin = vmid # vm-29887edd-6f21-d936-53e5-b4cb2bac3ba0/
+                cltd.type_instance = key # cpu0
+                cltd.values = [ value ]
+                if timestamp is not None:
+                    cltd.time = timestamp
+                cltd.dispatch()
+                self._LogVerbose('Dispatch() data from %s: %s/%s/%s/%s' % (hostname, cltd.host, cltd.plugin, cltd.type_instance, value))
 
-    def _GetRows(self, hostname, uuid, isHost):
+    def _GetRows(self, values, timestamps=None):
+        '''
+        Format the param values of a GetLatestSnapshot() row as metrics data. The columns
+        of a backfill window (timestamps set) are dispatched as they are
+        '''
+        if timestamps is not None:
+            return values
         result = {}
-        if isHost:
-            paramList = self.hosts[hostname]['rrdupdates'].GetHostParamList()
-        else:
-            paramList = self.hosts[hostname]['rrdupdates'].GetVMParamList(uuid)
-        for param in paramList:
-            if param != '':
-                max_time=0
-                data=''
-                for row in range(self.hosts[hostname]['rrdupdates'].GetRows()):
-                    epoch = self.hosts[hostname]['rrdupdates'].GetRowTime(row)
-                    if isHost:
-                        dv = str(self.hosts[hostname]['rrdupdates'].GetHostData(param,row))
-                    else:
-                        dv = str(self.hosts[hostname]['rrdupdates'].GetVMData(uuid,param,row))
-                    if epoch > max_time:
-                        max_time = epoch
-                        data = dv
-                result[param] = data
+        for param, value in values.iteritems():
+            result[param] = str(value)
         return result
 
+    def _ConfigBool(self, value):
+        ''' collectd gives true/false unquoted as a bool, accept the quoted strings as well '''
+        if isinstance(value, basestring):
+            return value.lower() in ('true', 'yes', 'on', '1')
+        return bool(value)
+
     def _LogVerbose(self, msg):
         ''' Be verbose, if self.verbose is True'''
         if not self.verbose:
@@ -382,6 +1031,8 @@ class XenServerCollectd:
 
 # Hooks
 xenserverCollectd = XenServerCollectd()
+# the queries and the rrd_updates times of the shared classes
+xenserver_common.log = collectd.debug
 if __name__ == "__main__":
     import ipdb
     ipdb.set_trace()
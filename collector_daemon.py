@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: collector_daemon.py
+ Author: longhui
+ Created Time: 2018-10-08 14:36:02
+
+ One process running several collector plugins (xenserver, squid or any Plugin
+ subclass) instead of one graphite_plugin.py / squid_plugin.py process each, with:
+
+   - one Scheduler ticking every step seconds (default: the greatest common
+     divisor of the intervals), each plugin running on the ticks of its own interval
+   - one CarbonClient (and CarbonSpool) every plugin's metrics are batched into,
+     so one carbon connection for the box
+   - one self metrics namespace, <prefix>.<hostname>.<plugin>.<metric>, with the
+     collect time, metrics, errors and skipped ticks of each plugin, the phases
+     of the xenserver reads, and the scheduler, carbon and memory of the daemon
+
+ The plugins are listed in an ini file, one section each; the [carbon] and
+ [daemon] sections hold the options of the pipeline:
+
+     [carbon]
+     server = 192.168.1.1
+     port = 2003
+     ; protocol = pickle, batch_size = 500, spool_dir = /var/spool/collector,
+     ; spool_size = 100 (MB), replay_rate = 1000
+
+     [daemon]
+     ; step = 5, jitter = 0, self_metrics = true, prefix = Collector
+
+     [xen1]
+     plugin = xenserver
+     interval = 10
+     host = 10.0.0.100
+     user = root
+     passwd = mysecretpassword
+     ; allow, deny, vm (whitespace separated), graph_host, rrd_interval, rrd_cf,
+     ; backfill, backfill_max_rows, state_file (can be shared), state_names,
+     ; state_names_max_age, timeout: the graphite_plugin.py options
+
+     [squid]
+     plugin = squid
+     interval = 30
+
+ Another plugin is given as plugin = module.ClassName: the class is imported and
+ built with the other options of its section as string keyword arguments.
+
+ Each plugin collects in a thread of its own, so a slow host does not hold the
+ others: a plugin still collecting when its next tick comes skips that tick.
+
+     python collector_daemon.py --config=/etc/collector_daemon.ini
+"""
+from optparse import OptionParser
+from ConfigParser import RawConfigParser
+import Queue
+import threading
+import resource
+import socket
+import math
+import time
+import sys
+import logging
+from logging import handlers
+import graphite_plugin
+import xenserver_common
+from graphite_common import CarbonClient, CarbonSpool, Scheduler
+from xenserver_common import MetricFilter
+
+verboselog = None
+
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def get_bool(options, key, default):
+    value = options.get(key)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def make_xenserver(options, interval):
+    ''' Return the factory of the xenserverPlugin of a section '''
+    metric_filter = None
+    if options.get('allow') or options.get('deny'):
+        metric_filter = MetricFilter(options.get('allow', '').split(), options.get('deny', '').split())
+
+    def make_plugin():
+        return graphite_plugin.xenserverPlugin(
+            host=options.get('host'), user=options.get('user', 'root'), passwd=options.get('passwd', ''),
+            verbose=verboselog, metric_filter=metric_filter,
+            graph_host=get_bool(options, 'graph_host', True), vm_uuids=options.get('vm', '').split(),
+            interval=int(options.get('rrd_interval', 5)), cf=options.get('rrd_cf', 'AVERAGE'),
+            backfill=get_bool(options, 'backfill', False),
+            backfill_max_rows=int(options.get('backfill_max_rows', 60)),
+            state_file=options.get('state_file'), state_names=get_bool(options, 'state_names', True),
+            state_names_max_age=int(options.get('state_names_max_age', 3600)),
+            timeout=float(options.get('timeout', 10)))
+    return make_plugin
+
+
+def make_squid(options, interval):
+    ''' Return the factory of the SquidPlugin of a section '''
+    import squid_plugin
+
+    def make_plugin():
+        return squid_plugin.SquidPlugin(step=interval)
+    return make_plugin
+
+
+def make_class(name, options, interval):
+    ''' Return the factory of the module.ClassName plugin of a section '''
+    module_name, class_name = name.rsplit('.', 1)
+    plugin_class = getattr(__import__(module_name, {}, {}, [class_name]), class_name)
+
+    def make_plugin():
+        return plugin_class(**options)
+    return make_plugin
+
+
+def carbon_metrics(plugin, data):
+    '''
+    Return the (path, value, timestamp) of the items of data, named by the carbon_path()
+    of the plugin: the same series as when its own script sends them
+    '''
+    metrics = []
+    for item in data:
+        data_map = item.format_data()
+        metrics.append((plugin.carbon_path(data_map), data_map["value"], data_map["timestamp"]))
+    return metrics
+
+
+# plugin = <name> of the sections
+PLUGINS = {
+    'xenserver': make_xenserver,
+    'squid': make_squid
+}
+
+
+class Job(object):
+    '''
+    A plugin of the daemon: collects in a thread of its own on the ticks of its interval,
+    the data is queued to the main thread which feeds the shared CarbonClient. The plugin
+    (its xapi session and rrd_updates cursor) is kept across the cycles and only rebuilt
+    after a failure.
+    '''
+
+    def __init__(self, name, make_plugin, interval):
+        self.name = name
+        self.make_plugin = make_plugin
+        self.interval = interval
+        self.plugin = None
+        self.next_due = None
+        self.running = False
+        self.collect_time = 0.0
+        self.metrics = 0
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.lag = 0.0
+
+    def due(self, tick, offset):
+        '''
+        Return True when the tick is one of the job: the ticks on the multiples of its
+        interval, plus the offset of the scheduler. The ones missed are counted skipped.
+        '''
+        if self.next_due is None:
+            self.next_due = math.ceil((tick - offset) / self.interval) * self.interval + offset
+        if tick < self.next_due - 0.001:
+            return False
+        missed = int((tick - self.next_due + 0.001) / self.interval)
+        self.next_due += (missed + 1) * self.interval
+        if self.running:
+            # the last collect overran the interval
+            missed += 1
+        self.skipped += missed
+        return not self.running
+
+    def start(self, tick, results):
+        self.running = True
+        self.lag = max(0.0, time.time() - tick)
+        thread = threading.Thread(target=self.run, args=(results,),
+                                  name="collector-%s" % self.name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self, results):
+        t1 = time.time()
+        metrics = []
+        try:
+            try:
+                if self.plugin is None:
+                    self.plugin = self.make_plugin()
+                metrics = carbon_metrics(self.plugin, self.plugin.prepare_data())
+                self.runs += 1
+            except Exception, e:
+                self.errors += 1
+                sys.stderr.write("collector_daemon: %s failed, it is rebuilt on its next tick: %s\n" % (self.name, e))
+                if verboselog:
+                    verboselog.exception("%s failed", self.name)
+                if self.plugin is not None and hasattr(self.plugin, 'Shutdown'):
+                    try:
+                        self.plugin.Shutdown()
+                    except Exception:
+                        pass
+                self.plugin = None
+        finally:
+            self.collect_time = time.time() - t1
+            self.metrics = len(metrics)
+            self.running = False
+            results.put(metrics)
+
+    def get_stats(self):
+        stats = {
+            "collect_time": self.collect_time,
+            "metrics": self.metrics,
+            "runs": self.runs,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "lag": self.lag
+        }
+        # the phases of the last read of the xenserver plugins
+        cycle = getattr(self.plugin, 'cycle', None)
+        if cycle:
+            stats.update(cycle)
+        return stats
+
+
+class CollectorDaemon(object):
+    '''
+    Run the jobs on the ticks of one Scheduler and send everything they collect through
+    one CarbonClient, with the self metrics of the daemon under prefix.<hostname>.
+    '''
+
+    def __init__(self, jobs, carbon, scheduler, self_metrics=True, prefix="Collector"):
+        self.jobs = jobs
+        self.carbon = carbon
+        self.scheduler = scheduler
+        self.selfMetrics = self_metrics
+        self.namespace = "%s.%s" % (prefix, socket.gethostname().replace('.', '_'))
+        self.results = Queue.Queue()
+
+    def run(self):
+        while True:
+            self.cycle()
+
+    def cycle(self):
+        tick = self.scheduler.wait()
+        stats = self.scheduler.get_stats()
+        started = 0
+        for job in self.jobs:
+            if job.due(tick, self.scheduler.offset):
+                job.start(tick, self.results)
+                started += 1
+        # the jobs still collecting at the next tick are sent on a later cycle
+        deadline = self.scheduler.next_tick - min(1.0, self.scheduler.step / 10.0)
+        received = 0
+        while received < started:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                metrics = self.results.get(True, timeout)
+            except Queue.Empty:
+                break
+            self.send(metrics)
+            received += 1
+        # the late ones of the previous cycles
+        while True:
+            try:
+                metrics = self.results.get(False)
+            except Queue.Empty:
+                break
+            self.send(metrics)
+        if self.selfMetrics:
+            self.add_self_metrics(tick)
+        self.carbon.flush()
+        if verboselog:
+            verboselog.info("Tick %.3f: %d plugins started, scheduler %s, carbon %s",
+                            tick, started, stats, self.carbon.get_stats())
+
+    def send(self, metrics):
+        for path, value, timestamp in metrics:
+            self.carbon.add(path, value, timestamp)
+
+    def add_self_metrics(self, tick):
+        stats = {}
+        for job in self.jobs:
+            for key, value in job.get_stats().iteritems():
+                stats["%s.%s" % (job.name, key)] = value
+        for key, value in self.scheduler.get_stats().iteritems():
+            stats["scheduler.%s" % key] = value
+        for key, value in self.carbon.get_stats().iteritems():
+            stats["carbon.%s" % key] = value
+        # kilobytes on linux
+        stats["daemon.max_rss"] = resource.getrusage(resource.RUSAGE_SELF)[2]
+        stats["daemon.threads"] = threading.activeCount()
+        for key, value in stats.iteritems():
+            self.carbon.add("%s.%s" % (self.namespace, key), value, tick)
+
+
+def load_jobs(config):
+    ''' Return the Jobs of the plugin sections of config '''
+    jobs = []
+    for section in config.sections():
+        if section in ('carbon', 'daemon'):
+            continue
+        options = dict(config.items(section))
+        name = options.pop('plugin', section)
+        interval = int(options.pop('interval', 10))
+        if name in PLUGINS:
+            make_plugin = PLUGINS[name](options, interval)
+        elif '.' in name:
+            make_plugin = make_class(name, options, interval)
+        else:
+            raise ValueError("Unknown plugin %s in section [%s]" % (name, section))
+        jobs.append(Job(section.replace('.', '_').replace(' ', '_'), make_plugin, interval))
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--config", dest="config", help="ini file of the carbon server and the plugins")
+    parser.add_option("--verbose", dest="verbose", action="store_true", help="Record log to /var/log/collectorDaemon.log")
+    (options, args) = parser.parse_args()
+    if not options.config:
+        parser.print_help()
+        sys.exit(1)
+
+    config = RawConfigParser()
+    if not config.read(options.config):
+        print "Can not read %s" % options.config
+        sys.exit(1)
+
+    if options.verbose:
+        verboselog = logging.getLogger("collectorDaemon")
+        verboselog.setLevel(logging.DEBUG)
+        file_handler = handlers.RotatingFileHandler('/var/log/collectorDaemon.log', 'a', 10 * 1024 * 1024, 5)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s|%(levelname)-7s|%(name)s|%(filename)-20s%(lineno)4d : %(message)s"))
+        verboselog.addHandler(file_handler)
+        xenserver_common.log = verboselog.info
+
+    carbon_options = {}
+    if config.has_section('carbon'):
+        carbon_options = dict(config.items('carbon'))
+    daemon_options = {}
+    if config.has_section('daemon'):
+        daemon_options = dict(config.items('daemon'))
+
+    try:
+        jobs = load_jobs(config)
+    except (ValueError, ImportError, AttributeError), e:
+        print "Bad plugin configuration: %s" % e
+        sys.exit(1)
+    if not jobs:
+        print "No plugin section in %s" % options.config
+        sys.exit(1)
+
+    # the scheduler ticks on every interval, unless a step is given
+    step = 0
+    for job in jobs:
+        step = gcd(step, job.interval)
+    step = int(daemon_options.get('step', step))
+    for job in jobs:
+        if job.interval % step:
+            print "The interval of [%s] is not a multiple of the step %s" % (job.name, step)
+            sys.exit(1)
+    scheduler = Scheduler(step, jitter=float(daemon_options.get('jitter', 0)), key=socket.gethostname())
+
+    if not carbon_options.get('server'):
+        print "Please give the carbon server in the [carbon] section"
+        sys.exit(1)
+    # one connection to carbon for all the plugins
+    spool = None
+    if carbon_options.get('spool_dir'):
+        spool = CarbonSpool(carbon_options['spool_dir'],
+                            max_bytes=int(carbon_options.get('spool_size', 100)) * 1024 * 1024,
+                            replay_rate=int(carbon_options.get('replay_rate', 1000)))
+    carbon = CarbonClient(carbon_options['server'], int(carbon_options.get('port', 2003)),
+                          protocol=carbon_options.get('protocol', 'plaintext'),
+                          batch_size=int(carbon_options.get('batch_size', 500)), spool=spool)
+
+    daemon = CollectorDaemon(jobs, carbon, scheduler, self_metrics=get_bool(daemon_options, 'self_metrics', True),
+                             prefix=daemon_options.get('prefix', 'Collector'))
+    daemon.run()
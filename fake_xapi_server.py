@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: fake_xapi_server.py
+ Author: longhui
+ Created Time: 2018-09-18 10:21:47
+
+ Stand-in XenServers to load test the collectors without real hosts. Every
+ virtual host listens on its own port (--port, --port + 1, ...) of one process
+ and answers:
+
+   - the XML-RPC calls the plugins make: session.login_with_password, session.logout,
+     session.get_this_host, pool.*, host.*, VM.* (get_all, get_all_records,
+     get_all_records_where, get_record and the field getters) and event.from
+   - GET /rrd_updates, with a document generated by benchmark.generate_rrd_updates()
+     (--vms x --vm-metrics x --rows) or the --template file (example.xml), gzip
+     compressed when asked, narrowed to one VM with vm_uuid= and without the host
+     columns with host=false
+
+ Errors can be injected: --latency seconds before each answer, a share of the
+ XML-RPC calls failing with SESSION_INVALID (--session-invalid), of the
+ rrd_updates answered with http 401 (--http-401) and of the requests hanging
+ --hang seconds (--hang-rate). With --pool the virtual hosts form one pool whose
+ master is the first one, otherwise each is a pool on its own.
+
+     python fake_xapi_server.py --hosts=200 --port=9000 --vms=30 --latency=0.05 --http-401=0.01
+     python graphite_plugin.py --console --host=127.0.0.1:9000 -u root -p x
+"""
+from optparse import OptionParser
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+import SocketServer
+import threading
+import random
+import time
+import gzip
+import re
+import sys
+from cStringIO import StringIO
+import benchmark
+import xenserver_common
+
+
+class FakeHost(object):
+    '''
+    One virtual XenServer: its host and VM records and its rrd_updates document
+    '''
+
+    def __init__(self, index, address, document):
+        self.ref = "OpaqueRef:host-%d" % index
+        self.address = address
+        self.document = document
+        self.documents = {} # (vm_uuid, host, gzip) -> document answered
+        rrdupdates = xenserver_common.GetRRDUdpates()
+        rrdupdates.Parse(StringIO(document))
+        self.record = {
+            "uuid": rrdupdates.GetHostUUID(),
+            "name_label": "fake-host-%d" % index,
+            "hostname": "fake-host-%d" % index,
+            "address": address,
+            "API_version_major": "2",
+            "API_version_minor": "5",
+        }
+        # the first VM of the document plays the control domain
+        self.vms = {}
+        for (i, uuid) in enumerate(sorted(rrdupdates.GetVMList())):
+            self.vms["OpaqueRef:vm-%d-%d" % (index, i)] = {
+                "uuid": uuid,
+                "name_label": "fake-vm-%d-%d" % (index, i),
+                "is_control_domain": i == 0,
+                "is_a_template": False,
+                "is_a_snapshot": False,
+                "power_state": "Running",
+                "resident_on": self.ref,
+            }
+
+    def get_document(self, vm_uuid=None, host=True, compress=False):
+        '''
+        Return the document, with the columns of vm_uuid only (all the VMs when None)
+        and the host columns if host, gzip compressed if compress
+        '''
+        key = (vm_uuid, host, compress)
+        if key not in self.documents:
+            if compress:
+                buf = StringIO()
+                f = gzip.GzipFile(fileobj=buf, mode="wb")
+                f.write(self.get_document(vm_uuid, host))
+                f.close()
+                self.documents[key] = buf.getvalue()
+            elif vm_uuid is None and host:
+                self.documents[key] = self.document
+            else:
+                self.documents[key] = narrow_document(self.document, vm_uuid, host)
+        return self.documents[key]
+
+
+def narrow_document(document, vm_uuid, host):
+    '''
+    Return the rrd_updates document with the columns of vm_uuid only (all the VMs when None)
+    and the host columns if host, as xapi answers the vm_uuid= and host= parameters
+    '''
+    keep = []
+    for entry in re.findall(r"<entry>([^<]*)</entry>", document):
+        (cf, kind, uuid, param) = entry.split(":")
+        if kind == "host":
+            keep.append(host)
+        else:
+            keep.append(vm_uuid is None or uuid == vm_uuid)
+    entries = iter(keep)
+    def legend(match):
+        if entries.next():
+            return match.group(0)
+        return ""
+    def row(match):
+        values = re.findall(r"<v>[^<]*</v>", match.group(2))
+        return match.group(1) + "".join([v for (v, k) in zip(values, keep) if k]) + "</row>"
+    document = re.sub(r"<entry>[^<]*</entry>", legend, document)
+    document = re.sub(r"<columns>\d+</columns>", "<columns>%d</columns>" % keep.count(True), document)
+    return re.sub(r"(<row>\s*<t>[^<]*</t>)(.*?)</row>", row, document)
+
+
+class Fleet(object):
+    '''
+    The virtual hosts, their sessions and the error injection, shared by every port
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.hosts = []
+        self.sessions = {} # session ref -> the FakeHost it was opened on
+        self.session_count = 0
+        self.event_tokens = 0
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "fetches": 0, "logins": 0, "session_invalid": 0, "http_401": 0, "hangs": 0}
+
+    def add_host(self, address):
+        index = len(self.hosts)
+        if self.options.template:
+            document = open(self.options.template).read()
+        else:
+            document = benchmark.generate_rrd_updates(self.options.vms, self.options.vm_metrics,
+                                                      self.options.rows, host_index=index)
+        host = FakeHost(index, address, document)
+        self.hosts.append(host)
+        return host
+
+    def pool_of(self, host):
+        ''' The hosts in the pool of host, its master first '''
+        if self.options.pool:
+            return self.hosts
+        return [host]
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+
+    def delay(self):
+        ''' Apply --latency, and hang --hang seconds on --hang-rate of the requests '''
+        if self.options.latency:
+            time.sleep(self.options.latency)
+        if self.options.hang_rate and random.random() < self.options.hang_rate:
+            self.count("hangs")
+            time.sleep(self.options.hang)
+
+    def login(self, host):
+        self.lock.acquire()
+        try:
+            self.session_count += 1
+            session = "OpaqueRef:session-%d" % self.session_count
+            # a session opened on the master is valid on the whole pool
+            self.sessions[session] = self.pool_of(host)[0]
+        finally:
+            self.lock.release()
+        self.count("logins")
+        return session
+
+    def valid(self, session):
+        return session in self.sessions
+
+    def invalidate(self, session):
+        self.sessions.pop(session, None)
+
+    def next_token(self):
+        self.lock.acquire()
+        try:
+            self.event_tokens += 1
+            return str(self.event_tokens)
+        finally:
+            self.lock.release()
+
+
+class XapiDispatcher(object):
+    '''
+    The XML-RPC calls of one virtual host, answered the way xapi does
+    '''
+
+    def __init__(self, fleet, host):
+        self.fleet = fleet
+        self.host = host
+
+    def _dispatch(self, method, params):
+        self.fleet.delay()
+        self.fleet.count("calls")
+        if method == "session.login_with_password":
+            return self.success(self.fleet.login(self.host))
+        session = params[0]
+        if not self.fleet.valid(session):
+            return self.failure("SESSION_INVALID", session)
+        if self.fleet.options.session_invalid and random.random() < self.fleet.options.session_invalid:
+            self.fleet.count("session_invalid")
+            self.fleet.invalidate(session)
+            return self.failure("SESSION_INVALID", session)
+        if method == "session.logout":
+            self.fleet.invalidate(session)
+            return self.success("")
+        if method == "session.get_this_host":
+            return self.success(self.fleet.sessions.get(session, self.host).ref)
+        if method == "event.from":
+            return self.success(self.event_from(*params[1:]))
+        (cls, call) = method.split(".", 1)
+        if cls == "pool":
+            master = self.fleet.pool_of(self.host)[0]
+            if call == "get_all":
+                return self.success(["OpaqueRef:pool-%s" % master.ref])
+            if call == "get_master":
+                return self.success(master.ref)
+        elif cls in ("host", "VM"):
+            return self.records_call(self.records(cls), call, params[1:])
+        return self.failure("MESSAGE_METHOD_UNKNOWN", method)
+
+    def records(self, cls):
+        records = {}
+        for host in self.fleet.pool_of(self.host):
+            if cls == "host":
+                records[host.ref] = host.record
+            else:
+                records.update(host.vms)
+        return records
+
+    def records_call(self, records, call, args):
+        if call == "get_all":
+            return self.success(records.keys())
+        if call == "get_all_records":
+            return self.success(records)
+        if call == "get_all_records_where":
+            # only the 'field "uuid" = "..." or ...' expressions MetadataCache.Resolve() sends
+            uuids = set(re.findall(r'field "uuid" = "([^"]*)"', args[0]))
+            return self.success(dict([(ref, record) for (ref, record) in records.iteritems() if record["uuid"] in uuids]))
+        if call.startswith("get_") and args and args[0] in records:
+            if call == "get_record":
+                return self.success(records[args[0]])
+            field = call[len("get_"):]
+            if field in records[args[0]]:
+                return self.success(records[args[0]][field])
+        if args and args[0] not in records:
+            return self.failure("HANDLE_INVALID", args[0])
+        return self.failure("MESSAGE_METHOD_UNKNOWN", call)
+
+    def event_from(self, classes, token, timeout):
+        ''' Every object of classes on the first call, then no change at all '''
+        if token:
+            time.sleep(min(float(timeout), 30))
+            return {"events": [], "valid_ref_counts": {}, "token": token}
+        events = []
+        for cls in classes:
+            name = {"vm": "VM", "host": "host"}.get(cls.lower())
+            if name is None:
+                continue
+            for (ref, record) in self.records(name).iteritems():
+                events.append({"class": cls, "operation": "add", "ref": ref, "snapshot": record})
+        return {"events": events, "valid_ref_counts": {}, "token": self.fleet.next_token()}
+
+    def success(self, value):
+        return {"Status": "Success", "Value": value}
+
+    def failure(self, *description):
+        return {"Status": "Failure", "ErrorDescription": list(description)}
+
+
+class FakeRequestHandler(SimpleXMLRPCRequestHandler):
+    '''
+    XML-RPC on POST, rrd_updates on GET, over kept alive connections
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        fleet = self.server.fleet
+        host = self.server.host
+        if not self.path.startswith("/rrd_updates"):
+            self.send_answer(404, "")
+            return
+        fleet.delay()
+        fleet.count("fetches")
+        session = (re.findall(r"session_id=([^&]*)", self.path) or [""])[0]
+        if not fleet.valid(session) or (fleet.options.http_401 and random.random() < fleet.options.http_401):
+            fleet.count("http_401")
+            self.send_answer(401, "")
+            return
+        vm_uuid = (re.findall(r"vm_uuid=([^&]*)", self.path) or [None])[0]
+        with_host = "host=false" not in self.path
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            self.send_answer(200, host.get_document(vm_uuid, with_host, True), "gzip")
+        else:
+            self.send_answer(200, host.get_document(vm_uuid, with_host))
+
+    def send_answer(self, status, body, encoding=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.fleet.options.verbose:
+            SimpleXMLRPCRequestHandler.log_message(self, format, *args)
+
+
+class FakeServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fleet, host):
+        SimpleXMLRPCServer.__init__(self, address, FakeRequestHandler, logRequests=False, allow_none=True)
+        self.fleet = fleet
+        self.host = host
+        self.register_instance(XapiDispatcher(fleet, host))
+
+
+def start_fleet(options):
+    fleet = Fleet(options)
+    servers = []
+    for i in range(options.hosts):
+        port = options.port + i
+        host = fleet.add_host("%s:%d" % (options.bind, port))
+        server = FakeServer((options.bind, port), fleet, host)
+        thread = threading.Thread(target=server.serve_forever, name="fake-xapi-%d" % port)
+        thread.setDaemon(True)
+        thread.start()
+        servers.append(server)
+    return (fleet, servers)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--hosts", dest="hosts", type="int", default=1, help="Virtual hosts, one port each")
+    parser.add_option("--bind", dest="bind", default="127.0.0.1", help="Address to listen on")
+    parser.add_option("--port", dest="port", type="int", default=9000, help="Port of the first virtual host")
+    parser.add_option("--pool", dest="pool", action="store_true", default=False, help="Put all the virtual hosts in one pool")
+    parser.add_option("--template", dest="template", help="rrd_updates document to serve, like example.xml, instead of a generated one")
+    parser.add_option("--vms", dest="vms", type="int", default=20, help="VMs per generated document")
+    parser.add_option("--vm-metrics", dest="vm_metrics", type="int", default=20, help="Metrics per VM of the generated documents")
+    parser.add_option("--rows", dest="rows", type="int", default=2, help="Rows of the generated documents")
+    parser.add_option("--latency", dest="latency", type="float", default=0.0, help="Seconds before each answer")
+    parser.add_option("--session-invalid", dest="session_invalid", type="float", default=0.0, help="Share of the XML-RPC calls failing with SESSION_INVALID")
+    parser.add_option("--http-401", dest="http_401", type="float", default=0.0, help="Share of the rrd_updates answered with http 401")
+    parser.add_option("--hang-rate", dest="hang_rate", type="float", default=0.0, help="Share of the requests hanging --hang seconds")
+    parser.add_option("--hang", dest="hang", type="float", default=60.0, help="Seconds a hanging request waits")
+    parser.add_option("--stats", dest="stats", type="int", default=0, help="Print the request counters every N seconds")
+    parser.add_option("--verbose", dest="verbose", action="store_true", default=False, help="Log every request")
+    (options, args) = parser.parse_args()
+
+    (fleet, servers) = start_fleet(options)
+    print "%d virtual hosts on %s:%d-%d" % (options.hosts, options.bind, options.port, options.port + options.hosts - 1)
+    sys.stdout.flush()
+    try:
+        while True:
+            if options.stats:
+                time.sleep(options.stats)
+                print time.strftime("%H:%M:%S"), fleet.stats
+                sys.stdout.flush()
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        print fleet.stats
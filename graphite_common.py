@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: graphite_common.py
+ Author: longhui
+ Created Time: 2018-10-15 16:40:18
+
+ Carbon output code shared by graphite_plugin.py, squid_plugin.py and
+ collector_daemon.py: the data items, the buffered CarbonClient with its on disk
+ CarbonSpool, and the step aligned Scheduler of the collection loops. Deploy it
+ next to the plugins.
+"""
+import time
+import os
+import socket
+import struct
+import zlib
+import math
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class CarbonClient(object):
+    '''
+    Long lived connection to carbon. The metrics are buffered and sent in large
+    writes, once flush_count metrics are waiting or flush_interval seconds passed.
+    When carbon can not be reached, the connection is retried with an exponential
+    backoff and the buffer keeps at most max_buffer metrics, the oldest are dropped.
+    protocol is "plaintext" (carbon port 2003) or "pickle" (port 2004), which sends
+    the metrics as length prefixed pickled lists of batch_size metrics at most.
+    With a CarbonSpool, what can not be sent is spooled on disk instead of being
+    dropped, and replayed once carbon is back.
+    '''
+
+    def __init__(self, server, port, flush_count=1000, flush_interval=1.0,
+                 max_buffer=100000, timeout=10, max_retry_delay=60,
+                 protocol="plaintext", batch_size=500, spool=None):
+        if protocol not in ("plaintext", "pickle"):
+            raise ValueError("Unknown carbon protocol: %s" % protocol)
+        self.server = server
+        self.port = port
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.spool = spool
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.max_retry_delay = max_retry_delay
+        self.sock = None
+        self.buffer = [] # (path, value, timestamp) tuples
+        self.last_flush = time.time()
+        self.retry_delay = 0
+        self.next_retry = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.connects = 0
+
+    def add(self, path, value, timestamp):
+        self.buffer.append((path, value, timestamp))
+        if len(self.buffer) > self.max_buffer:
+            overflow = len(self.buffer) - self.max_buffer
+            if self.spool is not None:
+                self.spool.append(self.buffer[:overflow])
+            else:
+                self.dropped += overflow
+            del self.buffer[:overflow]
+        if len(self.buffer) >= self.flush_count or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Send the buffered metrics, return False when carbon could not be reached:
+        they are kept for the next flush, or spooled
+        '''
+        if not self.buffer:
+            self.last_flush = time.time()
+            if self.sock is None and self.spool is not None and self.spool.pending():
+                # nothing new, but the spool waits for carbon
+                self._connect()
+            self._replay()
+            return True
+        if self.sock is None and not self._connect():
+            self._spool_buffer()
+            return False
+        message = self.encode(self.buffer)
+        try:
+            self.sock.sendall(message)
+        except socket.error:
+            # a part of the message may be sent twice, carbon keeps the last value of a timestamp
+            self._disconnect()
+            self._spool_buffer()
+            return False
+        self.sent += len(self.buffer)
+        self.bytes_sent += len(message)
+        self.buffer = []
+        self.last_flush = time.time()
+        self._replay()
+        return True
+
+    def close(self):
+        ''' Flush and close the connection, what could not be sent is spooled or dropped '''
+        self.flush()
+        self._spool_buffer()
+        self.dropped += len(self.buffer)
+        self.buffer = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def encode(self, items):
+        ''' Return the bytes sending the (path, value, timestamp) items '''
+        if self.protocol == "plaintext":
+            # need to add "\n", otherwise it will give warning: unfinished line
+            return "".join(["%s %s %s\n" % item for item in items])
+        frames = []
+        for start in range(0, len(items), self.batch_size):
+            batch = []
+            for (path, value, timestamp) in items[start:start + self.batch_size]:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+                batch.append((path, (timestamp, value)))
+            payload = pickle.dumps(batch, 2)
+            frames.append(struct.pack("!L", len(payload)) + payload)
+        return "".join(frames)
+
+    def get_stats(self):
+        stats = {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "buffered": len(self.buffer),
+            "bytes_sent": self.bytes_sent,
+            "connects": self.connects
+        }
+        if self.spool is not None:
+            stats.update(self.spool.get_stats())
+        return stats
+
+    def _spool_buffer(self):
+        if self.spool is not None and self.buffer:
+            self.spool.append(self.buffer)
+            self.buffer = []
+
+    def _replay(self):
+        ''' Send the spool, oldest first, as much as its replay rate allows '''
+        if self.spool is None:
+            return
+        while self.sock is not None and self.spool.pending():
+            (items, position) = self.spool.peek(self.spool.budget())
+            if not items:
+                return
+            message = self.encode(items)
+            try:
+                self.sock.sendall(message)
+            except socket.error:
+                self._disconnect()
+                return
+            self.spool.consume(position)
+            self.sent += len(items)
+            self.bytes_sent += len(message)
+
+    def _connect(self):
+        now = time.time()
+        if now < self.next_retry:
+            return False
+        try:
+            self.sock = socket.create_connection((self.server, self.port), self.timeout)
+        except socket.error:
+            self.sock = None
+            self.retry_delay = min(max(1, self.retry_delay * 2), self.max_retry_delay)
+            self.next_retry = now + self.retry_delay
+            return False
+        self.retry_delay = 0
+        self.connects += 1
+        return True
+
+    def _disconnect(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.sock = None
+        self.next_retry = 0
+
+
+class CarbonSpool(object):
+    '''
+    Bounded on disk spool of the metrics carbon could not take, used by CarbonClient.
+    It is a directory of append only segment files of about segment_bytes each (a
+    quarter of max_bytes at most), at most max_bytes in total: when it is full the
+    oldest segment is evicted. The metrics are replayed oldest first, replay_rate
+    metrics per second on average: the budget left unused between two flushes is
+    kept, up to max_burst seconds of it. The replay position is saved in the
+    directory, a restart does not send the replayed part of a segment again. A line torn
+    by a crash is cut off the newest segment at startup, and skipped in an older one.
+    '''
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, segment_bytes=1024 * 1024, replay_rate=1000,
+                 max_burst=300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # the spool is bounded by evicting whole segments: keep several of them
+        self.segment_bytes = max(1, min(segment_bytes, max_bytes // 4))
+        self.replay_rate = replay_rate
+        self.max_burst = max_burst
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # segments are named after a sequence number, the oldest one first
+        self.segments = sorted([int(name.split(".")[0]) for name in os.listdir(directory)
+                                if name.endswith(".spool")])
+        self._repair_last()
+        self.size = sum([os.path.getsize(self._path(seq)) for seq in self.segments])
+        self.offset = self._load_offset() # bytes of the oldest segment already replayed
+        self.tokens = 0
+        self.last_replay = time.time()
+        self.spooled = 0
+        self.replayed = 0
+        self.evicted = 0
+
+    def append(self, items):
+        ''' Add (path, value, timestamp) items at the end of the spool '''
+        lines = ["%s %s %s\n" % item for item in items]
+        if not self.segments:
+            # the replay budget is earned while there is something to replay only
+            self.tokens = 0
+            self.last_replay = time.time()
+        start = 0
+        while start < len(lines):
+            if self.segments:
+                room = self.segment_bytes - os.path.getsize(self._path(self.segments[-1]))
+            else:
+                room = 0
+            if room <= 0:
+                if self.segments:
+                    self.segments.append(self.segments[-1] + 1)
+                else:
+                    self.segments.append(0)
+                room = self.segment_bytes
+            # fill the last segment up to segment_bytes, with one line at least
+            end = start
+            size = 0
+            while end < len(lines) and (size < room or end == start):
+                size += len(lines[end])
+                end += 1
+            spool_file = open(self._path(self.segments[-1]), "ab")
+            try:
+                spool_file.write("".join(lines[start:end]))
+            finally:
+                spool_file.close()
+            self.size += size
+            start = end
+        self.spooled += len(items)
+        while self.size > self.max_bytes and self.segments:
+            self._evict()
+
+    def pending(self):
+        return len(self.segments) > 0
+
+    def budget(self):
+        ''' Number of metrics the replay rate allows to send now '''
+        now = time.time()
+        self.tokens = min(self.replay_rate * self.max_burst, self.tokens + self.replay_rate * (now - self.last_replay))
+        self.last_replay = now
+        return int(self.tokens)
+
+    def peek(self, count):
+        '''
+        Return up to count of the oldest (path, value, timestamp) items, and the
+        position to give to consume() once they are sent
+        '''
+        while self.segments and count > 0:
+            seq = self.segments[0]
+            spool_file = open(self._path(seq), "rb")
+            try:
+                spool_file.seek(self.offset)
+                items = []
+                offset = self.offset
+                while len(items) < count:
+                    line = spool_file.readline()
+                    if not line.endswith("\n"):
+                        if line and seq != self.segments[-1]:
+                            # torn by a crash while it was written, and never completed: skip it
+                            offset += len(line)
+                            self.evicted += 1
+                        break # end of the segment
+                    offset += len(line)
+                    items.append(tuple(line[:-1].rsplit(" ", 2)))
+            finally:
+                spool_file.close()
+            if items or seq == self.segments[-1]:
+                return (items, (seq, offset, len(items)))
+            # nothing left in this segment but a torn line, go on with the next one
+            self._remove_oldest()
+        return ([], None)
+
+    def consume(self, position):
+        ''' Forget the items returned by peek() with position '''
+        (seq, offset, count) = position
+        if not self.segments or self.segments[0] != seq:
+            return # evicted meanwhile
+        self.offset = offset
+        self.replayed += count
+        self.tokens -= count
+        if offset >= os.path.getsize(self._path(seq)):
+            self._remove_oldest()
+        else:
+            self._save_offset()
+
+    def get_stats(self):
+        return {
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "evicted": self.evicted,
+            "spool_bytes": self.size
+        }
+
+    def _evict(self):
+        spool_file = open(self._path(self.segments[0]), "rb")
+        try:
+            spool_file.seek(self.offset)
+            self.evicted += spool_file.read().count("\n")
+        finally:
+            spool_file.close()
+        self._remove_oldest()
+
+    def _remove_oldest(self):
+        path = self._path(self.segments.pop(0))
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+        self.offset = 0
+        self._save_offset()
+
+    def _repair_last(self):
+        '''
+        Truncate the newest segment back to its last complete line: a crash in the middle
+        of append() leaves a torn line the next append() would be written onto
+        '''
+        while self.segments:
+            path = self._path(self.segments[-1])
+            spool_file = open(path, "r+b")
+            try:
+                # a segment is segment_bytes at most, read at startup only
+                data = spool_file.read()
+                end = data.rfind("\n") + 1
+                if end < len(data):
+                    spool_file.truncate(end)
+            finally:
+                spool_file.close()
+            if end > 0:
+                return
+            # nothing complete in it, the segment before becomes the newest
+            os.remove(path)
+            self.segments.pop()
+
+    def _load_offset(self):
+        ''' Return the replay offset saved for the oldest segment, 0 if it is for another one '''
+        try:
+            offset_file = open(os.path.join(self.directory, "replay.offset"), "rb")
+            try:
+                (seq, offset) = [int(field) for field in offset_file.read().split()]
+            finally:
+                offset_file.close()
+        except (IOError, ValueError):
+            return 0
+        if not self.segments or self.segments[0] != seq:
+            return 0
+        return offset
+
+    def _save_offset(self):
+        ''' Save the replay offset of the oldest segment, renamed over the previous one '''
+        path = os.path.join(self.directory, "replay.offset")
+        seq = 0
+        if self.segments:
+            seq = self.segments[0]
+        offset_file = open(path + ".tmp", "wb")
+        try:
+            offset_file.write("%d %d\n" % (seq, self.offset))
+        finally:
+            offset_file.close()
+        os.rename(path + ".tmp", path)
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "%020d.spool" % seq)
+
+
+class Scheduler(object):
+    '''
+    Clock of the collection loops: the ticks fall on the wall clock multiples of step
+    (a 10s step ticks at :00, :10, :20 ..) so the points line up with the carbon
+    retention buckets, shifted by an offset below jitter seconds derived from key (the
+    host collected): the collectors of many hosts spread their load over the step and
+    keep their phase across restarts. A cycle which runs past the next tick makes the
+    ticks it overran skipped, they are not run late one after the other.
+    '''
+
+    def __init__(self, step, jitter=0.0, key=""):
+        self.step = step
+        self.offset = 0.0
+        if jitter > 0:
+            self.offset = (zlib.crc32(key) & 0xffffffff) % 1000 / 1000.0 * min(jitter, step)
+        self.next_tick = None
+        self.ticks = 0
+        self.skipped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def next_time(self, now):
+        ''' Return the first tick after now '''
+        return (math.floor((now - self.offset) / self.step) + 1) * self.step + self.offset
+
+    def wait(self):
+        ''' Sleep until the next tick, skipping the ones already past, and return its time '''
+        now = time.time()
+        if self.next_tick is None:
+            self.next_tick = self.next_time(now)
+        elif now > self.next_tick:
+            # the last cycle overran: skip instead of stacking the cycles
+            missed = int((now - self.next_tick) / self.step) + 1
+            self.skipped += missed
+            self.next_tick += missed * self.step
+        delay = self.next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        tick = self.next_tick
+        self.next_tick += self.step
+        self.ticks += 1
+        self.lag = max(0.0, time.time() - tick)
+        self.max_lag = max(self.max_lag, self.lag)
+        return tick
+
+    def get_stats(self):
+        return {
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "lag": self.lag,
+            "max_lag": self.max_lag
+        }
+
+
+class DataItem(object):
+    '''
+    The base class of data items.
+    If new monitor system is applied, we should support both new and old data
+    format. So extend it and overwrite format_data() to satisfy new system, and
+    modify old subclasses to make it capatible for old plugins
+    '''
+
+    def format_data(self):
+        '''
+        Formatting the data, return a dict
+        '''
+        raise NotImplementedError()
+
+
+class GraphiteData(DataItem):
+    _metric = ""
+    _endpoint = ""
+    _value = ""
+    _step = ""
+    _type = ""
+
+    def __init__(self, endpoint, metric, type, step, value, timestamp=None):
+        '''
+        host/plugin-instance/type-instance
+        :param endpoint: host
+        :param metric: plugin-instance
+        :param type: type-instance
+        :param step: time interval
+        :param value:
+        '''
+        self._endpoint = endpoint
+        self._metric = metric
+        self._type = type
+        self._step = step
+        self._value = value
+        if timestamp is None:
+            timestamp = time.time()
+        self._timestamp = timestamp
+
+    def format_data(self):
+        return {
+            "metric": self._metric,
+            "endpoint": self._endpoint,
+            "value": self._value,
+            "step": self._step,
+            "type": self._type,
+            "timestamp": self._timestamp
+        }
+
+
+class Plugin(object):
+    '''
+    The base class for plugins
+    All you need is just to extend it, overwrite prepare_data() method,
+    and call report() method in __main__. Overwrite carbon_path() to name
+    the metrics another way in carbon.
+    '''
+
+    def report(self):
+        '''
+        Report your prepared_data() to destination system
+        '''
+        data = self.prepare_data()
+        self._report_to_graphite(data)
+
+    def console(self):
+        '''
+        Show the data to the cluster administrators
+        '''
+        data = self.prepare_data()
+        self._report_to_console(data)
+
+    def send_to_carbon(self, server, port, carbon=None):
+        """
+        Send prepare_data() to carbon with the CarbonClient carbon, when it is
+        None a connection is opened for this call only
+        :return: False when the data could not be sent yet
+        """
+        if carbon is None:
+            client = CarbonClient(server, port)
+        else:
+            client = carbon
+
+        data = self.prepare_data()
+        for item in data:
+            data_map = item.format_data()
+            client.add(self.carbon_path(data_map),
+                       data_map["value"],
+                       data_map["timestamp"])
+        result = client.flush()
+        if carbon is None:
+            client.close()
+        return result
+
+    def carbon_path(self, data_map):
+        '''
+        Return the carbon path of the format_data() data_map of an item
+        '''
+        return "%s.%s" % (data_map["metric"], data_map["type"])
+
+    def prepare_data(self):
+        '''
+        Prepare your data. Return a list of DataItem(or its subclass) instances
+        '''
+        raise NotImplementedError
+
+    def generate_graphite_data(self):
+        """
+        :return: the carbon plaintext lines of prepare_data()
+        """
+        data = self.prepare_data()
+        result_data = []
+
+        for item in data:
+            data_map = item.format_data()
+            result_data.append('%s %s %s' % (self.carbon_path(data_map),
+                                             data_map["value"],
+                                             data_map["timestamp"]))
+        return result_data
+
+    def _report_to_graphite(self, data):
+        data_format = 'PUTVAL "%s/%s/%s" interval=%s N:%s'
+        for item in data:
+            data_map = item.format_data()
+            print data_format % (data_map["endpoint"], data_map["metric"],
+                                 data_map["type"], data_map["step"],
+                                 data_map["value"])
+
+    def _report_to_console(self, data):
+        for item in data:
+            data_map = item.format_data()
+            print '%s %s %s' % (self.carbon_path(data_map),
+                                data_map["value"],
+                                data_map["timestamp"])
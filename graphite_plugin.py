@@ -7,148 +7,15 @@
 """
 from optparse import OptionParser
 import XenAPI
-import urllib
 import time
 import sys
-import socket
 import logging
 from logging import handlers
-from xml.dom import minidom
-
-class Plugin(object):
-    '''
-    The base class for plugins
-    All you need is just to extend it, overwrite prepare_data() method,
-    and call report() method in __main__.
-    '''
-
-    def report(self):
-        '''
-        Report your prepared_data() to destination system
-        '''
-        data = self.prepare_data()
-        self._report_to_graphite(data)
-
-    def console(self):
-        '''
-        Show the data to the cluster administrators
-        '''
-        data = self.prepare_data()
-        self._report_to_console(data)
-
-    def send_to_carbon(self, server, port):
-        """
-        :return:
-        """
-
-        CARBON_SERVER = server
-        CARBON_PORT = port
-
-        data = self.prepare_data()
-        data_format = '%s.%s %s %s'
-        sock = socket.socket()
-        sock.connect((CARBON_SERVER, CARBON_PORT))
-        for item in data:
-            data_map = item.format_data()
-            message = data_format % (data_map["metric"],
-                                     data_map["type"],
-                                     data_map["value"],
-                                     data_map["timestamp"])
-            sock.sendall(message + "\n") # need to add "\n", otherwise it will give warning: unfinished line
-        sock.close()
-
-
-    def prepare_data(self):
-        '''
-        Prepare your data. Return a list of DataItem(or its subclass) instances
-        '''
-        raise NotImplementedError
-
-    def _report_to_graphite(self, data):
-        data_format = 'PUTVAL "%s/%s/%s" interval=%s N:%s'
-        for item in data:
-            data_map = item.format_data()
-            print data_format % (data_map["endpoint"], data_map["metric"],
-                                 data_map["type"], data_map["step"],
-                                 data_map["value"])
-
-    def _report_to_console(self, data):
-        data_format = '%s.%s %s %s' #'metric:%s type:%s value:%s timestamp:%s'
-        for item in data:
-            data_map = item.format_data()
-            #print data_format % (data_map["endpoint"], data_map["metric"], val)
-            print data_format % (data_map["metric"],
-                                 data_map["type"],
-                                 data_map["value"],
-                                 data_map["timestamp"])
-
-    def generate_graphite_data(self):
-        """
-        :return:
-        """
-        data_format = '%s.%s %s %s' #'metric:%s type:%s value:%s timestamp:%s'
-        data = self.prepare_data()
-        result_data=[]
-
-        for item in data:
-            data_map = item.format_data()
-            #print data_format % (data_map["endpoint"], data_map["metric"], val)
-            result_data.append(data_format % (data_map["metric"],
-                                 data_map["type"],
-                                 data_map["value"],
-                                 data_map["timestamp"]))
-        return result_data
+from graphite_common import Plugin, GraphiteData, CarbonClient, CarbonSpool, Scheduler
+import xenserver_common
+from xenserver_common import MetadataCache, StateFile, MetricFilter, GetRRDUdpates, RRDSelection
 
-
-class DataItem(object):
-    '''
-    The base class of data items.
-    If new monitor system is applied, we should support both new and old data
-    format. So extend it and overwrite format_data() to satisfy new system, and
-    modify old subclasses to make it capatible for old plugins
-    '''
-
-    def format_data(self):
-        '''
-        Formatting the data, return a dict
-        '''
-        raise NotImplementedError()
-
-
-class GraphiteData(DataItem):
-    _metric = ""
-    _endpoint = ""
-    _value = ""
-    _step = ""
-    _type = ""
-
-    def __init__(self, endpoint, metric, type, step, value, timestamp=None):
-        '''
-        host/plugin-instance/type-instance
-        :param endpoint: host
-        :param metric: plugin-instance
-        :param type: type-instance
-        :param step: time interval
-        :param value:
-        '''
-        self._endpoint = endpoint
-        self._metric = metric
-        self._type = type
-        self._step = step
-        self._value = value
-        if timestamp is None:
-            timestamp = time.time()
-        self._timestamp = timestamp
-
-    def format_data(self):
-        return {
-            "metric": self._metric,
-            "endpoint": self._endpoint,
-            "value": self._value,
-            "step": self._step,
-            "type": self._type,
-            "timestamp": self._timestamp
-        }
+verboselog = None
 
 class TestPlugin(Plugin):
     def __init__(self, endpoit, step, metric, type, value):
@@ -162,174 +29,10 @@ class TestPlugin(Plugin):
         return [GraphiteData(self._metric, self._endpoit, self._value, self._step, self._type)]
 
 
-# Per VM dictionary (used by GetRRDUdpates to look up column numbers by variable names)
-class VMReport(dict):
-    """Used internally by GetRRDUdpates"""
-    def __init__(self, uuid):
-        self.uuid = uuid
-
-
-# Per Host dictionary (used by GetRRDUdpates to look up column numbers by variable names)
-class HostReport(dict):
-    """Used internally by GetRRDUdpates"""
-    def __init__(self, uuid):
-        self.uuid = uuid
-
-
-# Fetch and parse data class
-class GetRRDUdpates:
-    """ Object used to get and parse the output the http://host/rrd_udpates?..."""
-    def __init__(self):
-        # rrdParams are what get passed to the CGI executable in the URL
-        self.rrdParams = dict()
-        self.rrdParams['start'] = int(time.time()) - 10
-        self.rrdParams['host'] = 'true'   # include data for host (as well as for VMs)
-        self.rrdParams['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
-        self.rrdParams['interval'] = '10'
-
-    def GetRows(self):
-        return self.rows
-
-    def GetVMList(self):
-        return self.vm_reports.keys()
-
-    def GetVMParamList(self, uuid):
-        report = self.vm_reports[uuid]
-        if not report:
-            return []
-        return report.keys()
-
-    def GetVMData(self, uuid, param, row):
-        report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
-
-    def GetHostUUID(self):
-        report = self.host_report
-        if not report:
-            return None
-        return report.uuid
-
-    def GetHostParamList(self):
-        report = self.host_report
-        if not report:
-            return []
-        return report.keys()
-
-    def GetHostData(self, param, row):
-        report = self.host_report
-        col = report[param]
-        return self.__lookup_data(col, row)
-
-    def GetRowTime(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col+1]
-        return float(node.firstChild.toxml()) # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml()) # node.firstChild should have nodeType TEXT_NODE
-
-    def Refresh(self, session, override_rrdParams = {}, server = 'http://localhost'):
-        rrdParams = dict(self.rrdParams)
-        rrdParams.update(override_rrdParams)
-        rrdParams['host'] = "true"
-        rrdParams['session_id'] = session
-        rrdParamstr = "&".join(["%s=%s"  % (k,rrdParams[k]) for k in rrdParams])
-        url = "%s/rrd_updates?%s" % (server, rrdParamstr)
-
-        if verboselog:
-            verboselog.info("Query: %s" % url)
-
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-        sock = urllib.URLopener().open(url)
-        xmlsource = sock.read()
-        sock.close()
-
-        #myFile = open('debug.xml','w')
-        #myFile.write(xmlsource)
-        #myFile.close()
-
-        xmldoc = minidom.parseString(xmlsource)
-        self.__parse_xmldoc(xmldoc)
-        # Update the time used on the next run
-        self.rrdParams['start'] = self.end_time + 1 # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def LookupMetadataBytag(name):
-            return int (self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-
-        # rows = number of samples per variable
-        # columns = number of variables
-        self.rows = LookupMetadataBytag('rows')
-        self.columns = LookupMetadataBytag('columns')
-
-        # These indicate the period covered by the data
-        self.start_time = LookupMetadataBytag('start')
-        self.step_time  = LookupMetadataBytag('step')
-        self.end_time   = LookupMetadataBytag('end')
-        if verboselog:
-            verboselog.info("start_time:%s, step_time:%s, end_time:%s", self.start_time, self.step_time, self.end_time)
-
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
-
-        # vm_reports matches uuid to per VM report
-        self.vm_reports = {}
-
-        # There is just one host_report and its uuid should not change!
-        self.host_report = None
-
-        # Handle each column.  (I.e. each variable)
-        for col in range(self.columns):
-            self.__handle_col(col)
-
-    def __handle_col(self, col):
-        # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
-
-        # vmOrHost will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
-        (cf, vmOrHost, uuid, param) = col_meta_data.split(':')
-
-        if vmOrHost == 'vm':
-            # Create a report for this VM if it doesn't exist
-            if not self.vm_reports.has_key(uuid):
-                self.vm_reports[uuid] = VMReport(uuid)
-
-            # Update the VMReport with the col data and meta data
-            vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
-
-        elif vmOrHost == 'host':
-            # Create a report for the host if it doesn't exist
-            if not self.host_report:
-                self.host_report = HostReport(uuid)
-            elif self.host_report.uuid != uuid:
-                raise Exception, "Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid)
-
-            # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
-
-        else:
-            raise Exception, "Invalid string in <legend>: %s" % col_meta_data
-
 class xenserverPlugin(Plugin):
-    def __init__(self, host=None, user="root", passwd="", verbose=False):
+    def __init__(self, host=None, user="root", passwd="", verbose=False, self_metrics=False, metric_filter=None,
+                 graph_host=True, vm_uuids=None, interval=5, cf="AVERAGE", backfill=False, backfill_max_rows=60,
+                 state_file=None, state_names=True, state_names_max_age=3600, timeout=10):
         self.host = host
         self.user = user
         self.passwd = passwd
@@ -337,85 +40,217 @@ class xenserverPlugin(Plugin):
         self.hostinfo = {}
         self.hostname = None
         self.__verbose = verbose # Set to true to make your logs really fat
-        self.graphHost = True
-        self.xApiIterCpt = 0
-        self.xApiDefaultIterCpt = 60 # Reconnect the API every X polls
+        self.graphHost = graph_host
+        self.sessionMaxAge = 3600 # Login again once the session is older than this
+        self.timeout = timeout # Seconds an XAPI call may take before it fails, a hung xapi does not block the loop
+        self.sessionTime = 0
+        self.cycleTime = None # seconds taken by the last prepare_data()
+        self.selfMetrics = self_metrics # Add the timings of each cycle as Xenserver_collector metrics
+        self.cycle = {} # seconds taken by each phase of the last Read()
+        self.sendTime = None # seconds taken by the last send to carbon, set by send_and_log()
+        self.schedulerStats = None # Scheduler.get_stats() of the loop, set by the loop
+        self.metricFilter = metric_filter # MetricFilter of the legend entries, None keeps them all
+        self.vmUUIDs = vm_uuids # Only fetch these VMs, with one vm_uuid= query each (see RRDSelection)
+        self.backfill = backfill # Send every row fetched, not only the newest one
+        self.backfillMaxRows = backfill_max_rows # Rows fetched and sent at most per cycle with backfill
+        self.stateFile = None # StateFile the cursor (and names) are saved to after each cycle
+        if state_file:
+            self.stateFile = StateFile(state_file)
+        self.stateNames = state_names # Save the uuid to name cache in the stateFile too
+        self.stateNamesMaxAge = state_names_max_age # Seconds the saved names spare the enumeration at login
+        self.savedCursor = None # rrd_updates cursor loaded from the stateFile
+        self.savedHighWater = None # backfill high water (per VM query) loaded from the stateFile
+        self.namesRestored = 0 # Time the names loaded from the stateFile were enumerated
+        self.namesTime = 0 # Time the names were enumerated last
         self.rrdParams = {}
-        self.rrdParams['cf'] = "AVERAGE"
-        self.rrdParams['start'] = int(time.time()) - 10
-        self.rrdParams['interval'] = 5
-        self.uuid_name_map={} # translate uuid to vm name
+        self.rrdParams['cf'] = cf
+        # 'start' is left to GetRRDUdpates, which moves it after each refresh
+        self.rrdParams['interval'] = interval
+        if not self.graphHost:
+            # xapi leaves the host columns out of the xml
+            self.rrdParams['host'] = 'false'
+        self.uuid_name_map = MetadataCache('hostname', '_control-domain') # translate uuid to vm name
         self.data = []
         if self.__verbose:
             self.log = verbose
+        self._RestoreState()
         self.Connect()
 
     def prepare_data(self):
+        t1 = time.time()
         self.data = []
         self.Read()
+        self.cycleTime = time.time() - t1
+        self._LogVerbose("Read %s metrics in %.3fs" % (len(self.data), self.cycleTime))
+        self._SaveState()
+        if self.selfMetrics:
+            self._AddSelfMetrics()
         return self.data
 
+    def _AddSelfMetrics(self):
+        ''' Add the timings and sizes of the last cycle to self.data, under Xenserver_collector.<hostname> '''
+        name = 'Xenserver_collector.%s' % str(self.hostname or self.host or 'localhost').replace('.', '_')
+        cycle = dict(self.cycle)
+        cycle['cycle_time'] = self.cycleTime
+        cycle['metrics'] = len(self.data)
+        # the send of this cycle comes after, report the one of the previous cycle
+        if self.sendTime is not None:
+            cycle['send_time'] = self.sendTime
+        if self.schedulerStats is not None:
+            cycle['scheduler_lag'] = self.schedulerStats['lag']
+            cycle['scheduler_skipped'] = self.schedulerStats['skipped']
+        for key, value in cycle.iteritems():
+            self.data.append(GraphiteData(endpoint=name, metric=name, type=key, step=self.rrdParams['interval'], value=value, timestamp=self.timestamp))
+
+    def _RestoreState(self):
+        ''' Resume the rrd_updates cursor, and the names, saved by a previous run '''
+        if self.stateFile is None:
+            return
+        state = self.stateFile.Load()
+        saved = state.get('hosts', {}).get(self.host or 'localhost')
+        if not saved:
+            return
+        self.savedCursor = saved['cursor']
+        self.savedHighWater = saved.get('high_water', 0)
+        if self.stateNames and 'names' in state:
+            self.uuid_name_map.Restore(state['names'])
+            self.namesRestored = saved.get('names_time', 0)
+        self._LogVerbose("State loaded from %s: cursor %s" % (self.stateFile.path, self.savedCursor))
+
+    def _SaveState(self):
+        ''' Write the rrd_updates cursor, and the names, to the StateFile '''
+        if self.stateFile is None:
+            return
+
+        def update(state):
+            # keep the other hosts of the file, and their names
+            hosts = state.get('hosts', {})
+            hosts[self.host or 'localhost'] = {'cursor': self.hostinfo['rrdupdates'].GetCursor(),
+                                              'high_water': self.hostinfo['rrdupdates'].GetHighWater(),
+                                              'names_time': self.namesTime}
+            saved = {'hosts': hosts}
+            if self.stateNames:
+                names = MetadataCache()
+                names.Restore(state.get('names', {}))
+                names.Restore(self.uuid_name_map.Dump())
+                saved['names'] = names.Dump()
+            return saved
+        try:
+            self.stateFile.Update(update)
+        except (IOError, OSError), e:
+            sys.stderr.write("xenserverPlugin: saving the state to %s failed: %s\n" % (self.stateFile.path, e))
+
     def Connect(self):
         ''' This is called at the startup of Collectd '''
         # Called at startup
 
         if self.host is None:
-            self.hostinfo['session'] = XenAPI.xapi_local()  #no __nonzero__, can not use if/not for bool test
-            self.url = "http://localhost"
+            self.hostinfo['session'] = XenAPI.xapi_local(timeout=self.timeout)  #no __nonzero__, can not use if/not for bool test
+            # fetch rrd_updates over the xapi unix socket too, no tcp loopback
+            self.url = "http://_var_xapi_xapi"
         else:
             self.url = "http://" + str(self.host)
-            self.hostinfo['session'] = XenAPI.Session(self.url)
+            self.hostinfo['session'] = XenAPI.Session(self.url, timeout=self.timeout)
         self._LogVerbose("Conntct to url: %s" %(self.url))
-        self.hostinfo['rrdupdates'] = GetRRDUdpates()
-        self.hostinfo['session'].xenapi.login_with_password(self.user, self.passwd)
-        # host name, uuid translation
-        host_ref = self.hostinfo['session'].xenapi.host.get_all()[0]
-        uuid = self.hostinfo['session'].xenapi.host.get_uuid(host_ref)
-        server_name = self.hostinfo['session'].xenapi.host.get_hostname(host_ref)
-        self.uuid_name_map[uuid] = server_name
-        self.hostname = server_name
-        # VM name, uuid translation
-        vm_refs_list = self.hostinfo['session'].xenapi.VM.get_all()
-        for vm_ref in vm_refs_list:
-            vm_uuid = self.hostinfo['session'].xenapi.VM.get_uuid(vm_ref)
-            vm_name = self.hostinfo['session'].xenapi.VM.get_name_label(vm_ref)
-            if self.hostinfo['session'].xenapi.VM.get_is_control_domain(vm_ref):
-                self.uuid_name_map[vm_uuid] = server_name + "_control-domain"
+        # keep the rrd_updates cursor across sessions
+        if 'rrdupdates' not in self.hostinfo:
+            if self.vmUUIDs:
+                self.hostinfo['rrdupdates'] = RRDSelection(self.vmUUIDs, self.metricFilter)
             else:
-                self.uuid_name_map[vm_uuid] = vm_name
+                self.hostinfo['rrdupdates'] = GetRRDUdpates(self.metricFilter)
+            if self.savedCursor is not None:
+                self.hostinfo['rrdupdates'].SetCursor(self.savedCursor)
+            if self.savedHighWater is not None:
+                self.hostinfo['rrdupdates'].SetHighWater(self.savedHighWater)
+        self.hostinfo['session'].xenapi.login_with_password(self.user, self.passwd)
+        self.sessionTime = time.time()
+        # host and VM name, uuid translation, unless the names saved in the StateFile are fresh enough
+        restored = self.namesRestored
+        self.namesRestored = 0
+        host_ref = self.hostinfo['session'].xenapi.session.get_this_host(self.hostinfo['session'].handle)
+        self.hostname = None
+        if time.time() - restored <= self.stateNamesMaxAge:
+            self.namesTime = restored
+            self.hostname = self.uuid_name_map.GetRefName(host_ref)
+        if self.hostname is None:
+            self.uuid_name_map.Load(self.hostinfo['session'])
+            self.namesTime = time.time()
+            self.hostname = self.uuid_name_map.GetRefName(host_ref)
 
     def Read(self):
         ''' This is called by Collectd every $Interval seconds '''
 
         # If the connection is gone, reconnect
+        t1 = time.time()
         if self.hostinfo['session'] is None:
             self.Connect()
-
-        # Dirt fix: Reconnect every x reads to prevent unhandled api session timeout.
-        self.xApiIterCpt += 1
-        if self.xApiIterCpt > self.xApiDefaultIterCpt:
+        elif time.time() - self.sessionTime > self.sessionMaxAge:
             self.Shutdown()
             self.Connect()
-            self.xApiIterCpt = 0
+        login_time = time.time() - t1
 
         self._LogVerbose("Read session and handle: %s, %s" % (self.hostinfo['session'], self.hostinfo['session'].handle))
         # Fetch the new http://host/rrd_update?.. and parse the new data
-        self.hostinfo['rrdupdates'].Refresh(self.hostinfo['session'].handle, self.rrdParams, self.url)
+        if self.backfill:
+            self.hostinfo['rrdupdates'].LimitStart(time.time() - self.backfillMaxRows * int(self.rrdParams['interval']))
+        try:
+            self.hostinfo['rrdupdates'].Refresh(self.hostinfo['session'].handle, self.rrdParams, self.url)
+        except IOError, e:
+            # http 401: xapi does not know the session anymore (SESSION_INVALID), login again and retry once
+            if len(e.args) < 2 or e.args[1] != 401:
+                raise
+            t1 = time.time()
+            self.Shutdown()
+            self.Connect()
+            login_time += time.time() - t1
+            self.hostinfo['rrdupdates'].Refresh(self.hostinfo['session'].handle, self.rrdParams, self.url)
+        self._LogVerbose("rrd_updates: %s" % self.hostinfo['rrdupdates'].GetHttpStats())
+        self.cycle = dict(self.hostinfo['rrdupdates'].GetRefreshStats())
+        self.cycle['login_time'] = login_time
+        if self.metricFilter is not None:
+            self._LogVerbose("%s columns kept, %s dropped by the metric filter" % (self.cycle['columns'], self.cycle['dropped']))
+        if self.vmUUIDs:
+            for (uuid, error) in self.hostinfo['rrdupdates'].GetFailed():
+                self._LogVerbose("rrd_updates of VM %s failed, left out: %s" % (uuid, error))
         # the timestamp only reachable after Refresh
         self.timestamp = self.hostinfo['rrdupdates'].end_time
-
-        # If the option is set, process the host mectrics data
-        if self.graphHost:
-            isHost = True
-            uuid = self.hostinfo['rrdupdates'].GetHostUUID()
-            mectricsData = self._GetRows(uuid, isHost)
-            self._ToCollectd(uuid, mectricsData, isHost)
-
-        # Process all row w've found so far for each vm
-        for uuid in self.hostinfo['rrdupdates'].GetVMList():
-            isHost = False
-            mectricsData = self._GetRows(uuid, isHost)
-            self._ToCollectd(uuid, mectricsData, isHost)
+        t1 = time.time()
+        if self.backfill:
+            # every row newer than the last one sent, by each query
+            windows = self.hostinfo['rrdupdates'].GetNewRows(self.backfillMaxRows)
+        else:
+            # values of the newest row, for the host and every vm
+            (rowTime, hostData, vmData) = self.hostinfo['rrdupdates'].GetLatestSnapshot()
+            windows = [(None, hostData, vmData)]
+        hostUUID = self.hostinfo['rrdupdates'].GetHostUUID()
+        t2 = time.time()
+        # name the VMs created since the login, without enumerating all of them again
+        uuids = [hostUUID]
+        for (timestamps, hostData, vmData) in windows:
+            uuids.extend(vmData.keys())
+        self.uuid_name_map.Resolve(self.hostinfo['session'], uuids)
+        t3 = time.time()
+        rows_time = 0.0
+
+        for (timestamps, hostData, vmData) in windows:
+            # If the option is set, process the host mectrics data
+            if self.graphHost:
+                isHost = True
+                mectricsData = self._GetRows(hostData, timestamps)
+                self._ToCollectd(hostUUID, mectricsData, isHost, timestamps)
+
+            # Process the rows w've found for each vm
+            for uuid, values in vmData.iteritems():
+                isHost = False
+                t4 = time.time()
+                mectricsData = self._GetRows(values, timestamps)
+                rows_time += time.time() - t4
+                self._ToCollectd(uuid, mectricsData, isHost, timestamps)
+
+        self.cycle['select_time'] = t2 - t1
+        self.cycle['resolve_time'] = t3 - t2
+        self.cycle['rows_time'] = rows_time
+        self.cycle['render_time'] = time.time() - t3 - rows_time
 
     def Shutdown(self):
         ''' Disconnect all the active sessions - This is called by Collectd on SIGTERM '''
@@ -426,8 +261,11 @@ class xenserverPlugin(Plugin):
         except Exception:
             pass
 
-    def _ToCollectd(self, uuid, metricsData, isHost):
-        ''' This is where the metrics are sent to Collectd '''
+    def _ToCollectd(self, uuid, metricsData, isHost, timestamps=None):
+        '''
+        This is where the metrics are sent to Collectd: one value per metric, or one per
+        timestamp from the columns of a backfill window
+        '''
         if isHost:
             if uuid in self.uuid_name_map:
                 vmid = 'Xenserver_host_%s' % (self.uuid_name_map[uuid])
@@ -442,6 +280,10 @@ class xenserverPlugin(Plugin):
         for key, value in metricsData.iteritems():
             # host / plugin - instance / type - instance
             # 'PUTVAL "%s/%s/%s" interval=%s N:%s'
+            if timestamps is not None:
+                for (timestamp, row_value) in zip(timestamps, value):
+                    self.data.append(GraphiteData(endpoint=vmid, metric=vmid, type=key, step=self.rrdParams['interval'], value=row_value, timestamp=timestamp))
+                continue
             self.data.append(GraphiteData(endpoint=vmid, metric=vmid, type=key, step=self.rrdParams['interval'], value=value, timestamp=self.timestamp))
             # type = 'gauge'
             # cltd.host =  vmid #'xenservers' # xenservers/
@@ -453,26 +295,16 @@ class xenserverPlugin(Plugin):
 
             #self._LogVerbose('Dispatch() data from %s: %s/%s/%s/%s' % (self.hostname, vmid, vmid, key, value))
 
-    def _GetRows(self, uuid, isHost):
+    def _GetRows(self, values, timestamps=None):
+        '''
+        Format the param values of a GetLatestSnapshot() row as metrics data. The columns
+        of a backfill window (timestamps set) are sent as they are
+        '''
+        if timestamps is not None:
+            return values
         result = {}
-        if isHost:
-            paramList = self.hostinfo['rrdupdates'].GetHostParamList()
-        else:
-            paramList = self.hostinfo['rrdupdates'].GetVMParamList(uuid)
-        for param in paramList:
-            if param != '':
-                max_time=0
-                data=''
-                for row in range(self.hostinfo['rrdupdates'].GetRows()):
-                    epoch = self.hostinfo['rrdupdates'].GetRowTime(row)
-                    if isHost:
-                        dv = str(self.hostinfo['rrdupdates'].GetHostData(param, row))
-                    else:
-                        dv = str(self.hostinfo['rrdupdates'].GetVMData(uuid, param, row))
-                    if epoch > max_time:
-                        max_time = epoch
-                        data = dv
-                result[param] = data
+        for param, value in values.iteritems():
+            result[param] = str(value)
         return result
 
     def _LogVerbose(self, msg):
@@ -483,6 +315,41 @@ class xenserverPlugin(Plugin):
 
 
 
+def send_and_log(plugin, server, port, carbon):
+    t1 = time.time()
+    plugin.send_to_carbon(server, port, carbon)
+    # reported with the self metrics of the next cycle
+    plugin.sendTime = time.time() - t1
+    if verboselog:
+        verboselog.info("Carbon client: %s", carbon.get_stats())
+
+
+def run_daemon(make_plugin, work, scheduler):
+    '''
+    Call work(plugin) on every tick of scheduler, keeping the same plugin (its session and
+    its rrd_updates cursor) across the loops. The plugin is only rebuilt after a failure.
+    '''
+    plugin = None
+    while True:
+        scheduler.wait()
+        t1 = time.time()
+        try:
+            if plugin is None:
+                plugin = make_plugin()
+            plugin.schedulerStats = scheduler.get_stats()
+            work(plugin)
+            sys.stdout.flush()
+        except Exception, e:
+            sys.stderr.write("xenserverPlugin failed, it is rebuilt on the next loop: %s\n" % e)
+            if verboselog:
+                verboselog.exception("xenserverPlugin failed")
+            if plugin is not None:
+                plugin.Shutdown()
+            plugin = None
+        if verboselog:
+            verboselog.info("Cycle took %.3fs, scheduler: %s", time.time() - t1, scheduler.get_stats())
+
+
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option('--console', dest="console", action="store_true", help="print the data to console")
@@ -492,8 +359,43 @@ if __name__ == "__main__":
     parser.add_option("-p", "--passwd", dest="passwd", help="Passward for host server")
     parser.add_option("--server", dest="server", help="Carbon server ip")
     parser.add_option("--port", dest="port", help="Port on carbon server")
+    parser.add_option("--protocol", dest="protocol", default="plaintext", choices=["plaintext", "pickle"],
+                      help="Carbon protocol: plaintext (port 2003) or pickle (port 2004)")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=500, help="Metrics per pickle batch")
+    parser.add_option("--spool-dir", dest="spool_dir", help="Spool the metrics on disk there while carbon is unreachable")
+    parser.add_option("--spool-size", dest="spool_size", type="int", default=100, help="Size limit of the spool, in MB")
+    parser.add_option("--replay-rate", dest="replay_rate", type="int", default=1000, help="Spooled metrics replayed per second")
+    parser.add_option("--timeout", dest="timeout", type="float", default=10,
+                      help="Seconds an XAPI call may take before the loop gives up on it")
     parser.add_option("--step", dest="step", help="Time interval to send data")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.0,
+                      help="Spread the hosts over this many seconds after each step boundary, by host")
     parser.add_option("--verbose", dest="verbose", action="store_true", help="Record log to console and /var/log/graphitePlugin.log")
+    parser.add_option("--daemon", dest="daemon", action="store_true", help="Keep the session and the rrd_updates cursor across the loops")
+    parser.add_option("--self-metrics", dest="self_metrics", action="store_true",
+                      help="Add the login, fetch, parse, render and send times of each cycle as Xenserver_collector metrics")
+    parser.add_option("--allow", dest="allow", action="append", default=[],
+                      help="Only send the legend entries (cf:vm|host:uuid:param) matching this glob, or regex with a re: prefix. Repeatable")
+    parser.add_option("--deny", dest="deny", action="append", default=[],
+                      help="Never send the legend entries matching this glob, or regex with a re: prefix. Repeatable")
+    parser.add_option("--vm", dest="vm_uuids", action="append", default=[],
+                      help="Only fetch the VM of this uuid, one rrd_updates query per VM run concurrently. Repeatable")
+    parser.add_option("--no-host", dest="graph_host", action="store_false", default=True,
+                      help="Leave the host metrics out, host=false is asked to xapi")
+    parser.add_option("--interval", dest="interval", type="int", default=5,
+                      help="rrd_updates interval: 5, 60, 3600 or 86400 seconds per sample")
+    parser.add_option("--cf", dest="cf", default="AVERAGE", choices=["AVERAGE", "MIN", "MAX"],
+                      help="rrd_updates consolidation function: AVERAGE, MIN or MAX")
+    parser.add_option("--backfill", dest="backfill", action="store_true",
+                      help="Send every row fetched with its own timestamp, not only the newest one. Use with --daemon")
+    parser.add_option("--backfill-max-rows", dest="backfill_max_rows", type="int", default=60,
+                      help="Rows fetched and sent at most per cycle with --backfill")
+    parser.add_option("--state-file", dest="state_file",
+                      help="Save the rrd_updates cursor and the names there after each cycle, to resume from at startup")
+    parser.add_option("--state-no-names", dest="state_names", action="store_false", default=True,
+                      help="Do not save the uuid to name cache in the --state-file")
+    parser.add_option("--state-names-max-age", dest="state_names_max_age", type="int", default=3600,
+                      help="Seconds the saved names spare the VM enumeration at startup")
     (options, args) = parser.parse_args()
 
     host_name = options.host
@@ -523,11 +425,29 @@ if __name__ == "__main__":
         file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(logging.Formatter("%(asctime)s|%(levelname)-7s|%(name)s|%(filename)-20s%(lineno)4d : %(message)s"))
         verboselog.addHandler(file_handler)
+        xenserver_common.log = verboselog.info
     else:
         verboselog = None
 
+    # compiled once, the columns left out are never stored nor sent
+    metric_filter = None
+    if options.allow or options.deny:
+        metric_filter = MetricFilter(options.allow, options.deny)
+
+    def make_plugin():
+        return xenserverPlugin(host=host_name, user=user, passwd=passwd, verbose=verboselog,
+                               self_metrics=options.self_metrics, metric_filter=metric_filter,
+                               graph_host=options.graph_host, vm_uuids=options.vm_uuids,
+                               interval=options.interval, cf=options.cf,
+                               backfill=options.backfill, backfill_max_rows=options.backfill_max_rows,
+                               state_file=options.state_file, state_names=options.state_names,
+                               state_names_max_age=options.state_names_max_age, timeout=options.timeout)
+
+    # ticks aligned on the step boundaries, the ones a cycle overran are skipped
+    scheduler = Scheduler(step, jitter=options.jitter, key=str(host_name))
+
     if options.console:
-        xen_plugin = xenserverPlugin(host=host_name, user=user, passwd=passwd, verbose=verboselog)
+        xen_plugin = make_plugin()
         t1 = time.time()
         xen_plugin.console()
         t2 = time.time()
@@ -537,12 +457,15 @@ if __name__ == "__main__":
         t3=time.time()
         print t2-t1, t3-t2
     elif options.collectd_exec:
+        if options.daemon:
+            run_daemon(make_plugin, lambda plugin: plugin.report(), scheduler)
         while True:
-            xen_plugin = xenserverPlugin(host=host_name, user=user, passwd=passwd, verbose=verboselog)
+            scheduler.wait()
+            xen_plugin = make_plugin()
+            xen_plugin.schedulerStats = scheduler.get_stats()
             xen_plugin.report()
             sys.stdout.flush()
             xen_plugin.Shutdown()
-            time.sleep(step)
     else:
         if not options.server or not options.port:
             print "Please input a server an a port for socket to send data to carbon"
@@ -552,10 +475,18 @@ if __name__ == "__main__":
         except ValueError:
             print "Port need to be an integer"
             port = 2003
+        # one connection to carbon for the process
+        spool = None
+        if options.spool_dir:
+            spool = CarbonSpool(options.spool_dir, max_bytes=options.spool_size * 1024 * 1024, replay_rate=options.replay_rate)
+        carbon = CarbonClient(server, port, protocol=options.protocol, batch_size=options.batch_size, spool=spool)
+        if options.daemon:
+            run_daemon(make_plugin, lambda plugin: send_and_log(plugin, server, port, carbon), scheduler)
         while True:
+            scheduler.wait()
             # The inital should put in the while so that each loop will generate a new time
-            xen_plugin = xenserverPlugin(host=host_name, user=user, passwd=passwd, verbose=verboselog)
-            xen_plugin.send_to_carbon(server, port)
+            xen_plugin = make_plugin()
+            xen_plugin.schedulerStats = scheduler.get_stats()
+            send_and_log(xen_plugin, server, port, carbon)
             sys.stdout.flush()
             xen_plugin.Shutdown()
-            time.sleep(step)
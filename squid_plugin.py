@@ -8,125 +8,10 @@
 
 from optparse import OptionParser
 import time
+import sys
 import socket
 import subprocess
-
-
-class Plugin(object):
-    '''
-    The base class for plugins
-    All you need is just to extend it, overwrite prepare_data() method,
-    and call report() method in __main__.
-    '''
-    def report(self):
-        '''
-        Report your prepared_data() to destination system
-        '''
-        data = self.prepare_data()
-        self._report_to_graphite(data)
-
-    def console(self):
-        '''
-        Show the data to the cluster administrators
-        '''
-        data = self.prepare_data()
-        self._report_to_console(data)
-
-    def send_to_carbon(self, server, port):
-        """
-        :return:
-        """
-        CARBON_SERVER = server
-        CARBON_PORT = port
-
-        data = self.prepare_data()
-        data_format = '%s.%s.%s %s %s'
-        sock = socket.socket()
-        sock.connect((CARBON_SERVER, CARBON_PORT))
-        for item in data:
-            data_map = item.format_data()
-            message = data_format % (data_map["endpoint"],
-                                     data_map["metric"],
-                                     data_map["type"],
-                                     data_map["value"],
-                                     data_map["timestamp"])
-            sock.sendall(message + "\n") # need to add "\n", otherwise it will give warning: unfinished line
-        sock.close()
-
-    def prepare_data(self):
-        '''
-        Prepare your data. Return a list of DataItem(or its subclass) instances
-        '''
-        raise NotImplementedError
-
-    def _report_to_graphite(self, data):
-        data_format = 'PUTVAL "%s/%s/%s" interval=%s N:%s'
-        for item in data:
-            data_map = item.format_data()
-            print( data_format % (data_map["endpoint"], data_map["metric"],
-                                 data_map["type"], data_map["step"],
-                                 data_map["value"]))
-
-    def _report_to_console(self, data):
-        data_format = '%s.%s.%s %s %s' #'metric:%s type:%s value:%s timestamp:%s'
-        for item in data:
-            data_map = item.format_data()
-            #print data_format % (data_map["endpoint"], data_map["metric"], val)
-            print( data_format % (data_map["endpoint"],
-                                 data_map["metric"],
-                                 data_map["type"],
-                                 data_map["value"],
-                                 data_map["timestamp"]))
-
-class DataItem(object):
-    '''
-    The base class of data items.
-    If new monitor system is applied, we should support both new and old data
-    format. So extend it and overwrite format_data() to satisfy new system, and
-    modify old subclasses to make it capatible for old plugins
-    '''
-
-    def format_data(self):
-        '''
-        Formatting the data, return a dict
-        '''
-        raise NotImplementedError()
-
-
-class GraphiteData(DataItem):
-    _metric = ""
-    _endpoint = ""
-    _value = ""
-    _step = ""
-    _type = ""
-
-    def __init__(self, endpoint, metric, type, step, value, timestamp=None):
-        '''
-        host/plugin-instance/type-instance
-        :param endpoint: host
-        :param metric: plugin-instance
-        :param type: type-instance
-        :param step: time interval
-        :param value:
-        '''
-        self._endpoint = endpoint
-        self._metric = metric
-        self._type = type
-        self._step = step
-        self._value = value
-        if timestamp is None:
-            timestamp = time.time()
-        self._timestamp = timestamp
-
-    def format_data(self):
-        return {
-            "metric": self._metric,
-            "endpoint": self._endpoint,
-            "value": self._value,
-            "step": self._step,
-            "type": self._type,
-            "timestamp": self._timestamp
-        }
+from graphite_common import Plugin, CarbonClient, CarbonSpool, Scheduler, GraphiteData
 
 
 class SquidPlugin(Plugin):
@@ -136,6 +21,12 @@ class SquidPlugin(Plugin):
         self.step = step
         self.data = []
 
+    def carbon_path(self, data_map):
+        '''
+        The squid metrics are kept apart per proxy: endpoint.metric.type
+        '''
+        return "%s.%s.%s" % (data_map["endpoint"], data_map["metric"], data_map["type"])
+
     def prepare_data(self ):
 
         self.data = []
@@ -173,7 +64,15 @@ if __name__ == "__main__":
     parser.add_option('--collectd-exec', dest="collectd_exec", action="store_true", help="use collectd-exec plugin")
     parser.add_option("--server", dest="server", help="Carbon server ip")
     parser.add_option("--port", dest="port", help="Port on carbon server")
+    parser.add_option("--protocol", dest="protocol", default="plaintext", choices=["plaintext", "pickle"],
+                      help="Carbon protocol: plaintext (port 2003) or pickle (port 2004)")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=500, help="Metrics per pickle batch")
+    parser.add_option("--spool-dir", dest="spool_dir", help="Spool the metrics on disk there while carbon is unreachable")
+    parser.add_option("--spool-size", dest="spool_size", type="int", default=100, help="Size limit of the spool, in MB")
+    parser.add_option("--replay-rate", dest="replay_rate", type="int", default=1000, help="Spooled metrics replayed per second")
     parser.add_option("--step", dest="step", help="Time interval to send data")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.0,
+                      help="Spread the hosts over this many seconds after each step boundary, by hostname")
 
     (options, args) = parser.parse_args()
     if options.step:
@@ -185,14 +84,24 @@ if __name__ == "__main__":
         step = 30
 
     squildPlugin = SquidPlugin(step=step)
+    # ticks aligned on the step boundaries, the ones a cycle overran are skipped
+    scheduler = Scheduler(step, jitter=options.jitter, key=socket.gethostname())
+
+    def wait():
+        skipped = scheduler.skipped
+        scheduler.wait()
+        if scheduler.skipped > skipped:
+            sys.stderr.write("squid_plugin: the last cycle overran the step, %d ticks skipped (lag %.3fs)\n"
+                             % (scheduler.skipped - skipped, scheduler.lag))
+
     if options.console:
         while 1:
+            wait()
             squildPlugin.console()
-            time.sleep(step)
     elif options.collectd_exec:
         while 1:
+            wait()
             squildPlugin.report()
-            time.sleep(step)
     elif (options.server and options.port):
         server = options.server
         try:
@@ -200,9 +109,13 @@ if __name__ == "__main__":
         except ValueError:
             print("Port need to be an integer, use default 2003")
             port = 2003
+        spool = None
+        if options.spool_dir:
+            spool = CarbonSpool(options.spool_dir, max_bytes=options.spool_size * 1024 * 1024, replay_rate=options.replay_rate)
+        carbon = CarbonClient(server, port, protocol=options.protocol, batch_size=options.batch_size, spool=spool)
         while 1:
-            squildPlugin.send_to_carbon(server, port)
-            time.sleep(step)
+            wait()
+            squildPlugin.send_to_carbon(server, port, carbon)
     else:
         parser.print_help()
 
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_carbon.py
+
+ Tests of the CarbonClient framing (plaintext and pickle) against a local TCP
+ listener standing for carbon, and of the CarbonSpool replay, eviction and resume.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from graphite_common import CarbonClient, CarbonSpool
+
+
+class CarbonListener(threading.Thread):
+    ''' Accept connections on a local port and keep all the bytes received on each of them '''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.received = [] # bytes of each connection, once closed by the client
+        self.done = threading.Condition()
+
+    def run(self):
+        while True:
+            try:
+                (conn, address) = self.sock.accept()
+            except socket.error:
+                return # closed by stop()
+            chunks = []
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            conn.close()
+            self.done.acquire()
+            try:
+                self.received.append("".join(chunks))
+                self.done.notifyAll()
+            finally:
+                self.done.release()
+
+    def wait(self, connections, timeout=5.0):
+        ''' Return the bytes of the first connections, once that many are closed '''
+        deadline = time.time() + timeout
+        self.done.acquire()
+        try:
+            while len(self.received) < connections and time.time() < deadline:
+                self.done.wait(deadline - time.time())
+            return list(self.received)
+        finally:
+            self.done.release()
+
+    def stop(self):
+        self.sock.close()
+
+
+def unused_port():
+    ''' Return a local port nothing listens on '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def decode_pickle(data):
+    ''' Return the list of the batches of a pickle protocol stream '''
+    batches = []
+    while data:
+        (length,) = struct.unpack("!L", data[:4])
+        batches.append(pickle.loads(data[4:4 + length]))
+        data = data[4 + length:]
+    return batches
+
+
+class CarbonClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = CarbonListener()
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def testPlaintext(self):
+        client = CarbonClient("127.0.0.1", self.listener.port, flush_count=1000, flush_interval=3600)
+        client.add("xen.host1.cpu0", 0.5, 1524485260)
+        client.add("xen.host1.memory", 1024, 1524485260)
+        client.add("xen.host1.cpu0", 0.25, 1524485270)
+        client.close()
+        self.assertEqual(self.listener.wait(1), ["xen.host1.cpu0 0.5 1524485260\n"
+                                                 "xen.host1.memory 1024 1524485260\n"
+                                                 "xen.host1.cpu0 0.25 1524485270\n"])
+        self.assertEqual(client.get_stats()["sent"], 3)
+        self.assertEqual(client.connects, 1)
+
+    def testPickleBatches(self):
+        client = CarbonClient("127.0.0.1", self.listener.port, flush_count=1000, flush_interval=3600,
+                              protocol="pickle", batch_size=2)
+        client.add("xen.host1.cpu0", "0.5", 1524485260)
+        client.add("xen.host1.memory", 1024, 1524485260)
+        client.add("xen.host1.state", "running", 1524485260)
+        client.close()
+        batches = decode_pickle(self.listener.wait(1)[0])
+        self.assertEqual(batches, [[("xen.host1.cpu0", (1524485260, 0.5)), ("xen.host1.memory", (1524485260, 1024.0))],
+                                   [("xen.host1.state", (1524485260, "running"))]])
+
+    def testFlushCount(self):
+        client = CarbonClient("127.0.0.1", self.listener.port, flush_count=2, flush_interval=3600)
+        client.add("a", 1, 10)
+        self.assertEqual(len(client.buffer), 1)
+        client.add("b", 2, 10)
+        self.assertEqual(client.buffer, [])
+        self.assertEqual(client.sent, 2)
+        client.close()
+
+    def testUnknownProtocol(self):
+        self.assertRaises(ValueError, CarbonClient, "127.0.0.1", self.listener.port, protocol="json")
+
+    def testDropWithoutSpool(self):
+        client = CarbonClient("127.0.0.1", unused_port(), flush_count=1000, flush_interval=3600, max_buffer=3)
+        for index in range(5):
+            client.add("a", index, 10 + index)
+        self.assertEqual(client.flush(), False)
+        self.assertEqual(client.buffer, [("a", 2, 12), ("a", 3, 13), ("a", 4, 14)])
+        self.assertEqual(client.dropped, 2)
+        client.close()
+        self.assertEqual(client.dropped, 5)
+
+
+class CarbonSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spoolDir = os.path.join(self.directory, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def items(self, count, start=0):
+        return [("xen.host1.m%d" % index, str(index), str(1524485260 + index)) for index in range(start, start + count)]
+
+    def testSpoolAndReplay(self):
+        listener = CarbonListener()
+        listener.start()
+        try:
+            spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+            client = CarbonClient("127.0.0.1", unused_port(), flush_count=1000, flush_interval=3600, spool=spool)
+            for (path, value, timestamp) in self.items(10):
+                client.add(path, value, timestamp)
+            self.assertEqual(client.flush(), False)
+            self.assertEqual(spool.pending(), True)
+            self.assertEqual(spool.get_stats()["spooled"], 10)
+            # carbon is back: new metrics go first, the spool follows oldest first
+            client.port = listener.port
+            client.next_retry = 0
+            spool.last_replay -= 1
+            for (path, value, timestamp) in self.items(2, 10):
+                client.add(path, value, timestamp)
+            client.close()
+            lines = listener.wait(1)[0].splitlines()
+        finally:
+            listener.stop()
+        expected = ["%s %s %s" % item for item in self.items(12)]
+        self.assertEqual(lines, expected[10:] + expected[:10])
+        self.assertEqual(spool.pending(), False)
+        self.assertEqual(spool.get_stats()["replayed"], 10)
+
+    def testReplayRate(self):
+        spool = CarbonSpool(self.spoolDir, replay_rate=100, max_burst=5)
+        spool.append(self.items(1000))
+        spool.last_replay -= 2
+        self.assertEqual(spool.budget(), 200)
+        (items, position) = spool.peek(spool.budget())
+        self.assertEqual(len(items), 200)
+        spool.consume(position)
+        self.assertEqual(spool.budget(), 0)
+        # the unused budget is kept up to max_burst seconds of replay_rate
+        spool.last_replay -= 3600
+        self.assertEqual(spool.budget(), 500)
+
+    def testEviction(self):
+        spool = CarbonSpool(self.spoolDir, max_bytes=1000, segment_bytes=1000)
+        for index in range(100):
+            spool.append(self.items(1, index))
+        stats = spool.get_stats()
+        self.assert_(stats["spool_bytes"] <= 1000)
+        self.assert_(stats["evicted"] > 0)
+        self.assert_(len(spool.segments) > 1)
+        # the oldest metrics are evicted, the newest are kept
+        left = self.readAll(spool)
+        self.assertEqual(left, self.items(100)[stats["evicted"]:])
+
+    def testResumeOffset(self):
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        spool.append(self.items(10))
+        (items, position) = spool.peek(4)
+        self.assertEqual(items, self.items(4))
+        spool.consume(position)
+        # a restart resumes after what was replayed
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        self.assertEqual(self.readAll(spool), self.items(6, 4))
+
+    def writeSegment(self, seq, data):
+        if not os.path.isdir(self.spoolDir):
+            os.makedirs(self.spoolDir)
+        segment = open(os.path.join(self.spoolDir, "%020d.spool" % seq), "wb")
+        try:
+            segment.write(data)
+        finally:
+            segment.close()
+
+    def testTornNewestSegment(self):
+        # a crash in the middle of append(): the torn line is cut at startup, not appended to
+        self.writeSegment(0, "a.b 1 100\na.c 2 1")
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        spool.append([("x.y", "5", "200")])
+        self.assertEqual(self.readAll(spool), [("a.b", "1", "100"), ("x.y", "5", "200")])
+        self.assertEqual(spool.pending(), False)
+
+    def testTornOnlyLine(self):
+        self.writeSegment(0, "a.c 2 1")
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        self.assertEqual(spool.pending(), False)
+        self.assertEqual(spool.get_stats()["spool_bytes"], 0)
+
+    def testTornOlderSegment(self):
+        # the torn line of a segment which is not the newest any more is skipped
+        self.writeSegment(0, "a.b 1 100\na.c 2 1")
+        self.writeSegment(1, "")
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        spool.append([("x.y", "5", "200")])
+        self.assertEqual(self.readAll(spool), [("a.b", "1", "100"), ("x.y", "5", "200")])
+        self.writeSegment(2, "a.d 3 1")
+        self.writeSegment(3, "x.z 6 300\n")
+        spool = CarbonSpool(self.spoolDir, replay_rate=1000000)
+        self.assertEqual(self.readAll(spool), [("x.z", "6", "300")])
+        self.assertEqual(spool.pending(), False)
+
+    def readAll(self, spool):
+        ''' Return every item left in spool, consuming them '''
+        (items, position) = spool.peek(1000000)
+        result = []
+        while items:
+            result.extend(items)
+            spool.consume(position)
+            (items, position) = spool.peek(1000000)
+        return result
+
+
+if __name__ == '__main__':
+    unittest.main()
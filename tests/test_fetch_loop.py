@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_fetch_loop.py
+
+ Tests of the non blocking HttpFetch / FetchLoop of collectd-xenserver.py (AsyncFetch)
+ against a local socket server writing its responses byte for byte: the framings
+ (Content-Length, chunked, close), the retry of a kept alive socket the server closed,
+ and the timeout of each request.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import time
+import socket
+import threading
+import unittest
+
+from collectd_plugin import plugin
+FetchLoop = plugin.FetchLoop
+
+
+class ScriptedServer(threading.Thread):
+    '''
+    Local http server answering each request with respond(conn, index), index counting the
+    requests received so far. The connection is kept open while respond returns True
+    '''
+
+    def __init__(self, respond):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.respond = respond
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.url = 'http://127.0.0.1:%d' % self.sock.getsockname()[1]
+        self.connections = 0
+        self.requests = [] # request lines and headers received
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                (conn, address) = self.sock.accept()
+            except socket.error:
+                return # closed by stop()
+            self.connections += 1
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def serve(self, conn):
+        data = ''
+        try:
+            while True:
+                while '\r\n\r\n' not in data:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        return
+                    data += chunk
+                (request, data) = data.split('\r\n\r\n', 1)
+                self.lock.acquire()
+                try:
+                    self.requests.append(request)
+                    index = len(self.requests) - 1
+                finally:
+                    self.lock.release()
+                if not self.respond(conn, index):
+                    return
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+
+def send_pieces(conn, data, cuts):
+    ''' Write data in several segments, cut at the offsets of cuts, for the client to receive them apart '''
+    start = 0
+    for end in list(cuts) + [len(data)]:
+        conn.sendall(data[start:end])
+        start = end
+        time.sleep(0.02)
+
+
+class FetchLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.results = []
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def start(self, respond):
+        self.server = ScriptedServer(respond)
+        self.server.start()
+
+    def callback(self, key, status, headers, body, error, elapsed):
+        self.results.append((key, status, headers, body, error, elapsed))
+
+    def fetch(self, loop, keys, timeout=2.0):
+        self.results = []
+        loop.Run([(key, self.server.url, '/rrd_updates?start=%s' % key) for key in keys], timeout, self.callback)
+        return self.results
+
+    def testContentLength(self):
+        def respond(conn, index):
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 5\r\nContent-Encoding: gzip\r\n\r\nhello')
+            return True
+        self.start(respond)
+        loop = FetchLoop()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'])
+        self.assertEqual((key, status, body, error), ('a', 200, 'hello', None))
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        request = self.server.requests[0].split('\r\n')
+        self.assertEqual(request[0], 'GET /rrd_updates?start=a HTTP/1.1')
+        self.assert_('Accept-Encoding: gzip' in request)
+        # the connection is kept for the next run
+        self.assertEqual(len(loop.idle[self.server.url]), 1)
+
+    def testContentLengthZero(self):
+        def respond(conn, index):
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+            return True
+        self.start(respond)
+        loop = FetchLoop()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'])
+        self.assertEqual((status, body, error), (200, '', None))
+        self.fetch(loop, ['b'])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(loop.GetStats()['requests'], 2)
+
+    def testChunkedSplit(self):
+        response = ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    '5\r\nhello\r\n'
+                    '7;name=value\r\n, world\r\n'
+                    '0\r\nX-Trailer: yes\r\n\r\n')
+        head = response.index('\r\n\r\n') + 4
+        # cut in the middle of the head, of a size line, of a chunk, of its CRLF and of the trailer
+        cuts = [10, head + 1, head + 5, head + 9, head + 13, head + 17, len(response) - 3]
+        def respond(conn, index):
+            send_pieces(conn, response, cuts)
+            return True
+        self.start(respond)
+        loop = FetchLoop()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'])
+        self.assertEqual((status, body, error), (200, 'hello, world', None))
+        # the trailer is read to the end: the connection is reusable
+        self.fetch(loop, ['b'])
+        self.assertEqual(self.results[0][3], 'hello, world')
+        self.assertEqual(self.server.connections, 1)
+
+    def testCloseFraming(self):
+        def respond(conn, index):
+            send_pieces(conn, 'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n<xport>', [])
+            send_pieces(conn, '</xport>', [])
+            return False
+        self.start(respond)
+        loop = FetchLoop()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'])
+        self.assertEqual((status, body, error), (200, '<xport></xport>', None))
+        self.assertEqual(loop.idle.get(self.server.url, []), [])
+
+    def testIdleSocketClosed(self):
+        # the server answers once then closes the connection it announced kept alive
+        def respond(conn, index):
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            return False
+        self.start(respond)
+        loop = FetchLoop()
+        self.fetch(loop, ['a'])
+        time.sleep(0.1)
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['b'])
+        self.assertEqual((key, status, body, error), ('b', 200, 'ok', None))
+        # retried once, on a new connection
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testNoRetryOnNewSocket(self):
+        # a new connection closed before any answer fails, it is not retried
+        def respond(conn, index):
+            return False
+        self.start(respond)
+        loop = FetchLoop()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'])
+        self.assertEqual(status, None)
+        self.assertNotEqual(error, None)
+        self.assertEqual(self.server.connections, 1)
+
+    def testTimeout(self):
+        def respond(conn, index):
+            time.sleep(2)
+            return False
+        self.start(respond)
+        loop = FetchLoop()
+        t1 = time.time()
+        [(key, status, headers, body, error, elapsed)] = self.fetch(loop, ['a'], timeout=0.3)
+        self.assert_(time.time() - t1 < 1.0)
+        self.assertEqual((key, status, error), ('a', None, 'timeout'))
+        self.assert_(0.25 <= elapsed < 1.0)
+        self.assertEqual(loop.GetStats()['timeouts'], 1)
+
+    def testTimeoutPerRequest(self):
+        # one request per server at a time: the second one starts once the first one timed
+        # out, and still gets the whole timeout
+        def respond(conn, index):
+            time.sleep(2)
+            return False
+        self.start(respond)
+        loop = FetchLoop(perServer=1)
+        results = self.fetch(loop, ['a', 'b'], timeout=0.3)
+        self.assertEqual([(key, error) for (key, status, headers, body, error, elapsed) in results],
+                         [('a', 'timeout'), ('b', 'timeout')])
+        for (key, status, headers, body, error, elapsed) in results:
+            self.assert_(0.25 <= elapsed < 1.0)
+
+    def testPerServerCap(self):
+        active = [0]
+        peak = [0]
+        def respond(conn, index):
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            time.sleep(0.1)
+            active[0] -= 1
+            conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            return True
+        self.start(respond)
+        loop = FetchLoop(perServer=3)
+        results = self.fetch(loop, range(9))
+        self.assertEqual(sorted([key for (key, status, headers, body, error, elapsed) in results]), range(9))
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(self.server.connections, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_rrd_fetch.py
+
+ Tests of the rrd_updates fetch over a unix socket, the path the plugins use on the
+ XenServer itself (server http://_var_xapi_xapi), against a stand-in xapi answering
+ /rrd_updates with example.xml on a socket of a temporary directory.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, TOP)
+from xenserver_common import GetRRDUdpates, RRDHttpClient
+
+
+class XapiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answer GET /rrd_updates with the document of the server, keeping the connection alive '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.document
+        gzipped = 'gzip' in (self.headers.getheader('accept-encoding') or '')
+        if self.server.gzip and gzipped:
+            buf = StringIO()
+            gz = gzip.GzipFile(fileobj=buf, mode='wb')
+            gz.write(body)
+            gz.close()
+            body = buf.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.gzip and gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no client address on a unix socket
+
+
+class XapiServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, document):
+        SocketServer.UnixStreamServer.__init__(self, path, XapiHandler)
+        self.document = document
+        self.paths = [] # paths of the requests received
+        self.status = 200
+        self.gzip = False
+
+
+class UnixSocketFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        # XenAPI.UDSHTTPConnection reads the '_' of the host as '/': no '_' in the socket path
+        self.directory = tempfile.mkdtemp(prefix='xapi', dir='/tmp')
+        while '_' in self.directory:
+            os.rmdir(self.directory)
+            self.directory = tempfile.mkdtemp(prefix='xapi', dir='/tmp')
+        path = os.path.join(self.directory, 'xapi')
+        example = open(os.path.join(TOP, 'example.xml'), 'rb')
+        try:
+            self.document = example.read()
+        finally:
+            example.close()
+        self.server = XapiServer(path, self.document)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://' + path.replace('/', '_')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def expected(self):
+        rrdupdates = GetRRDUdpates()
+        rrdupdates.Parse(StringIO(self.document))
+        return rrdupdates
+
+    def testRefresh(self):
+        rrdupdates = GetRRDUdpates()
+        rrdupdates.Refresh('OpaqueRef:1234', server=self.url)
+        expected = self.expected()
+        self.assertEqual(rrdupdates.GetHostUUID(), expected.GetHostUUID())
+        self.assertEqual(sorted(rrdupdates.GetVMList()), sorted(expected.GetVMList()))
+        self.assertEqual(rrdupdates.GetLatestSnapshot(), expected.GetLatestSnapshot())
+        # the next refresh starts after the last row returned
+        self.assertEqual(rrdupdates.GetCursor(), expected.end_time + 1)
+        path = self.server.paths[0]
+        self.assert_(path.startswith('/rrd_updates?'))
+        params = dict([param.split('=', 1) for param in path.split('?', 1)[1].split('&')])
+        self.assertEqual(params['session_id'], 'OpaqueRef:1234')
+        self.assertEqual(params['host'], 'true')
+
+    def testKeepAlive(self):
+        rrdupdates = GetRRDUdpates()
+        for index in range(3):
+            rrdupdates.Refresh('OpaqueRef:1234', server=self.url)
+        stats = rrdupdates.GetHttpStats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['bytes_received'], 3 * len(self.document))
+
+    def testGzip(self):
+        self.server.gzip = True
+        rrdupdates = GetRRDUdpates()
+        rrdupdates.Refresh('OpaqueRef:1234', server=self.url)
+        self.assertEqual(rrdupdates.GetLatestSnapshot(), self.expected().GetLatestSnapshot())
+        self.assert_(rrdupdates.GetHttpStats()['bytes_received'] < len(self.document))
+
+    def testHttpError(self):
+        self.server.status = 401
+        client = RRDHttpClient(self.url)
+        try:
+            client.Open('/rrd_updates?session_id=OpaqueRef:expired')
+        except IOError, e:
+            self.assertEqual(e.args[:2], ('http error', 401))
+        else:
+            self.fail('http 401 did not raise IOError')
+        client.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_rrd_parse.py
+
+ Tests of the streaming GetRRDUdpates parser against the minidom one it replaced:
+ MinidomRRDUpdates below is the parsing code of the plugins before, every value
+ read by both of them from example.xml and from generated documents must match.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+from array import array
+from StringIO import StringIO
+from xml.dom import minidom
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, TOP)
+from xenserver_common import GetRRDUdpates, MetricFilter
+from benchmark import generate_rrd_updates
+
+
+class MinidomRRDUpdates:
+    ''' The minidom parsing of the rrd_updates documents, as the plugins did it before the expat parser '''
+
+    def __init__(self, xmlsource):
+        xmldoc = minidom.parseString(xmlsource)
+        # The 1st node contains meta data (description of the data)
+        # The 2nd node contains the data
+        self.meta_node = xmldoc.firstChild.childNodes[0]
+        self.data_node = xmldoc.firstChild.childNodes[1]
+        self.rows = self.__LookupMetadataBytag('rows')
+        self.columns = self.__LookupMetadataBytag('columns')
+        self.start_time = self.__LookupMetadataBytag('start')
+        self.step_time = self.__LookupMetadataBytag('step')
+        self.end_time = self.__LookupMetadataBytag('end')
+        legend = self.meta_node.getElementsByTagName('legend')[0]
+        self.vm_reports = {}
+        self.host_uuid = None
+        self.host_report = {}
+        for col in range(self.columns):
+            (cf, vmOrHost, uuid, param) = legend.childNodes[col].firstChild.toxml().split(':')
+            if vmOrHost == 'vm':
+                self.vm_reports.setdefault(uuid, {})[param] = col
+            else:
+                self.host_uuid = uuid
+                self.host_report[param] = col
+
+    def __LookupMetadataBytag(self, name):
+        return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
+
+    def GetData(self, col, row):
+        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
+        return float(node.firstChild.toxml())
+
+    def GetRowTime(self, row):
+        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
+        return int(node.firstChild.toxml())
+
+
+class ParserTest(unittest.TestCase):
+
+    def parse(self, document, metric_filter=None):
+        rrdupdates = GetRRDUdpates(metric_filter)
+        rrdupdates.Parse(StringIO(document))
+        return rrdupdates
+
+    def checkDocument(self, document):
+        ''' Compare every value GetRRDUdpates reads from document with the minidom ones '''
+        reference = MinidomRRDUpdates(document)
+        rrdupdates = self.parse(document)
+        for name in ('rows', 'columns', 'start_time', 'step_time', 'end_time'):
+            self.assertEqual(getattr(rrdupdates, name), getattr(reference, name))
+        self.assertEqual(rrdupdates.GetHostUUID(), reference.host_uuid)
+        self.assertEqual(sorted(rrdupdates.GetHostParamList()), sorted(reference.host_report.keys()))
+        self.assertEqual(sorted(rrdupdates.GetVMList()), sorted(reference.vm_reports.keys()))
+        for row in range(reference.rows):
+            self.assertEqual(rrdupdates.GetRowTime(row), reference.GetRowTime(row))
+            for param, col in reference.host_report.items():
+                self.assertEqual(rrdupdates.GetHostData(param, row), reference.GetData(col, row))
+            for uuid, report in reference.vm_reports.items():
+                self.assertEqual(sorted(rrdupdates.GetVMParamList(uuid)), sorted(report.keys()))
+                for param, col in report.items():
+                    self.assertEqual(rrdupdates.GetVMData(uuid, param, row), reference.GetData(col, row))
+        return (rrdupdates, reference)
+
+    def testExample(self):
+        example = open(os.path.join(TOP, 'example.xml'), 'rb')
+        try:
+            document = example.read()
+        finally:
+            example.close()
+        (rrdupdates, reference) = self.checkDocument(document)
+        # the newest row, as the plugins send it
+        latest = reference.rows - 1
+        (timestamp, host_values, vm_values) = rrdupdates.GetLatestSnapshot()
+        self.assertEqual(timestamp, reference.GetRowTime(latest))
+        for param, col in reference.host_report.items():
+            self.assertEqual(host_values[param], reference.GetData(col, latest))
+        for uuid, report in reference.vm_reports.items():
+            for param, col in report.items():
+                self.assertEqual(vm_values[uuid][param], reference.GetData(col, latest))
+
+    def testGenerated(self):
+        for (vms, vm_metrics, rows) in ((0, 0, 1), (1, 3, 1), (20, 10, 12)):
+            self.checkDocument(generate_rrd_updates(vms, vm_metrics, rows))
+
+    def testRowsSince(self):
+        document = generate_rrd_updates(5, 4, 12)
+        reference = MinidomRRDUpdates(document)
+        rrdupdates = self.parse(document)
+        since = reference.GetRowTime(3)
+        [(timestamps, host_values, vm_values)] = rrdupdates.GetRowsSince(since, 6)
+        rows = range(reference.rows)[-6:]
+        self.assertEqual(timestamps, [reference.GetRowTime(row) for row in rows])
+        for param, col in reference.host_report.items():
+            self.assertEqual(list(host_values[param]), [reference.GetData(col, row) for row in rows])
+        for uuid, report in reference.vm_reports.items():
+            for param, col in report.items():
+                self.assertEqual(list(vm_values[uuid][param]), [reference.GetData(col, row) for row in rows])
+
+    def testMetricFilter(self):
+        document = generate_rrd_updates(3, 4, 2)
+        reference = MinidomRRDUpdates(document)
+        rrdupdates = self.parse(document, MetricFilter(allow=['*:vm:*'], deny=['re::cpu[13]$']))
+        self.assertEqual(rrdupdates.GetHostParamList(), [])
+        for uuid, report in reference.vm_reports.items():
+            self.assertEqual(sorted(rrdupdates.GetVMParamList(uuid)), ['cpu0', 'cpu2'])
+            for param in ('cpu0', 'cpu2'):
+                for row in range(reference.rows):
+                    self.assertEqual(rrdupdates.GetVMData(uuid, param, row), reference.GetData(report[param], row))
+
+    def testNothingKept(self):
+        # valid Allow/Deny patterns which match no legend entry of this host
+        document = generate_rrd_updates(3, 4, 5)
+        reference = MinidomRRDUpdates(document)
+        rrdupdates = self.parse(document, MetricFilter(allow=['*:vm:*:memory']))
+        self.assertEqual(rrdupdates.columns, 0)
+        self.assertEqual(rrdupdates.GetColumn(0), array('d'))
+        self.assertEqual(list(rrdupdates.GetTimestamps()), [reference.GetRowTime(row) for row in range(reference.rows)])
+        self.assertEqual(rrdupdates.GetLatestSnapshot(), (reference.GetRowTime(reference.rows - 1), {}, {}))
+        [(timestamps, host_values, vm_values)] = rrdupdates.GetRowsSince(0)
+        self.assertEqual((len(timestamps), host_values, vm_values), (5, {}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
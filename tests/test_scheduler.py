@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_scheduler.py
+
+ Tests of the Scheduler of the collection loops, driven by a fake clock: the ticks on
+ the wall clock multiples of step, the per host offset derived from the key, the
+ skipping of the ticks a long cycle overran, and the lag and skipped counts.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import os
+import sys
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import graphite_common
+from graphite_common import Scheduler
+
+
+class FakeClock:
+    ''' Stands for the time module in graphite_common: sleep() moves the clock, oversleeping by late seconds '''
+
+    def __init__(self, now):
+        self.now = now
+        self.late = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds + self.late
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1000000.3)
+        self.savedTime = graphite_common.time
+        graphite_common.time = self.clock
+
+    def tearDown(self):
+        graphite_common.time = self.savedTime
+
+    def testAlignedTicks(self):
+        scheduler = Scheduler(10)
+        self.assertEqual(scheduler.wait(), 1000010)
+        self.assertEqual(self.clock.now, 1000010)
+        # the cycle takes 3.5s, the next tick is still on the step boundary
+        self.clock.now += 3.5
+        self.assertEqual(scheduler.wait(), 1000020)
+        self.assertEqual([round(seconds, 6) for seconds in self.clock.sleeps], [9.7, 6.5])
+        self.assertEqual(scheduler.get_stats(), {'ticks': 2, 'skipped': 0, 'lag': 0.0, 'max_lag': 0.0})
+
+    def testJitterOffset(self):
+        key = 'xenserver-01.example.com'
+        offset = (zlib.crc32(key) & 0xffffffff) % 1000 / 1000.0 * 5
+        scheduler = Scheduler(10, jitter=5, key=key)
+        self.assertEqual(scheduler.offset, offset)
+        tick = scheduler.wait()
+        self.assertAlmostEqual((tick - offset) % 10, 0, 6)
+        self.assert_(1000000.3 < tick <= 1000010.3 + offset)
+        # the same host keeps its phase across restarts, the others are spread
+        self.assertEqual(Scheduler(10, jitter=5, key=key).offset, offset)
+        offsets = [Scheduler(10, jitter=5, key='host%d' % index).offset for index in range(50)]
+        self.assert_(len(set(offsets)) > 40)
+        self.assert_(min(offsets) >= 0 and max(offsets) < 5)
+        # the offset stays below the step
+        self.assert_(Scheduler(10, jitter=60, key=key).offset < 10)
+        self.assertEqual(Scheduler(10, jitter=0, key=key).offset, 0.0)
+
+    def testOverrunSkips(self):
+        scheduler = Scheduler(10)
+        self.assertEqual(scheduler.wait(), 1000010)
+        # the cycle ran 25.5s: the ticks of 1000020 and 1000030 are skipped, not run late
+        self.clock.now += 25.5
+        self.assertEqual(scheduler.wait(), 1000040)
+        self.assertEqual(scheduler.skipped, 2)
+        self.assertEqual(scheduler.wait(), 1000050)
+        self.assertEqual(scheduler.get_stats()['ticks'], 3)
+        self.assertEqual(scheduler.get_stats()['skipped'], 2)
+
+    def testLag(self):
+        scheduler = Scheduler(10)
+        self.clock.late = 0.25
+        scheduler.wait()
+        self.assertAlmostEqual(scheduler.lag, 0.25, 6)
+        self.clock.late = 0.1
+        scheduler.wait()
+        stats = scheduler.get_stats()
+        self.assertAlmostEqual(stats['lag'], 0.1, 6)
+        self.assertAlmostEqual(stats['max_lag'], 0.25, 6)
+
+    def testNextTime(self):
+        scheduler = Scheduler(60)
+        self.assertEqual(scheduler.next_time(1000000.3), 1000020)
+        self.assertEqual(scheduler.next_time(1000020), 1000080)
+
+
+if __name__ == '__main__':
+    unittest.main()
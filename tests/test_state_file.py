@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: test_state_file.py
+
+ Tests of the StateFile the collectors resume from after a restart: the atomic Save(),
+ the Load() of a missing, empty or corrupt file, and Update() keeping the hosts and
+ names of the other collectors sharing the file.
+ Run from the top directory: python -m unittest discover -s tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from collectd_plugin import plugin
+from xenserver_common import StateFile, GetRRDUdpates, RRDSelection
+
+
+class StateFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'xenserver.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        state_file = open(self.path, 'wb')
+        try:
+            state_file.write(data)
+        finally:
+            state_file.close()
+
+    def testRoundTrip(self):
+        state = {'hosts': {'10.0.0.1': {'cursor': 1524485261, 'high_water': {'vm-a': 1524485260}}},
+                 'names': {'names': {'vm-a': 'web1'}, 'refs': {'OpaqueRef:1': 'vm-a'}}}
+        StateFile(self.path).Save(state)
+        loaded = StateFile(self.path).Load()
+        self.assertEqual(loaded['hosts'], state['hosts'])
+        self.assertEqual(loaded['names'], state['names'])
+        self.assertEqual(loaded['version'], StateFile.version)
+        # the temporary file was renamed over the state
+        self.assertEqual(os.listdir(self.directory), ['xenserver.state'])
+
+    def testFailedSaveKeepsState(self):
+        state_file = StateFile(self.path)
+        state_file.Save({'hosts': {'a': {'cursor': 1}}})
+        # a lambda can not be pickled: the save fails half way
+        self.assertRaises(Exception, state_file.Save, {'hosts': {'a': {'cursor': lambda: 2}}})
+        self.assertEqual(state_file.Load()['hosts'], {'a': {'cursor': 1}})
+        self.assertEqual(os.listdir(self.directory), ['xenserver.state'])
+
+    def testMissingEmptyCorrupt(self):
+        self.assertEqual(StateFile(self.path).Load(), {})
+        self.write('')
+        self.assertEqual(StateFile(self.path).Load(), {})
+        self.write('\x80\x02}q\x01(U\x05hosts')
+        self.assertEqual(StateFile(self.path).Load(), {})
+        self.write('not a pickle at all\n')
+        self.assertEqual(StateFile(self.path).Load(), {})
+
+    def testOtherVersion(self):
+        StateFile(self.path).Save({'hosts': {'a': {'cursor': 1}}})
+        newer = StateFile(self.path)
+        newer.version = StateFile.version + 1
+        self.assertEqual(newer.Load(), {})
+
+    def testConcurrentWriters(self):
+        # several processes updating their own host through Update(): none is lost
+        writers = 4
+        pids = []
+        for index in range(writers):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    state_file = StateFile(self.path)
+                    for cursor in range(20):
+                        def update(state, cursor=cursor):
+                            hosts = state.get('hosts', {})
+                            hosts['host%d' % index] = {'cursor': cursor}
+                            return {'hosts': hosts}
+                        state_file.Update(update)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        hosts = StateFile(self.path).Load()['hosts']
+        self.assertEqual(hosts, dict([('host%d' % index, {'cursor': 19}) for index in range(writers)]))
+
+
+class CollectdStateTest(unittest.TestCase):
+    ''' The state of collectd-xenserver.py: two collectors sharing one file, then a restart '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'xenserver.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def collector(self, hostname, cursor, names):
+        reader = plugin.XenServerCollectd()
+        reader.stateFile = StateFile(self.path)
+        reader.hosts[hostname] = {'url': 'http://%s' % hostname, 'rrdupdates': GetRRDUdpates(), 'names_time': 100}
+        reader.hosts[hostname]['rrdupdates'].SetCursor(cursor)
+        reader.hosts[hostname]['rrdupdates'].SetHighWater(cursor - 1)
+        for (uuid, name) in names.items():
+            reader.uuid_name_map.UpdateVM('OpaqueRef:%s' % uuid, {'uuid': uuid, 'name_label': name,
+                                                                   'is_a_template': False, 'is_a_snapshot': False,
+                                                                   'is_control_domain': False})
+        return reader
+
+    def testSharedFile(self):
+        first = self.collector('10.0.0.1', 1000, {'vm-a': 'web1'})
+        second = self.collector('10.0.0.2', 2000, {'vm-b': 'db1'})
+        first._SaveState()
+        second._SaveState()
+        # the first one saves again: the host of the second one is kept
+        first.hosts['10.0.0.1']['rrdupdates'].SetCursor(1010)
+        first._SaveState()
+        state = StateFile(self.path).Load()
+        self.assertEqual(state['hosts']['10.0.0.1'], {'cursor': 1010, 'high_water': 999, 'names_time': 100})
+        self.assertEqual(state['hosts']['10.0.0.2'], {'cursor': 2000, 'high_water': 1999, 'names_time': 100})
+        self.assertEqual(state['names']['names'], {'vm-a': 'web1', 'vm-b': 'db1'})
+
+        # a restart resumes the cursor, the high water and the names
+        restarted = plugin.XenServerCollectd()
+        restarted.stateFile = StateFile(self.path)
+        restarted.savedState = restarted.stateFile.Load()
+        restarted.uuid_name_map.Restore(restarted.savedState['names'])
+        restarted.hosts['10.0.0.2'] = {'url': 'http://10.0.0.2', 'rrdupdates': GetRRDUdpates()}
+        restarted._RestoreHost('10.0.0.2')
+        self.assertEqual(restarted.hosts['10.0.0.2']['rrdupdates'].GetCursor(), 2000)
+        self.assertEqual(restarted.hosts['10.0.0.2']['rrdupdates'].GetHighWater(), 1999)
+        self.assertEqual(restarted.uuid_name_map['vm-a'], 'web1')
+
+    def testSelectionState(self):
+        # with vm_uuid= queries, the cursor and the high water are kept per VM
+        reader = plugin.XenServerCollectd()
+        reader.stateFile = StateFile(self.path)
+        selection = RRDSelection(['vm-a', 'vm-b'])
+        selection.SetCursor({'vm-a': 1000, 'vm-b': 900})
+        selection.SetHighWater({'vm-a': 999, 'vm-b': 899})
+        reader.hosts['10.0.0.1'] = {'url': 'http://10.0.0.1', 'rrdupdates': selection}
+        reader._SaveState()
+        restarted = plugin.XenServerCollectd()
+        restarted.savedState = StateFile(self.path).Load()
+        restarted.hosts['10.0.0.1'] = {'url': 'http://10.0.0.1', 'rrdupdates': RRDSelection(['vm-a', 'vm-b', 'vm-c'])}
+        restarted.hosts['10.0.0.1']['rrdupdates'].SetCursor(500)
+        restarted._RestoreHost('10.0.0.1')
+        self.assertEqual(restarted.hosts['10.0.0.1']['rrdupdates'].GetCursor(), {'vm-a': 1000, 'vm-b': 900, 'vm-c': 500})
+        self.assertEqual(restarted.hosts['10.0.0.1']['rrdupdates'].GetHighWater(), {'vm-a': 999, 'vm-b': 899, 'vm-c': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,909 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ File Name: xenserver_common.py
+ Author: longhui
+ Created Time: 2018-10-15 10:12:40
+
+ XAPI and rrd_updates code shared by collectd-xenserver.py, graphite_plugin.py and
+ collector_daemon.py: the uuid to name cache, the state file, the kept alive
+ rrd_updates http client, the legend filter and the rrd_updates parser. Deploy it
+ next to the plugins (the collectd ModulePath, or the directory of graphite_plugin.py).
+"""
+import XenAPI
+import urlparse
+import httplib
+import socket
+import zlib
+import re
+import fnmatch
+import threading
+import os
+import time
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from array import array
+from cStringIO import StringIO
+from xml.parsers import expat
+
+# Logging function of the plugin using this module (collectd.debug, logger.info ..), None to stay quiet
+log = None
+
+
+def _Log(msg):
+    if log is not None:
+        log(msg)
+
+
+# uuid to name translation of the hosts and VMs (used by the plugins to name the metrics)
+class MetadataCache(dict):
+    """ uuid -> name map, loaded with one get_all_records() call per XAPI class """
+    def __init__(self, hostNameField='name_label', controlDomainSuffix=None):
+        # hostNameField is the host record field used as its name ('name_label' or 'hostname')
+        # when controlDomainSuffix is set, a control domain is named after its host plus the suffix
+        self.hostNameField = hostNameField
+        self.controlDomainSuffix = controlDomainSuffix
+        self.refs = {} # translate opaque ref to uuid
+        self.missing = {} # uuid -> time of the lookup which did not find it
+        self.missingTTL = 300 # seconds before an unknown uuid is looked up again
+
+    def Load(self, session):
+        ''' Add every host and VM known by session '''
+        host_records = session.xenapi.host.get_all_records()
+        vm_records = session.xenapi.VM.get_all_records()
+        for ref, record in host_records.iteritems():
+            self.UpdateHost(ref, record)
+        for ref, record in vm_records.iteritems():
+            self.UpdateVM(ref, record)
+
+    def UpdateHost(self, ref, record):
+        self.refs[ref] = record['uuid']
+        self[record['uuid']] = record[self.hostNameField]
+
+    def UpdateVM(self, ref, record):
+        # templates and snapshots never show up in rrd_updates
+        if record['is_a_template'] or record['is_a_snapshot']:
+            self.Remove(ref)
+            return
+        name = record['name_label']
+        if record['is_control_domain'] and self.controlDomainSuffix is not None:
+            host_name = self.GetRefName(record['resident_on'])
+            if host_name is not None:
+                name = host_name + self.controlDomainSuffix
+        self.refs[ref] = record['uuid']
+        self[record['uuid']] = name
+
+    def Remove(self, ref):
+        uuid = self.refs.pop(ref, None)
+        if uuid is not None:
+            self.pop(uuid, None)
+
+    def Resolve(self, session, uuids):
+        '''
+        Look up the uuids not in the cache with one get_all_records_where() call per
+        class. The ones still not found are not looked up again for missingTTL seconds
+        '''
+        now = time.time()
+        lookup = []
+        for uuid in uuids:
+            if not uuid or uuid in self or now - self.missing.get(uuid, 0) < self.missingTTL:
+                continue
+            lookup.append(uuid)
+        if not lookup:
+            return
+        where = " or ".join(['field "uuid" = "%s"' % uuid for uuid in lookup])
+        for ref, record in session.xenapi.host.get_all_records_where(where).iteritems():
+            self.UpdateHost(ref, record)
+        for ref, record in session.xenapi.VM.get_all_records_where(where).iteritems():
+            self.UpdateVM(ref, record)
+        for uuid in lookup:
+            if uuid in self:
+                self.missing.pop(uuid, None)
+            else:
+                self.missing[uuid] = now
+
+    def Dump(self):
+        ''' Return the names and refs, to save them in a StateFile '''
+        return {'names': dict(self), 'refs': dict(self.refs)}
+
+    def Restore(self, dump):
+        ''' Add the names and refs of a Dump() '''
+        self.update(dump.get('names', {}))
+        self.refs.update(dump.get('refs', {}))
+
+    def GetRefName(self, ref):
+        ''' Return the name of the object with opaque ref, None if unknown '''
+        uuid = self.refs.get(ref)
+        if uuid is None:
+            return None
+        return self.get(uuid)
+
+
+# Collector state kept across restarts (used by the plugins to resume where they stopped)
+class StateFile:
+    '''
+    Pickled state of the collector: the rrd_updates cursor of each host and, optionally,
+    the uuid -> name cache. Save() writes a temporary file of its own and renames it over
+    the previous one, a crash leaves the old state or the new one, never half of one.
+    Update() holds a lock on <path>.lock around the load, change and save, so that the
+    processes and threads sharing the file do not lose each other's hosts.
+    '''
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def Load(self):
+        ''' Return the state saved last, {} if there is none or if it can not be read '''
+        try:
+            state_file = open(self.path, 'rb')
+        except IOError:
+            return {}
+        try:
+            try:
+                state = pickle.load(state_file)
+            except Exception:
+                return {}
+        finally:
+            state_file.close()
+        if not isinstance(state, dict) or state.get('version') != self.version:
+            return {}
+        return state
+
+    def Save(self, state):
+        state = dict(state)
+        state['version'] = self.version
+        state['time'] = time.time()
+        (fd, temp) = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                      dir=os.path.dirname(self.path) or '.')
+        try:
+            state_file = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            finally:
+                state_file.close()
+            os.rename(temp, self.path)
+        except:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+    def Update(self, update):
+        ''' Save update(state) of the state saved last, under the lock of the file '''
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self.Save(update(self.Load()))
+        finally:
+            # closing the file releases the lock
+            lock_file.close()
+
+# Body of a rrd_updates response (used by GetRRDUdpates.Parse as its stream)
+class RRDResponse:
+    """ File like object reading a RRDHttpClient response: counts the bytes received, decompresses gzip """
+    def __init__(self, response, client):
+        self.response = response
+        self.client = client
+        self.received = 0
+        self.read_time = 0.0 # seconds spent waiting for the server and decompressing
+        self.decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size):
+        t1 = time.time()
+        try:
+            while True:
+                chunk = self.response.read(size)
+                self.client.bytes_received += len(chunk)
+                self.received += len(chunk)
+                if self.decompressor is None:
+                    return chunk
+                if not chunk:
+                    return self.decompressor.flush()
+                data = self.decompressor.decompress(chunk)
+                if data:
+                    return data
+        finally:
+            self.read_time += time.time() - t1
+
+    def close(self):
+        # httplib closes the response once it is read to the end, the connection
+        # can only be reused then
+        if not self.response.isclosed():
+            self.client.Close()
+        self.response.close()
+
+# Keep alive HTTP connection (used by GetRRDUdpates to fetch rrd_updates)
+class RRDHttpClient:
+    """ One persistent HTTP, HTTPS or unix socket connection to server, with connect and read timeouts """
+    def __init__(self, server, connect_timeout=5, read_timeout=30):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(server)
+        self.server = server
+        self.scheme = scheme
+        self.netloc = netloc
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.conn = None
+        self.requests = 0
+        self.connects = 0
+        self.bytes_received = 0 # as sent by the server, before decompression
+
+    def Open(self, path):
+        '''
+        GET path and return a RRDResponse reading its body. Like urllib.URLopener,
+        an http error raises IOError('http error', status, reason, headers)
+        '''
+        reused = self.conn is not None and self.conn.sock is not None
+        try:
+            response = self.__request(path)
+        except (httplib.HTTPException, socket.error):
+            if not reused:
+                raise
+            # the server closed the idle connection, retry once on a new one
+            self.Close()
+            response = self.__request(path)
+        self.requests += 1
+        if response.status != 200:
+            response.read()
+            raise IOError('http error', response.status, response.reason, response.msg)
+        return RRDResponse(response, self)
+
+    def Close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def GetStats(self):
+        ''' Requests, connections opened, bytes received and connection reuse ratio '''
+        reuse = 0.0
+        if self.requests:
+            reuse = 1 - float(self.connects) / self.requests
+        return {'requests': self.requests, 'connects': self.connects,
+                'bytes_received': self.bytes_received, 'reuse_ratio': reuse}
+
+    def __request(self, path):
+        if self.conn is None:
+            if self.scheme == 'https':
+                self.conn = httplib.HTTPSConnection(self.netloc, timeout=self.connect_timeout)
+            elif self.netloc.startswith('_'):
+                # unix socket path with '/' written '_', as XenAPI.xapi_local() names /var/xapi/xapi
+                self.conn = XenAPI.UDSHTTPConnection(self.netloc, timeout=self.connect_timeout)
+            else:
+                self.conn = httplib.HTTPConnection(self.netloc, timeout=self.connect_timeout)
+        if self.conn.sock is None:
+            self.conn.connect()
+            self.conn.sock.settimeout(self.read_timeout)
+            self.connects += 1
+        self.conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        return self.conn.getresponse()
+
+
+# Per VM dictionary (used by GetRRDUdpates to look up column numbers by variable names)
+class VMReport(dict):
+    """Used internally by GetRRDUdpates"""
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+# Per Host dictionary (used by GetRRDUdpates to look up column numbers by variable names)
+class HostReport(dict):
+    """Used internally by GetRRDUdpates"""
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+# Legend entries to keep (used by GetRRDUdpates.Parse to skip the other columns)
+class MetricFilter:
+    '''
+    Allow and deny lists of rrd_updates legend entries (cf:vmOrHost:uuid:param). Each pattern
+    is a glob matching the whole entry, or a regular expression searched in it when prefixed
+    with "re:". An entry is kept if it matches an allow pattern (or there is none) and no deny
+    pattern. Each pattern is compiled once, on its own: the flags fnmatch.translate() adds to
+    the globs do not leak into the regular expressions.
+    '''
+    def __init__(self, allow=(), deny=()):
+        self.allow = self.__Compile(allow)
+        self.deny = self.__Compile(deny)
+
+    def __Compile(self, patterns):
+        ''' Return the match functions of patterns, None if there is none '''
+        if not patterns:
+            return None
+        matchers = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                matchers.append(re.compile(pattern[3:]).search)
+            else:
+                matchers.append(re.compile(fnmatch.translate(pattern)).match)
+        return matchers
+
+    def __Matches(self, matchers, entry):
+        for match in matchers:
+            if match(entry):
+                return True
+        return False
+
+    def Keep(self, entry):
+        ''' Return True if the legend entry has to be parsed, stored and sent '''
+        if self.allow is not None and not self.__Matches(self.allow, entry):
+            return False
+        return self.deny is None or not self.__Matches(self.deny, entry)
+
+# Fetch and parse data class
+class GetRRDUdpates:
+    """ Object used to get and parse the output the http://host/rrd_udpates?..."""
+    # <meta> nodes holding an integer, and the attribute they are stored in
+    meta_tags = {'rows': 'rows', 'columns': 'columns', 'start': 'start_time', 'step': 'step_time', 'end': 'end_time'}
+
+    def __init__(self, metric_filter=None):
+        # rrdParams are what get passed to the CGI executable in the URL
+        self.rrdParams = dict()
+        self.rrdParams['start'] = int(time.time()) - 10
+        self.rrdParams['host'] = 'true'   # include data for host (as well as for VMs)
+        self.rrdParams['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
+        self.rrdParams['interval'] = '10'
+        self.chunk_size = 64 * 1024 # bytes read from the response for each parser feed
+        self.connect_timeout = 5 # seconds
+        self.read_timeout = 30 # seconds
+        self.http = None # RRDHttpClient, kept across the refreshes
+        self.refreshStats = {} # timings and sizes of the last refresh
+        self.metric_filter = metric_filter # MetricFilter of the legend entries, None keeps them all
+        self.high_water = 0 # timestamp of the newest row returned by GetNewRows()
+
+    def GetRows(self):
+        return self.rows
+
+    def GetVMList(self):
+        return self.vm_reports.keys()
+
+    def GetVMParamList(self, uuid):
+        report = self.vm_reports[uuid]
+        if not report:
+            return []
+        return report.keys()
+
+    def GetVMData(self, uuid, param, row):
+        report = self.vm_reports[uuid]
+        col = report[param]
+        return self.__lookup_data(col, row)
+
+    def GetHostUUID(self):
+        report = self.host_report
+        if not report:
+            return None
+        return report.uuid
+
+    def GetHostParamList(self):
+        report = self.host_report
+        if not report:
+            return []
+        return report.keys()
+
+    def GetHostData(self, param, row):
+        report = self.host_report
+        col = report[param]
+        return self.__lookup_data(col, row)
+
+    def GetHttpStats(self):
+        ''' Return the RRDHttpClient.GetStats() of the refreshes so far '''
+        if self.http is None:
+            return {}
+        return self.http.GetStats()
+
+    def GetRowTime(self, row):
+        return self.__lookup_timestamp(row)
+
+    def GetColumn(self, col):
+        '''
+        Return all the values of column col as an array('d'), in chronological order
+        '''
+        if self.columns == 0:
+            # the MetricFilter left out every column
+            return array('d')
+        return self.values[col::self.columns][::-1]
+
+    def GetRow(self, row):
+        '''
+        Return all the values of row as an array('d'), indexed by column
+        '''
+        base = (self.rows - 1 - row) * self.columns
+        return self.values[base:base + self.columns]
+
+    def GetTimestamps(self):
+        '''
+        Return the timestamps of all rows as an array('l'), in chronological order
+        '''
+        return self.timestamps[::-1]
+
+    def GetLatestRow(self):
+        ''' Return the index of the newest row, None if no row was returned '''
+        return self.latest_row
+
+    def GetLatestSnapshot(self):
+        '''
+        Return (timestamp, host_values, vm_values) for the newest row.
+        host_values maps each host param to its value, vm_values maps each VM uuid
+        to the same kind of dict. All of them are read from one GetRow() slice.
+        '''
+        if self.latest_row is None:
+            return (None, {}, {})
+        values = self.GetRow(self.latest_row)
+        host_values = {}
+        if self.host_report:
+            host_values = self.__snapshot_report(self.host_report, values)
+        vm_values = {}
+        for uuid, report in self.vm_reports.iteritems():
+            vm_values[uuid] = self.__snapshot_report(report, values)
+        return (self.GetRowTime(self.latest_row), host_values, vm_values)
+
+    def __snapshot_report(self, report, values):
+        return dict([(param, values[col]) for param, col in report.iteritems() if param != ''])
+
+    def GetRowsSince(self, since, max_rows=None):
+        '''
+        Return [(timestamps, host_values, vm_values)] for the rows newer than since, oldest
+        first and max_rows at most (the newest ones), [] if there is none. host_values maps
+        each host param to the array('d') of its values in these rows, vm_values maps each
+        VM uuid to the same kind of dict. The values are read column by column: with the
+        usual consecutive rows, one strided slice of values per column
+        '''
+        selected = [row for row in self.row_order if self.GetRowTime(row) > since]
+        if max_rows is not None and len(selected) > max_rows:
+            selected = selected[-max_rows:]
+        if not selected:
+            return []
+        first = selected[0]
+        if selected == range(first, first + len(selected)):
+            # stored rows are newest first: reverse the slice to go oldest first
+            begin = (self.rows - first - len(selected)) * self.columns
+            end = (self.rows - first) * self.columns
+            def column(col):
+                return self.values[begin + col:end:self.columns][::-1]
+        else:
+            def column(col):
+                return array('d', [self.__lookup_data(col, row) for row in selected])
+        host_values = {}
+        if self.host_report:
+            host_values = self.__window_report(self.host_report, column)
+        vm_values = {}
+        for uuid, report in self.vm_reports.iteritems():
+            vm_values[uuid] = self.__window_report(report, column)
+        return [([self.GetRowTime(row) for row in selected], host_values, vm_values)]
+
+    def GetNewRows(self, max_rows=None):
+        ''' Return the GetRowsSince() windows newer than the high water, and move it past them '''
+        windows = self.GetRowsSince(self.high_water, max_rows)
+        for timestamps, host_values, vm_values in windows:
+            self.high_water = max(self.high_water, timestamps[-1])
+        return windows
+
+    def GetHighWater(self):
+        ''' Return the timestamp of the newest row returned, to resume from with SetHighWater() '''
+        return self.high_water
+
+    def SetHighWater(self, high_water):
+        ''' Resume from a GetHighWater() value, or from the oldest mark of a RRDSelection one '''
+        if isinstance(high_water, dict):
+            if not high_water:
+                return
+            high_water = min(high_water.values())
+        self.high_water = high_water
+
+    def __window_report(self, report, column):
+        return dict([(param, column(col)) for param, col in report.iteritems() if param != ''])
+
+    # extract float from value (<v>) node by col,row
+    def __lookup_data(self, col, row):
+        # Note: the <rows> nodes are in reverse chronological order, and comprise
+        # a timestamp <t> node, followed by self.columns data <v> nodes
+        return self.values[(self.rows - 1 - row) * self.columns + col]
+
+    # extract int from value (<t>) node by row
+    def __lookup_timestamp(self, row):
+        # Note: the <rows> nodes are in reverse chronological order, and comprise
+        # a timestamp <t> node, followed by self.columns data <v> nodes
+        return self.timestamps[self.rows - 1 - row]
+
+    def GetQuery(self, session, override_rrdParams = {}):
+        ''' Return the /rrd_updates?.. path of the next refresh '''
+        rrdParams = dict(self.rrdParams)
+        rrdParams.update(override_rrdParams)
+        rrdParams['session_id'] = session
+        rrdParamstr = "&".join(["%s=%s"  % (k,rrdParams[k]) for k in rrdParams])
+        return "/rrd_updates?%s" % rrdParamstr
+
+    def Refresh(self, session, override_rrdParams = {}, server = 'http://localhost'):
+        path = self.GetQuery(session, override_rrdParams)
+        url = "%s%s" % (server, path)
+
+        _Log("Query: %s" % url)
+
+        # keep the connection to the server alive, it raises an Exception on http 401 'Unauthorised' error
+        t1 = time.time()
+        if self.http is None or self.http.server != server:
+            self.http = RRDHttpClient(server, self.connect_timeout, self.read_timeout)
+        sock = self.http.Open(path)
+        t2 = time.time()
+        try:
+            # the response is parsed while it is read, the xml source is never held as a whole
+            self.Parse(sock)
+        finally:
+            sock.close()
+        # the reads of the response are fetch time, the rest of Parse() is parse time
+        self.__SetRefreshStats(t2 - t1 + sock.read_time, time.time() - t2 - sock.read_time, sock.received)
+
+        # Update the time used on the next run
+        self.rrdParams['start'] = self.end_time + 1 # avoid retrieving same data twice
+
+    def ParseBody(self, body, encoding=None, fetch_time=0.0):
+        '''
+        Parse a whole rrd_updates response body fetched by the caller (FetchLoop) in
+        fetch_time seconds, gzip encoded or not, and move the start time like Refresh does
+        '''
+        t1 = time.time()
+        size = len(body)
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.Parse(StringIO(body))
+        self.rrdParams['start'] = self.end_time + 1
+        self.__SetRefreshStats(fetch_time, time.time() - t1, size)
+
+    def GetCursor(self):
+        ''' Return the start of the next refresh, to resume from with SetCursor() '''
+        return int(self.rrdParams['start'])
+
+    def SetCursor(self, cursor):
+        ''' Resume from a GetCursor() value, or from the oldest start of a RRDSelection cursor '''
+        if isinstance(cursor, dict):
+            if not cursor:
+                return
+            cursor = min(cursor.values())
+        self.rrdParams['start'] = int(cursor)
+
+    def LimitStart(self, oldest):
+        ''' Do not ask for rows older than oldest (a time.time() value) on the next refresh '''
+        if int(self.rrdParams['start']) < oldest:
+            self.rrdParams['start'] = int(oldest)
+
+    def GetQueries(self, session, override_rrdParams = {}):
+        ''' Return [GetQuery()], the paths of the next refresh as RRDSelection does '''
+        return [self.GetQuery(session, override_rrdParams)]
+
+    def ParseBodies(self, responses, fetch_time=0.0):
+        ''' Parse the (body, encoding) response to GetQueries(), as RRDSelection does '''
+        if not isinstance(responses[0], tuple):
+            raise responses[0]
+        self.ParseBody(responses[0][0], responses[0][1], fetch_time)
+
+    def GetRefreshStats(self):
+        ''' Return the fetch_time, parse_time, bytes, rows, columns and dropped columns of the last refresh '''
+        return self.refreshStats
+
+    def __SetRefreshStats(self, fetch_time, parse_time, size):
+        self.refreshStats = {'fetch_time': fetch_time, 'parse_time': parse_time, 'bytes': size,
+                             'rows': self.rows, 'columns': self.columns, 'dropped': self.dropped}
+
+    def Parse(self, stream):
+        '''
+        Parse a rrd_updates <xport> document read from the file-like object stream.
+        The document is fed to expat chunk by chunk: the legend is indexed and the
+        values are stored as they go by, no DOM is built.
+        '''
+        # rows = number of samples per variable
+        # columns = number of variables
+        self.rows = 0
+        self.columns = 0
+        self.dropped = 0 # columns left out by the metric_filter
+
+        # These indicate the period covered by the data
+        self.start_time = 0
+        self.step_time = 0
+        self.end_time = 0
+
+        # vm_reports matches uuid to per VM report
+        self.vm_reports = {}
+
+        # There is just one host_report and its uuid should not change!
+        self.host_report = None
+
+        # The <row> nodes are stored in document order: values is a rows x columns
+        # matrix flattened row by row, timestamps has one entry per row
+        # ('l' is 64 bits wide on the LP64 platforms xapi and collectd run on)
+        self.values = array('d')
+        self.timestamps = array('l')
+
+        self.__col = 0
+        self.__text = []
+        # with a metric_filter, __keep tells for each column of the document whether its
+        # values are stored, __vcol is the column of the next <v> in the current row
+        self.__keep = None
+        if self.metric_filter is not None:
+            self.__keep = []
+        self.__vcol = 0
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.__start_element
+        parser.EndElementHandler = self.__end_element
+        parser.CharacterDataHandler = self.__character_data
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+        parser.Parse('', True)
+
+        # trust the rows really read over the <rows> meta data
+        self.rows = len(self.timestamps)
+        if self.__keep is not None:
+            # the stored rows only hold the columns kept
+            self.columns = len(self.__keep) - self.dropped
+
+        # row_order lists the rows from the oldest to the newest sample, do not
+        # rely on the document order for it
+        self.row_order = sorted(range(self.rows), key=self.GetRowTime)
+        if self.row_order:
+            self.latest_row = self.row_order[-1]
+        else:
+            self.latest_row = None
+        _Log("start_time:%s, step_time:%s, end_time:%s" % (self.start_time, self.step_time, self.end_time))
+
+    def __start_element(self, name, attrs):
+        self.__text = []
+
+    def __character_data(self, data):
+        self.__text.append(data)
+
+    def __end_element(self, name):
+        text = ''.join(self.__text)
+        self.__text = []
+        if name == 'v':
+            if self.__keep is None:
+                self.values.append(float(text))
+            else:
+                if self.__keep[self.__vcol]:
+                    self.values.append(float(text))
+                self.__vcol += 1
+        elif name == 't':
+            # each <row> starts with its timestamp
+            self.timestamps.append(int(text))
+            self.__vcol = 0
+        elif name == 'entry':
+            # Handle each column.  (I.e. each variable)
+            if self.__keep is None:
+                self.__handle_col(self.__col, text)
+                self.__col += 1
+            elif self.metric_filter.Keep(text):
+                # kept columns are numbered in the stored rows, not in the document
+                self.__keep.append(True)
+                self.__handle_col(self.__col, text)
+                self.__col += 1
+            else:
+                self.__keep.append(False)
+                self.dropped += 1
+        elif name in self.meta_tags:
+            setattr(self, self.meta_tags[name], int(text))
+
+    def __handle_col(self, col, col_meta_data):
+        # work out how to interpret col from its legend <entry>, col_meta_data
+
+        # vmOrHost will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
+        (cf, vmOrHost, uuid, param) = col_meta_data.split(':')
+
+        if vmOrHost == 'vm':
+            # Create a report for this VM if it doesn't exist
+            if not self.vm_reports.has_key(uuid):
+                self.vm_reports[uuid] = VMReport(uuid)
+
+            # Update the VMReport with the col data and meta data
+            vm_report = self.vm_reports[uuid]
+            vm_report[param] = col
+
+        elif vmOrHost == 'host':
+            # Create a report for the host if it doesn't exist
+            if not self.host_report:
+                self.host_report = HostReport(uuid)
+            elif self.host_report.uuid != uuid:
+                raise Exception, "Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid)
+
+            # Update the HostReport with the col data and meta data
+            self.host_report[param] = col
+
+        else:
+            raise Exception, "Invalid string in <legend>: %s" % col_meta_data
+
+# rrd_updates of some VMs only (used by the plugins in place of GetRRDUdpates)
+class RRDSelection:
+    '''
+    rrd_updates of a selection of VMs only: one vm_uuid= query per VM, each with its own
+    GetRRDUdpates (connection and start cursor), fetched max_parallel at a time and merged
+    back into one snapshot. The host metrics, when asked, come with the query of the first
+    VM. A VM whose query fails (not running on this host any more, ..) is left out of the
+    snapshot, the refresh only fails when all the queries do or when the session is refused.
+    Offers the GetRRDUdpates methods the plugins use.
+    '''
+    def __init__(self, vm_uuids, metric_filter=None, max_parallel=8):
+        self.vm_uuids = list(vm_uuids)
+        self.parts = [GetRRDUdpates(metric_filter) for uuid in self.vm_uuids]
+        self.max_parallel = max_parallel
+        self.current = [] # index of the parts parsed by the last refresh
+        self.failed = [] # (vm uuid, error) of the parts which failed the last refresh
+        self.end_time = 0
+        self.refreshStats = {}
+
+    def GetQueries(self, session, override_rrdParams = {}):
+        ''' Return the /rrd_updates?.. path of each VM for the next refresh '''
+        return [part.GetQuery(session, self.__Override(index, override_rrdParams))
+                for index, part in enumerate(self.parts)]
+
+    def __Override(self, index, override_rrdParams):
+        rrdParams = dict(override_rrdParams)
+        rrdParams['vm_uuid'] = self.vm_uuids[index]
+        if index > 0:
+            rrdParams['host'] = 'false'
+        return rrdParams
+
+    def Refresh(self, session, override_rrdParams = {}, server = 'http://localhost'):
+        t1 = time.time()
+        errors = [None] * len(self.parts)
+        queue = range(len(self.parts))
+        def fetch():
+            while True:
+                try:
+                    index = queue.pop()
+                except IndexError:
+                    return
+                try:
+                    self.parts[index].Refresh(session, self.__Override(index, override_rrdParams), server)
+                except Exception, e:
+                    errors[index] = e
+        threads = [threading.Thread(target=fetch) for i in range(min(self.max_parallel, len(self.parts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.__Merge(errors, time.time() - t1)
+
+    def ParseBodies(self, responses, fetch_time=0.0):
+        '''
+        Parse the responses to GetQueries() fetched by the caller (FetchLoop): a (body, encoding)
+        per query, or the error of the queries which failed
+        '''
+        t1 = time.time()
+        errors = []
+        for index, response in enumerate(responses):
+            if isinstance(response, tuple):
+                try:
+                    self.parts[index].ParseBody(response[0], response[1], fetch_time)
+                    response = None
+                except Exception, e:
+                    response = e
+            errors.append(response)
+        self.__Merge(errors, fetch_time + time.time() - t1)
+
+    def __Merge(self, errors, refresh_time):
+        self.current = []
+        self.failed = []
+        for index, error in enumerate(errors):
+            if error is None:
+                self.current.append(index)
+                continue
+            # xapi does not know the session anymore: the caller logs in again
+            if isinstance(error, IOError) and len(error.args) > 1 and error.args[1] == 401:
+                raise error
+            self.failed.append((self.vm_uuids[index], error))
+        if not self.current and self.failed:
+            raise self.failed[0][1]
+        stats = {'fetch_time': 0.0, 'parse_time': 0.0, 'bytes': 0, 'rows': 0, 'columns': 0, 'dropped': 0}
+        for index in self.current:
+            part = self.parts[index]
+            self.end_time = max(self.end_time, part.end_time)
+            for key, value in part.GetRefreshStats().iteritems():
+                if key == 'rows':
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+        # the queries run concurrently, what is not parsing is waiting for them
+        stats['fetch_time'] = max(0.0, refresh_time - stats['parse_time'])
+        stats['queries'] = len(self.parts)
+        stats['failed'] = len(self.failed)
+        self.refreshStats = stats
+
+    def GetFailed(self):
+        ''' Return the (vm uuid, error) of the queries which failed the last refresh '''
+        return self.failed
+
+    def GetLatestSnapshot(self):
+        ''' Return the GetLatestSnapshot() of all the parts refreshed, merged '''
+        (rowTime, host_values, vm_values) = (None, {}, {})
+        for index in self.current:
+            (timestamp, values, vms) = self.parts[index].GetLatestSnapshot()
+            if timestamp is None:
+                continue
+            if rowTime is None or timestamp > rowTime:
+                rowTime = timestamp
+            if values:
+                host_values = values
+            vm_values.update(vms)
+        return (rowTime, host_values, vm_values)
+
+    def GetRowsSince(self, since, max_rows=None):
+        ''' Return the GetRowsSince() windows of all the parts refreshed '''
+        windows = []
+        for index in self.current:
+            windows.extend(self.parts[index].GetRowsSince(since, max_rows))
+        return windows
+
+    def GetNewRows(self, max_rows=None):
+        '''
+        Return the GetNewRows() windows of all the parts refreshed: each part has its own
+        high water, a part left out of a refresh keeps its mark and gets its rows back later
+        '''
+        windows = []
+        for index in self.current:
+            windows.extend(self.parts[index].GetNewRows(max_rows))
+        return windows
+
+    def GetHighWater(self):
+        ''' Return the high water of each VM query '''
+        return dict([(self.vm_uuids[index], part.GetHighWater()) for index, part in enumerate(self.parts)])
+
+    def SetHighWater(self, high_water):
+        ''' Resume from a GetHighWater() value, the VMs not in it keep their mark '''
+        for index, part in enumerate(self.parts):
+            if not isinstance(high_water, dict):
+                part.SetHighWater(high_water)
+            elif self.vm_uuids[index] in high_water:
+                part.SetHighWater(high_water[self.vm_uuids[index]])
+
+    def LimitStart(self, oldest):
+        for part in self.parts:
+            part.LimitStart(oldest)
+
+    def GetCursor(self):
+        ''' Return the start of the next refresh of each VM '''
+        return dict([(self.vm_uuids[index], part.GetCursor()) for index, part in enumerate(self.parts)])
+
+    def SetCursor(self, cursor):
+        ''' Resume from a GetCursor() value, the VMs not in it keep their start '''
+        for index, part in enumerate(self.parts):
+            if not isinstance(cursor, dict):
+                part.SetCursor(cursor)
+            elif self.vm_uuids[index] in cursor:
+                part.SetCursor(cursor[self.vm_uuids[index]])
+
+    def GetHostUUID(self):
+        for index in self.current:
+            uuid = self.parts[index].GetHostUUID()
+            if uuid is not None:
+                return uuid
+        return None
+
+    def GetRefreshStats(self):
+        ''' Return the GetRRDUdpates.GetRefreshStats() of the parts summed, with the queries and failed counts '''
+        return self.refreshStats
+
+    def GetHttpStats(self):
+        ''' Return the RRDHttpClient.GetStats() of the parts summed '''
+        stats = {'requests': 0, 'connects': 0, 'bytes_received': 0}
+        for part in self.parts:
+            for key, value in part.GetHttpStats().iteritems():
+                if key in stats:
+                    stats[key] += value
+        stats['reuse_ratio'] = 0.0
+        if stats['requests']:
+            stats['reuse_ratio'] = 1 - float(stats['connects']) / stats['requests']
+        return stats